@@ -0,0 +1,270 @@
+"""
+Microbenchmarks for the hot paths of thinFTP's FileHandler.
+
+Unlike `ftp_tester.py`, which exercises a running server end to end, this
+suite calls `FileHandler` directly on synthetic trees, so that the cost of
+the filesystem layer can be measured in isolation. It needs nothing but the
+standard library and a writable temporary directory, and runs offline.
+
+Trees generated:
+
+- wide: a single directory holding many files.
+- deep: a chain of nested directories.
+- small: many small files spread over several directories.
+- symlinks: a directory of symbolic links to files and directories.
+
+Each benchmark is looped until a measurement lasts at least `MIN_TIME`, so
+that fast operations are not dominated by timer resolution, and measured
+several times; the best time is kept, as it is the least affected by noise
+from other processes. Results can be
+saved as a JSON baseline, and later runs compared against it: the run fails
+(exit status 1) when a benchmark is slower than its baseline by more than
+the threshold.
+
+Usage::
+
+    python benchmarks/fileman_bench.py --save benchmarks/fileman_baseline.json
+    # ... change fileman.py ...
+    python benchmarks/fileman_bench.py --compare benchmarks/fileman_baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from thinftp.fileman import FileHandler  # noqa: E402
+
+#: Number of entries of each tree at scale 1.
+WIDE_FILES = 2000
+DEEP_LEVELS = 64
+SMALL_DIRS, SMALL_FILES = 20, 100
+SYMLINKS = 500
+BIG_FILE_SIZE = 8 * 1024 * 1024
+#: Minimum duration of a single measurement, in seconds.
+MIN_TIME = 0.05
+
+
+def make_trees(root, scale):
+    """
+    Generate the synthetic trees.
+
+    Parameters:
+        root (Path): Directory receiving the trees.
+        scale (float): Multiplier of the number of entries.
+
+    Returns:
+        dict: Facts about the trees used by the benchmarks.
+    """
+    n = lambda count: max(1, int(count * scale))
+
+    wide = root / 'wide'
+    wide.mkdir()
+    for i in range(n(WIDE_FILES)):
+        (wide / f"file{i:06d}.dat").write_bytes(b'x' * (i % 512))
+
+    deep = root / 'deep'
+    path = deep
+    for i in range(n(DEEP_LEVELS)):
+        path = path / f"d{i}"
+    path.mkdir(parents=True)
+    (path / 'leaf.txt').write_bytes(b'leaf')
+
+    small = root / 'small'
+    for d in range(n(SMALL_DIRS)):
+        sub = small / f"dir{d:04d}"
+        sub.mkdir(parents=True)
+        for f in range(SMALL_FILES):
+            (sub / f"f{f:04d}.txt").write_bytes(os.urandom(256))
+
+    links = root / 'symlinks'
+    links.mkdir()
+    for i in range(n(SYMLINKS)):
+        target = f"../wide/file{i % n(WIDE_FILES):06d}.dat" if i % 2 else '../small'
+        (links / f"link{i:05d}").symlink_to(target)
+
+    (root / 'big.bin').write_bytes(os.urandom(BIG_FILE_SIZE))
+    with open(root / 'sparse.img', 'wb') as f:
+        f.truncate(BIG_FILE_SIZE * 16)
+        f.seek(BIG_FILE_SIZE * 8)
+        f.write(os.urandom(BIG_FILE_SIZE // 16))
+    line = b'lorem ipsum dolor sit amet, consectetur adipiscing elit\n'
+    (root / 'big.txt').write_bytes(line * (BIG_FILE_SIZE // len(line)))
+    return {
+        'deep_path': '/' + path.relative_to(root).as_posix(),
+        'small_files': [f"/small/dir{d:04d}/f{f:04d}.txt"
+                        for d in range(n(SMALL_DIRS)) for f in range(0, SMALL_FILES, 10)],
+    }
+
+
+def benchmarks(fm, facts):
+    """
+    Define the benchmarks.
+
+    Parameters:
+        fm (FileHandler): Handler rooted at the generated trees.
+        facts (dict): Result of `make_trees`.
+
+    Returns:
+        dict: Benchmark names mapped to (callable, operations per call).
+    """
+    deep = facts['deep_path']
+    small = facts['small_files']
+    resolve_paths = ['wide/file000001.dat', '/small/dir0000/../dir0000/f0001.txt',
+                     deep + '/leaf.txt', 'symlinks/link00001', '../../etc']
+    chunk = b'y' * 8192
+
+    def read_all(fname, type='I'):
+        for _ in fm.read(fname, type):
+            pass
+
+    def cwd_deep():
+        fm.cwd(deep)
+        fm.cwd('/')
+
+    return {
+        'resolve_path': (lambda: [fm.resolve_path(p) for p in resolve_paths], len(resolve_paths)),
+        'name_ls/wide': (lambda: fm.name_ls('wide'), 1),
+        'name_ls/symlinks': (lambda: fm.name_ls('symlinks'), 1),
+        'name_ls/wide-glob': (lambda: fm.name_ls('wide/file0001*.dat'), 1),
+        'ls/wide': (lambda: fm.ls('wide'), 1),
+        'ls/symlinks': (lambda: fm.ls('symlinks'), 1),
+        'ls/deep-leaf': (lambda: fm.ls(deep), 1),
+        'read/big-binary': (lambda: read_all('big.bin'), 1),
+        'read/big-ascii': (lambda: read_all('big.txt', 'A'), 1),
+        'read/sparse': (lambda: read_all('sparse.img'), 1),
+        'read/small-files': (lambda: [read_all(f) for f in small], len(small)),
+        'write/big': (lambda: fm.write('out.bin', (chunk for _ in range(BIG_FILE_SIZE // len(chunk)))), 1),
+        'write/small-files': (lambda: [fm.write(f"out{i}.txt", [chunk[:256]]) for i in range(100)], 100),
+        'cwd/deep': (cwd_deep, 2),
+    }
+
+
+def run(scale=1.0, repeat=5, only=None):
+    """
+    Run the benchmarks on freshly generated trees.
+
+    Parameters:
+        scale (float): Multiplier of the number of entries of the trees.
+        repeat (int): Runs of each benchmark; the best one is kept.
+        only (str): Run only the benchmarks whose name contains this.
+
+    Returns:
+        dict: Benchmark names mapped to the best time per operation, in seconds.
+    """
+    root = Path(tempfile.mkdtemp(prefix='thinftp-bench-'))
+    try:
+        facts = make_trees(root, scale)
+        fm = FileHandler(root)
+        results = {}
+        for name, (fn, ops) in benchmarks(fm, facts).items():
+            if only and only not in name:
+                continue
+            # Warm up caches while finding how many calls last MIN_TIME
+            loops = 1
+            while True:
+                start = time.perf_counter()
+                for _ in range(loops):
+                    fn()
+                if time.perf_counter() - start >= MIN_TIME:
+                    break
+                loops *= 2
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for _ in range(loops):
+                    fn()
+                best = min(best, (time.perf_counter() - start) / loops)
+            results[name] = best / ops
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline.
+
+    Parameters:
+        results (dict): Current results.
+        baseline (dict): Baseline results.
+        threshold (float): Allowed slowdown, as a fraction (0.25 is 25%).
+
+    Returns:
+        list: Names of the benchmarks that regressed.
+    """
+    regressed = []
+    for name, secs in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<20} {secs * 1e6:12.1f} us   (no baseline)")
+            continue
+        change = secs / base - 1
+        mark = ''
+        if change > threshold:
+            regressed.append(name)
+            mark = '  REGRESSION'
+        print(f"{name:<20} {secs * 1e6:12.1f} us   {base * 1e6:12.1f} us   {change:+7.1%}{mark}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for FileHandler")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="Multiplier of the size of the generated trees (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Runs of each benchmark, the best is kept (default: %(default)s)")
+    parser.add_argument('--filter', metavar="TEXT",
+                        help="Run only the benchmarks whose name contains TEXT")
+    parser.add_argument('--save', metavar="FILE",
+                        help="Save the results as a JSON baseline")
+    parser.add_argument('--compare', metavar="FILE",
+                        help="Compare with a JSON baseline, failing on regressions")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Allowed slowdown against the baseline (default: %(default)s)")
+    opts = parser.parse_args()
+
+    results = run(opts.scale, opts.repeat, opts.filter)
+    status = 0
+    if opts.compare:
+        with open(opts.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['meta']['scale'] != opts.scale:
+            print(f"Baseline was recorded at scale {baseline['meta']['scale']}, not {opts.scale}")
+            return 2
+        print(f"{'benchmark':<20} {'current':>15}   {'baseline':>15}   change")
+        regressed = compare(results, baseline['results'], opts.threshold)
+        if regressed:
+            print(f"{len(regressed)} benchmarks regressed by more than {opts.threshold:.0%}: "
+                  + ', '.join(regressed))
+            status = 1
+    else:
+        for name, secs in results.items():
+            print(f"{name:<20} {secs * 1e6:12.1f} us")
+
+    if opts.save:
+        data = {
+            'meta': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'scale': opts.scale,
+                'repeat': opts.repeat,
+            },
+            'results': results,
+        }
+        with open(opts.save, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        print(f"Saved baseline to {opts.save}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
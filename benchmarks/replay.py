@@ -0,0 +1,358 @@
+"""
+Replay of recorded thinFTP sessions.
+
+Drives a server with the sessions of a trace recorded with
+`--record-trace` (see `thinftp.trace`), keeping their timing, and reports
+the latency of each kind of command and the throughput of the transfers, so
+that tuning decisions rest on real traffic shapes.
+
+Sessions start at the times they started when recorded, and send each of
+their commands at its recorded offset, divided by `--speed` (0 sends them
+as fast as the server answers). At most `--concurrency` sessions run at
+once; sessions that have to wait for a free slot start late, which the
+report shows as lag. Uploads send as many bytes as were recorded, and
+downloads read whatever the server sends.
+
+By default the trace is replayed against a fresh server started in a child
+process, serving a temporary directory populated with the directories and
+files (of the recorded sizes) that the trace reads. Use `--port` to replay
+against a running server instead, logging in with `--user`/`--password`.
+Either way the replay comes from a single IP, so the server's command rate
+limit should be off (the child server runs without it).
+
+It needs nothing but the standard library.
+
+Usage::
+
+    python benchmarks/replay.py trace.gz --speed 10 --concurrency 32
+"""
+
+import argparse
+import posixpath
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from thinftp.trace import read_trace  # noqa: E402
+
+#: Commands using the data connection, and SITE subcommands doing so.
+DATA_VERBS = ('LIST', 'NLST', 'MLSD', 'RETR', 'STOR', 'APPE', 'STOU')
+DATA_SITE_CMDS = ('FIND', 'RETRTAR', 'STORTAR')
+#: Commands uploading over the data connection.
+UPLOAD_VERBS = ('STOR', 'APPE', 'STOU')
+#: Commands whose argument is a file that must exist.
+READ_VERBS = ('RETR', 'SIZE', 'MDTM', 'HASH', 'XCRC', 'XMD5', 'XSHA1', 'XSHA256', 'DELE', 'RNFR')
+
+
+def serve(directory, backend):
+    """
+    Run a server on an ephemeral port, printing the port on stdout.
+    """
+    from argparse import Namespace
+    from thinftp.handler import ThinFTP
+    from thinftp.logger import get_logger
+    from thinftp.server import ThreadedThinFTP
+
+    lgr = get_logger()
+    lgr.setLevel('CRITICAL')
+    config = Namespace(bind='127.0.0.1', port=0, user='bench', pswd='bench',
+                       directory=directory, backend=backend, lgr=lgr, command_rate=0)
+    with ThreadedThinFTP(('127.0.0.1', 0), ThinFTP, config) as server:
+        print(server.server_address[1], flush=True)
+        server.serve_forever()
+
+
+def populate(directory, sessions):
+    """
+    Create the directories and files the sessions of a trace expect.
+
+    Parameters:
+        directory (str): The directory to populate.
+        sessions (list): Sessions of the trace.
+
+    Returns:
+        tuple: (directories, files) created.
+    """
+    dirs = set()
+    files = {}
+    for session in sessions:
+        cwd = '/'
+        for _, verb, args, code, _, size in session['cmds']:
+            if code >= 400:
+                continue
+            if verb == 'CWD' and args:
+                cwd = posixpath.normpath(posixpath.join(cwd, args))
+                dirs.add(cwd)
+            elif verb == 'CDUP':
+                cwd = posixpath.dirname(cwd)
+            elif verb in READ_VERBS and args:
+                path = posixpath.normpath(posixpath.join(cwd, args))
+                files[path] = max(files.get(path, 0), size if verb == 'RETR' else 0)
+    root = Path(directory)
+    for d in dirs:
+        (root / d.lstrip('/')).mkdir(parents=True, exist_ok=True)
+    created = 0
+    for path, size in files.items():
+        local = root / path.lstrip('/')
+        if local.is_dir() or path.lstrip('/') == '':
+            continue
+        local.parent.mkdir(parents=True, exist_ok=True)
+        with open(local, 'wb') as f:
+            f.truncate(size)
+        created += 1
+    return len(dirs), created
+
+
+class Control:
+    """
+    A minimal FTP control connection.
+    """
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rb')
+        self.host = host
+        self.reply()
+
+    def reply(self):
+        """
+        Read a reply, possibly multi-line.
+
+        Returns:
+            tuple: (code, text of the last line).
+        """
+        line = self.file.readline().decode(errors='replace')
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        if line[3:4] == '-':
+            end = line[:3] + ' '
+            while not line.startswith(end):
+                line = self.file.readline().decode(errors='replace')
+                if not line:
+                    raise ConnectionError("Connection closed by server")
+        return int(line[:3]), line[4:].strip()
+
+    def send(self, cmd):
+        self.sock.sendall(cmd.encode() + b'\r\n')
+
+    def command(self, cmd):
+        self.send(cmd)
+        return self.reply()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def pasv_address(text, host):
+    """
+    Get the data address from the text of a 227 or 229 reply.
+    """
+    if '(|||' in text:
+        return host, int(text.split('(|||')[1].split('|')[0])
+    numbers = text[text.index('(') + 1:text.index(')')].split(',')
+    return '.'.join(numbers[:4]), int(numbers[4]) * 256 + int(numbers[5])
+
+
+class Stats:
+    """
+    Latencies and transfers of a replay, collected from all sessions.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.mismatches = 0
+        self.bytes = 0
+        self.lag = []
+        self.failed_sessions = 0
+        self._lock = threading.Lock()
+
+    def fail(self):
+        with self._lock:
+            self.failed_sessions += 1
+
+    def add(self, verb, latency, code, recorded, transferred):
+        with self._lock:
+            self.latencies[verb].append(latency)
+            self.bytes += transferred
+            if code >= 400:
+                self.errors[verb] += 1
+            if code // 100 != recorded // 100 and recorded:
+                self.mismatches += 1
+
+
+def run_command(ctl, data, verb, args, size):
+    """
+    Send a command, doing its data transfer, if any.
+
+    Returns:
+        tuple: (code, bytes transferred, data address for the next command,
+        if a PASV reply has not been used yet).
+    """
+    cmd = f"{verb} {args}" if args else verb
+    site = args.split(' ', 1)[0] if verb == 'SITE' else ''
+    if verb in ('PASV', 'EPSV'):
+        code, text = ctl.command(cmd)
+        return code, 0, pasv_address(text, ctl.host) if code in (227, 229) else None
+    if verb not in DATA_VERBS and site not in DATA_SITE_CMDS:
+        code, _ = ctl.command(cmd)
+        return code, 0, data
+    if data is None:
+        code, _ = ctl.command(cmd)
+        return code, 0, None
+    with socket.create_connection(data) as conn:
+        code, _ = ctl.command(cmd)
+        if not 100 <= code < 200:
+            return code, 0, None
+        transferred = 0
+        if verb in UPLOAD_VERBS or site == 'STORTAR':
+            chunk = b'\0' * 65536
+            while transferred < size:
+                n = min(len(chunk), size - transferred)
+                conn.sendall(chunk[:n])
+                transferred += n
+            conn.shutdown(socket.SHUT_WR)
+        else:
+            while True:
+                block = conn.recv(65536)
+                if not block:
+                    break
+                transferred += len(block)
+    code, _ = ctl.reply()
+    return code, transferred, None
+
+
+def replay_session(session, t0, speed, port, host, user, password, stats):
+    """
+    Replay one session, waiting for the recorded time of each command.
+    """
+    start = t0 + session['start'] / speed if speed else time.monotonic()
+    delay = start - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    else:
+        with stats._lock:
+            stats.lag.append(-delay)
+        start = time.monotonic()
+    try:
+        ctl = Control(port, host)
+    except OSError:
+        stats.fail()
+        return
+    try:
+        ctl.command(f"USER {user}")
+        code, _ = ctl.command(f"PASS {password}")
+        if code != 230:
+            stats.fail()
+            return
+        data = None
+        for offset, verb, args, recorded, _, size in session['cmds']:
+            if verb in ('USER', 'PASS'):
+                continue
+            if speed:
+                delay = start + offset / 1000 / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            began = time.perf_counter()
+            code, transferred, data = run_command(ctl, data, verb, args, size)
+            stats.add(verb, time.perf_counter() - began, code, recorded, transferred)
+            if verb == 'QUIT':
+                break
+    except OSError:
+        stats.fail()
+    finally:
+        ctl.close()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(stats, elapsed, sessions):
+    """
+    Print the results of a replay.
+    """
+    commands = sum(len(v) for v in stats.latencies.values())
+    print(f"{'command':<10} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for verb, values in sorted(stats.latencies.items(), key=lambda kv: -len(kv[1])):
+        values.sort()
+        print(f"{verb:<10} {len(values):>7} {stats.errors[verb]:>7} "
+              + ' '.join(f"{percentile(values, p) * 1000:9.2f}" for p in (0.5, 0.95, 0.99))
+              + f" {values[-1] * 1000:9.2f}")
+    print()
+    print(f"sessions:          {sessions} ({stats.failed_sessions} failed)")
+    print(f"commands:          {commands} in {elapsed:.2f} s ({commands / elapsed:.1f}/s)")
+    print(f"transferred:       {stats.bytes / 1e6:.2f} MB ({stats.bytes / 1e6 / elapsed:.2f} MB/s)")
+    print(f"reply mismatches:  {stats.mismatches} (reply class differs from the recording)")
+    if stats.lag:
+        print(f"late sessions:     {len(stats.lag)} (max {max(stats.lag):.2f} s behind)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded thinFTP sessions")
+    parser.add_argument('trace', nargs='?', help="Trace file recorded with --record-trace")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help="Maximum number of concurrent sessions (default: %(default)s)")
+    parser.add_argument('--backend', choices=('local', 'memory'), default='local',
+                        help="Filesystem backend of the child server (default: %(default)s)")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Host of a running server (default: %(default)s)")
+    parser.add_argument('--port', type=int,
+                        help="Port of a running server to replay against, instead of a child server")
+    parser.add_argument('--user', default='bench', help="User of a running server")
+    parser.add_argument('--password', default='bench', help="Password of a running server")
+    parser.add_argument('--serve', metavar="DIR", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.serve:
+        serve(opts.serve, opts.backend)
+        return 0
+    if not opts.trace:
+        parser.error("the trace file is required")
+    _, sessions = read_trace(opts.trace)
+    if not sessions:
+        print("The trace holds no sessions")
+        return 1
+
+    with tempfile.TemporaryDirectory(prefix='thinftp-replay-') as directory:
+        proc = None
+        port = opts.port
+        if port is None:
+            dirs, files = populate(directory, sessions)
+            print(f"Populated {dirs} directories and {files} files")
+            proc = subprocess.Popen([sys.executable, __file__, '--serve', directory,
+                                     '--backend', opts.backend],
+                                    stdout=subprocess.PIPE, text=True)
+            port = int(proc.stdout.readline())
+            if opts.backend == 'memory':
+                print("Note: the memory backend starts empty, reads may fail")
+        stats = Stats()
+        try:
+            t0 = time.monotonic()
+            with ThreadPoolExecutor(opts.concurrency) as pool:
+                for session in sessions:
+                    pool.submit(replay_session, session, t0, opts.speed, port, opts.host,
+                                opts.user, opts.password, stats)
+            elapsed = time.monotonic() - t0
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+    report(stats, elapsed, len(sessions))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
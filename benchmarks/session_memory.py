@@ -0,0 +1,145 @@
+"""
+Memory footprint of idle thinFTP sessions.
+
+Starts a server in a child process, opens many control connections to it and
+logs each one in, then reports how much the server's resident set size (RSS)
+grew per 1000 idle logged-in sessions. Each session costs a thread, its
+socket and the handler's state; this measures all of them together, as seen
+by the operating system.
+
+The server runs in its own process so that the client sockets do not count,
+and its RSS is read from `/proc`, so this only runs on Linux. It needs
+nothing but the standard library.
+
+Usage::
+
+    python benchmarks/session_memory.py --sessions 2000
+"""
+
+import argparse
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def serve(directory, backend):
+    """
+    Run a server on an ephemeral port, printing the port on stdout.
+    """
+    sys.path.insert(0, str(ROOT))
+    from argparse import Namespace
+    from thinftp.handler import ThinFTP
+    from thinftp.logger import get_logger
+    from thinftp.server import ThreadedThinFTP
+
+    lgr = get_logger()
+    lgr.setLevel('CRITICAL')
+    config = Namespace(bind='127.0.0.1', port=0, user='bench', pswd='bench',
+                       directory=directory, backend=backend, lgr=lgr)
+    with ThreadedThinFTP(('127.0.0.1', 0), ThinFTP, config) as server:
+        print(server.server_address[1], flush=True)
+        server.serve_forever()
+
+
+def rss_kib(pid):
+    """
+    Get the resident set size of a process, in KiB.
+    """
+    with open(f"/proc/{pid}/status", encoding='ascii') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    raise RuntimeError("VmRSS not found")
+
+
+def login(port):
+    """
+    Open a control connection and log in.
+
+    Returns:
+        socket.socket: The connected socket.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    conn = sock.makefile('rb')
+    conn.readline()
+    for cmd in (b'USER bench\r\n', b'PASS bench\r\n'):
+        sock.sendall(cmd)
+        reply = conn.readline()
+    if not reply.startswith(b'230'):
+        raise RuntimeError(f"Login failed: {reply!r}")
+    conn.close()
+    return sock
+
+
+def raise_fd_limit(needed):
+    """
+    Raise the soft limit of open files, as far as the hard limit allows.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+def measure(sessions, backend):
+    """
+    Measure the RSS growth of a server for a number of idle sessions.
+
+    Parameters:
+        sessions (int): Number of sessions to open.
+        backend (str): The server's filesystem backend.
+
+    Returns:
+        tuple: (RSS before, RSS after), in KiB.
+    """
+    raise_fd_limit(sessions + 256)
+    with tempfile.TemporaryDirectory(prefix='thinftp-bench-') as directory:
+        proc = subprocess.Popen([sys.executable, __file__, '--serve', directory, '--backend', backend],
+                                stdout=subprocess.PIPE, text=True,
+                                preexec_fn=lambda: raise_fd_limit(sessions + 256))
+        socks = []
+        try:
+            port = int(proc.stdout.readline())
+            # Warm up: the first sessions import and allocate shared state
+            socks.extend(login(port) for _ in range(10))
+            time.sleep(0.5)
+            before = rss_kib(proc.pid)
+            socks.extend(login(port) for _ in range(sessions))
+            time.sleep(0.5)
+            after = rss_kib(proc.pid)
+        finally:
+            proc.terminate()
+            proc.wait()
+            for sock in socks:
+                sock.close()
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory footprint of idle sessions")
+    parser.add_argument('--sessions', type=int, default=1000,
+                        help="Number of idle logged-in sessions to open (default: %(default)s)")
+    parser.add_argument('--backend', choices=('local', 'memory'), default='local',
+                        help="Filesystem backend of the server (default: %(default)s)")
+    parser.add_argument('--serve', metavar="DIR", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.serve:
+        serve(opts.serve, opts.backend)
+        return 0
+    before, after = measure(opts.sessions, opts.backend)
+    per_1k = (after - before) * 1000 / opts.sessions
+    print(f"sessions:           {opts.sessions}")
+    print(f"RSS before:         {before / 1024:10.1f} MiB")
+    print(f"RSS after:          {after / 1024:10.1f} MiB")
+    print(f"RSS per 1k sessions: {per_1k / 1024:9.1f} MiB ({per_1k / 1000:.1f} KiB per session)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
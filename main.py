@@ -7,7 +7,9 @@ import getpass
 import sys
 import traceback
 
+from thinftp.auth import hash_password
 from thinftp.logger import get_logger
+from thinftp.reload import inherited_password
 from thinftp.server import start_server
 from thinftp import __version__ as tftp_version
 
@@ -42,14 +44,117 @@ def main():
                         default=".",
                         help="Sets the root Directory (default: %(default)s)")
 
+    parser.add_argument('-B', '--backend',
+                        choices=('local', 'memory'),
+                        default='local',
+                        help="Filesystem backend to serve (default: %(default)s)")
+
+    parser.add_argument('--digest-store',
+                        metavar="xattr|FILE",
+                        help="Persist computed checksums to extended attributes or a JSON index file")
+
+    parser.add_argument('--upload-digests',
+                        metavar="ALGOS",
+                        default='',
+                        help="Comma-separated digests computed during uploads, such as SHA-256,MD5")
+
+    parser.add_argument('--sparse-uploads',
+                        action='store_true',
+                        help="Keep long runs of zeros in uploaded files as holes")
+
+    parser.add_argument('--cache-threshold',
+                        metavar="SIZE",
+                        default='64M',
+                        help="Stream transfers of files from this size past the page cache, 0 to never (default: %(default)s)")
+
+    parser.add_argument('--direct-uploads',
+                        metavar="SIZE",
+                        help="Write uploads beyond this size with O_DIRECT")
+
+    parser.add_argument('--transfers-per-device',
+                        type=int,
+                        metavar="N",
+                        default=0,
+                        help="Queue downloads of large files beyond N at once per disk, 0 for no limit (default: %(default)s)")
+
+    parser.add_argument('--certfile',
+                        metavar="PEM",
+                        help="Certificate chain enabling FTPS (AUTH TLS)")
+
+    parser.add_argument('--keyfile',
+                        metavar="PEM",
+                        help="Private key of the certificate, if not in the certfile")
+
+    parser.add_argument('--tls-required',
+                        action='store_true',
+                        help="Refuse logins and transfers that are not protected by TLS")
+
+    parser.add_argument('-U', '--users',
+                        metavar="FILE",
+                        help="Serve the users listed in a JSON users file instead of a single user")
+
+    parser.add_argument('--vhosts',
+                        metavar="FILE",
+                        help="Serve the virtual hosts listed in a JSON hosts file, selected with HOST")
+
+    parser.add_argument('--hash-password',
+                        action='store_true',
+                        help="Print a password hash for use in a users file and exit")
+
+    parser.add_argument('--drain-timeout',
+                        type=float,
+                        default=300.0,
+                        help="Seconds sessions may take to finish after a graceful restart on SIGUSR2 (default: %(default)s)")
+
+    parser.add_argument('--command-rate',
+                        type=float,
+                        default=50.0,
+                        help="Commands per second allowed per client IP, 0 for no limit (default: %(default)s)")
+
+    parser.add_argument('--command-burst',
+                        type=int,
+                        default=200,
+                        help="Commands a client IP may send at once (default: %(default)s)")
+
+    parser.add_argument('--quota',
+                        metavar="SIZE",
+                        help="Disk quota of the single user, such as 500M or 10G")
+
+    parser.add_argument('--diag-dir',
+                        metavar="DIR",
+                        help="Directory receiving profiles and memory snapshots (default: the temporary directory)")
+
+    parser.add_argument('--find-index',
+                        action='store_true',
+                        help="Index the file names of the served directory for SITE FIND")
+
+    parser.add_argument('--find-index-store',
+                        metavar="FILE",
+                        help="Persist the filename index to FILE, for fast restarts")
+
+    parser.add_argument('--record-trace',
+                        dest='trace_file',
+                        metavar="FILE",
+                        help="Record anonymized sessions to a trace file, for benchmarks/replay.py")
+
     parser.add_argument('-D', '--debug',
                         action='store_true',
                         help="Enable DEBUG logs")
 
     opts = parser.parse_args()
 
-    # Get the password from the user
-    opts.pswd = getpass.getpass(f"Set Password for {opts.user}: ")
+    if opts.hash_password:
+        print(hash_password(getpass.getpass("Password to hash: ")))
+        return
+
+    # Get the password from the user, unless a users file is given or a
+    # restarting server passed it on
+    if opts.users:
+        opts.pswd = None
+    else:
+        opts.pswd = inherited_password()
+        if opts.pswd is None:
+            opts.pswd = getpass.getpass(f"Set Password for {opts.user}: ")
 
     # Get the logger instance
     opts.lgr = get_logger(debug=opts.debug)
@@ -8,12 +8,14 @@ __email__ = "harishtpj@outlook.com"
 try:
     from .server import ThreadedThinFTP
     from .handler import ThinFTP
-    from .logger import setup_logger
+    from .logger import get_logger
+    from .embed import EmbeddedServer
     
     __all__ = [
         "ThreadedThinFTP",
         "ThinFTP", 
-        "setup_logger",
+        "get_logger",
+        "EmbeddedServer",
         "__version__"
     ]
 except ImportError:
@@ -0,0 +1,372 @@
+"""
+User authentication for thinFTP.
+
+This module implements the multi-user credential store used by the thinFTP
+server. Users are read from a JSON file holding salted password hashes, a
+home directory and an access flag for each user. The store is loaded once at
+startup and may be reloaded at runtime (the server does so upon `SIGHUP`).
+
+Since password hashing is deliberately expensive, successful verifications
+are memoized in a small bounded cache, and failed attempts are tracked per
+client IP so that a reconnect storm cannot turn `PASS` into a CPU hotspot:
+failures are answered with growing delays, and repeated ones lead to
+escalating temporary bans.
+
+The users file has the following layout::
+
+    {
+        "users": {
+            "alice": {
+                "password": "pbkdf2_sha256$600000$<salt>$<hash>",
+                "home": "alice",
+                "writable": true,
+                "admin": false,
+                "quota": "10G"
+            }
+        }
+    }
+
+Relative home directories are resolved against the served directory. Admin
+users may run the administrative `SITE` commands (such as `SITE DIAG`). The
+optional quota limits the disk usage of the home directory, in bytes or with
+a K, M, G or T suffix.
+
+Classes:
+    User: A single authenticated FTP account.
+    UserStore: File-backed collection of users with verification caching.
+    FailureLimiter: Per-IP limiter for failed login attempts.
+
+Functions:
+    hash_password: Produce an encoded, salted hash of a password.
+    check_password: Verify a password against an encoded hash.
+"""
+
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from .quota import parse_size
+
+PBKDF2_ITERATIONS = 600_000
+SCRYPT_PARAMS = (2**14, 8, 1)
+
+
+def hash_password(pswd, scheme='pbkdf2_sha256'):
+    """
+    Hash a password with a random salt.
+
+    Parameters:
+        pswd (str): The plaintext password.
+        scheme (str): Either 'pbkdf2_sha256' or 'scrypt'.
+
+    Returns:
+        str: The encoded hash, in the form `<scheme>$<params>$<salt>$<hash>`.
+
+    Raises:
+        ValueError: If the scheme is not supported.
+    """
+    salt = secrets.token_hex(16)
+    if scheme == 'pbkdf2_sha256':
+        dk = hashlib.pbkdf2_hmac('sha256', pswd.encode(), salt.encode(), PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt}${dk.hex()}"
+    if scheme == 'scrypt':
+        n, r, p = SCRYPT_PARAMS
+        dk = hashlib.scrypt(pswd.encode(), salt=salt.encode(), n=n, r=r, p=p)
+        return f"scrypt${n},{r},{p}${salt}${dk.hex()}"
+    raise ValueError(f"Unsupported password scheme: {scheme!r}")
+
+
+def check_password(pswd, encoded):
+    """
+    Check a password against an encoded hash from `hash_password`.
+
+    Parameters:
+        pswd (str): The plaintext password to check.
+        encoded (str): The encoded hash.
+
+    Returns:
+        bool: True if the password matches, otherwise False.
+    """
+    try:
+        scheme, params, salt, expected = encoded.split('$')
+        if scheme == 'pbkdf2_sha256':
+            dk = hashlib.pbkdf2_hmac('sha256', pswd.encode(), salt.encode(), int(params))
+        elif scheme == 'scrypt':
+            n, r, p = (int(x) for x in params.split(','))
+            dk = hashlib.scrypt(pswd.encode(), salt=salt.encode(), n=n, r=r, p=p)
+        else:
+            return False
+        # compare_digest only takes ASCII strings; bytes work for any hash
+        return hmac.compare_digest(dk.hex().encode(), expected.encode())
+    except ValueError:
+        return False
+
+
+class User:
+    """
+    An FTP user account.
+
+    Attributes:
+        name (str): The login name.
+        pswd_hash (str): Encoded password hash, or None if not applicable.
+        home (Path): The root directory served to the user.
+        writable (bool): Whether the user may modify the filesystem.
+        admin (bool): Whether the user may run administrative commands.
+        quota (int): Maximum disk usage of the home directory in bytes, or None.
+    """
+
+    def __init__(self, name, pswd_hash, home, writable=True, admin=False, quota=None):
+        """
+        Initialize the User.
+
+        Parameters:
+            name (str): The login name.
+            pswd_hash (str): Encoded password hash.
+            home (str): The root directory served to the user.
+            writable (bool): Whether the user has read-write access.
+            admin (bool): Whether the user may run administrative commands.
+            quota (int): Maximum disk usage of the home directory in bytes.
+        """
+        self.name = name
+        self.pswd_hash = pswd_hash
+        self.home = Path(home).resolve()
+        self.writable = writable
+        self.admin = admin
+        self.quota = quota
+
+    def __repr__(self):
+        mode = 'rw' if self.writable else 'ro'
+        if self.admin:
+            mode += ', admin'
+        return f"User({self.name!r}, home={str(self.home)!r}, {mode})"
+
+
+class UserStore:
+    """
+    File-backed user database.
+
+    Password checks run against salted hashes; successful checks are
+    remembered in a bounded LRU cache keyed by a keyed digest of the
+    password (the plaintext is never kept in memory), so repeated logins
+    by the same client cost a single HMAC.
+
+    Attributes:
+        path (Path): Location of the users file.
+        base_dir (Path): Directory against which relative homes are resolved.
+        cache_size (int): Maximum number of memoized verifications.
+    """
+
+    def __init__(self, path, base_dir, cache_size=256, entries=None):
+        """
+        Initialize the UserStore and load the users file.
+
+        Parameters:
+            path (str): Location of the users file, or None if `entries`
+                are given.
+            base_dir (str): Directory used to resolve relative home directories.
+            cache_size (int): Maximum number of memoized verifications.
+            entries (dict): Users, as in the "users" object of a users
+                file, to load instead of the file.
+
+        Raises:
+            OSError: If the users file cannot be read.
+            ValueError: If the users file is malformed.
+        """
+        self.path = Path(path) if path is not None else None
+        self.base_dir = Path(base_dir).resolve()
+        self.cache_size = cache_size
+        self._users = {}
+        self._cache = OrderedDict()
+        self._secret = secrets.token_bytes(32)
+        self._dummy = hash_password(secrets.token_hex(8))
+        self._lock = threading.Lock()
+        if entries is None:
+            self.reload()
+        else:
+            self.load(entries)
+
+    def reload(self):
+        """
+        (Re)load the users file, replacing the current users atomically.
+
+        Clears the verification cache, so that changed passwords take
+        effect immediately.
+
+        Raises:
+            OSError: If the users file cannot be read.
+            ValueError: If the users file is malformed.
+        """
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        self.load(data.get('users', {}))
+
+    def load(self, entries):
+        """
+        Replace the current users atomically, clearing the verification
+        cache.
+
+        Parameters:
+            entries (dict): User names mapped to their entries, as in the
+                "users" object of a users file.
+
+        Raises:
+            ValueError: If an entry is malformed.
+        """
+        users = {}
+        for name, entry in entries.items():
+            if 'password' not in entry:
+                raise ValueError(f"User {name!r} has no password")
+            home = self.base_dir / entry.get('home', '.')
+            users[name] = User(name, entry['password'], home, entry.get('writable', True),
+                               entry.get('admin', False), parse_size(entry.get('quota')))
+        with self._lock:
+            self._users = users
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(list(self._users.values()))
+
+    def get(self, name):
+        """
+        Look up a user by name.
+
+        Parameters:
+            name (str): The login name.
+
+        Returns:
+            User: The user, or None if there is no such user.
+        """
+        return self._users.get(name)
+
+    def verify(self, name, pswd):
+        """
+        Verify a user's password.
+
+        Parameters:
+            name (str): The login name.
+            pswd (str): The plaintext password.
+
+        Returns:
+            User: The authenticated user, or None if verification failed.
+        """
+        user = self._users.get(name)
+        key = (name, hmac.new(self._secret, pswd.encode(), 'sha256').digest())
+        with self._lock:
+            if user is not None and key in self._cache:
+                self._cache.move_to_end(key)
+                return user
+
+        if user is None:
+            # Spend the same effort as a real check to not reveal valid names
+            check_password(pswd, self._dummy)
+            return None
+        if not check_password(pswd, user.pswd_hash):
+            return None
+
+        with self._lock:
+            if self._users.get(name) is user:
+                self._cache[key] = True
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return user
+
+
+class FailureLimiter:
+    """
+    Limits failed login attempts per client IP.
+
+    Failures are counted within a sliding window, and each one is answered
+    more slowly than the last. Once the limit is reached the IP is banned,
+    for `ban_time` the first time and twice as long for each further ban,
+    up to `max_ban`. Bans are remembered for `max_ban` after they end. A
+    successful login clears nothing: failures only expire with the window,
+    so that an attacker holding one valid account cannot keep guessing below
+    the limit. The table is bounded: when full, the least recently used
+    entry is evicted.
+
+    Attributes:
+        max_failures (int): Failures allowed per window.
+        window (float): Length of the window in seconds.
+        max_entries (int): Maximum number of tracked IPs.
+        ban_time (float): Length of the first ban in seconds.
+        max_ban (float): Longest ban in seconds.
+        delay (float): Delay of the reply to a first failure in seconds,
+            doubled by each further failure within the window.
+    """
+
+    def __init__(self, max_failures=5, window=60.0, max_entries=4096,
+                 ban_time=None, max_ban=3600.0, delay=0.0):
+        """
+        Initialize the FailureLimiter.
+
+        Parameters:
+            max_failures (int): Failures allowed per window.
+            window (float): Length of the window in seconds.
+            max_entries (int): Maximum number of tracked IPs.
+            ban_time (float): Length of the first ban in seconds. Defaults
+                to `window`.
+            max_ban (float): Longest ban in seconds.
+            delay (float): Delay of the reply to a first failure in seconds.
+        """
+        self.max_failures = max_failures
+        self.window = window
+        self.max_entries = max_entries
+        self.ban_time = window if ban_time is None else ban_time
+        self.max_ban = max(max_ban, self.ban_time)
+        self.delay = delay
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def blocked(self, ip):
+        """
+        Check whether an IP is banned for failed attempts.
+
+        Parameters:
+            ip (str): The client IP.
+
+        Returns:
+            bool: True if further attempts should be refused.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is None:
+                return False
+            count, start, bans, banned_until = entry
+            if now < banned_until:
+                return True
+            if now - max(start + self.window, banned_until) > self.max_ban:
+                del self._entries[ip]
+            return False
+
+    def record_failure(self, ip):
+        """
+        Record a failed attempt for an IP, banning it after too many.
+
+        Parameters:
+            ip (str): The client IP.
+
+        Returns:
+            float: Seconds to wait before replying to the attempt.
+        """
+        now = time.monotonic()
+        with self._lock:
+            count, start, bans, banned_until = self._entries.pop(ip, (0, now, 0, 0.0))
+            if now - start > self.window:
+                count, start = 0, now
+            count += 1
+            delay = self.delay * 2 ** (count - 1)
+            if count >= self.max_failures:
+                banned_until = now + min(self.ban_time * 2 ** bans, self.max_ban)
+                count, start, bans = 0, now, bans + 1
+            self._entries[ip] = (count, start, bans, banned_until)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return delay
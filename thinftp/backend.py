@@ -0,0 +1,568 @@
+"""
+Filesystem backend interface for thinFTP.
+
+This module defines `FileBackend`, the interface through which the `ThinFTP`
+handler talks to the filesystem it serves. Each session owns one backend
+instance, which tracks the session's working directory and pending rename.
+
+A backend only has to implement the primitive operations (navigation,
+listing, stat, open, mkdir, rmdir, rename and delete). Listing in `ls`
+format and chunked reading/writing are provided on top of those primitives,
+and may be overridden where the backend can do better.
+
+Classes:
+    FileBackend: Abstract base class for filesystem backends.
+
+Functions:
+    format_entry: Format a stat result as an `ls -l` style line.
+    format_time: Format a timestamp as used by MDTM (RFC 3659).
+    unique_names: Candidate names for a unique file (STOU).
+"""
+
+import os
+import posixpath
+import stat
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from .digest import digesting, new_hashes, verify
+from .errors import FileHandlerError
+
+CHUNK_SIZE = 8192
+
+
+def unique_names(fname=None):
+    """
+    Generate candidate names for a file that must not replace another one.
+
+    The requested name comes first, then a few numbered variants of it, then
+    random ones, so that many clients asking for the same name do not probe
+    an ever longer sequence.
+
+    Parameters:
+        fname (str): The name requested by the client, or None.
+
+    Yields:
+        str: Candidate names.
+    """
+    base = fname or 'upload'
+    if fname:
+        yield fname
+    for i in range(1, 10):
+        yield f"{base}.{i}"
+    while True:
+        yield f"{base}.{os.urandom(4).hex()}"
+
+
+def format_entry(name, stats):
+    """
+    Format a directory entry as a line of an `ls -l` style listing.
+
+    Parameters:
+        name (str): The entry name.
+        stats (os.stat_result): The entry's stat result.
+
+    Returns:
+        str: `<permissions> <nlinks> <owner> <group> <size> <modtime> <name>`
+    """
+    perms = stat.filemode(stats.st_mode)
+    mtime = time.strftime("%b %d %H:%M", time.localtime(stats.st_mtime))
+    return f"{perms} 1 user group {stats.st_size:>8} {mtime} {name}"
+
+
+def format_time(ts):
+    """
+    Format a timestamp as a `time-val` of RFC 3659 (used by MDTM).
+
+    Parameters:
+        ts (float): Seconds since the epoch.
+
+    Returns:
+        str: The UTC time as `YYYYMMDDHHMMSS`.
+    """
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime(ts))
+
+
+class FileBackend(ABC):
+    """
+    Abstract filesystem backend.
+
+    Paths given to a backend are FTP paths: absolute ones are relative to the
+    backend's root, others are relative to the current working directory.
+    Backends must confine every operation to their root, raising
+    `PermissionError` on attempts to escape it.
+
+    Entries returned by `name_ls` must have a `name` attribute and `stat()`
+    and `is_dir()` methods, like `pathlib.Path` objects do.
+
+    Backends report their modifying operations (mkdir, write, delete, rmdir,
+    rename and copy) through `fs_op`, which feeds the `on_fs_op` hooks.
+
+    Attributes:
+        ren_old: The entry marked by `rename_from`, or None.
+        cp_old: The entry marked by `copy_from`, or None.
+        hooks (Hooks): The instrumentation hooks, set by the server, or None.
+        quota (int): Maximum usage of the root directory in bytes, or None.
+        usage (UsageIndex): Current usage of the root directory, set along
+            with `quota`.
+        sparse (bool): Leave long runs of zeros in uploaded files as holes,
+            where the backend supports it.
+        cache (CachePolicy): How large transfers use the page cache, where
+            the backend has one, or None.
+    """
+
+    ren_old = None
+    cp_old = None
+    hooks = None
+    quota = None
+    usage = None
+    sparse = False
+    cache = None
+
+    def fs_op(self, op, path, **info):
+        """
+        Report a completed modifying operation to the `on_fs_op` hooks.
+
+        Parameters:
+            op (str): The operation, e.g. 'write' or 'rename'.
+            path: The backend's resolved path of the operation.
+            **info: Details of the operation, e.g. `size` or `dest`.
+        """
+        if self.hooks is not None and self.hooks.on_fs_op:
+            self.hooks.fire('on_fs_op', self, op, path, **info)
+
+
+    @abstractmethod
+    def pwd(self):
+        """
+        Get the current working directory relative to the root directory.
+
+        Returns:
+            str: The current directory as a string.
+        """
+
+    @abstractmethod
+    def get_abs(self, path):
+        """
+        Get the absolute path of a given path relative to the root directory.
+
+        Parameters:
+            path (str): The path to resolve.
+
+        Returns:
+            str: The absolute path as a string.
+        """
+
+    @abstractmethod
+    def cwd(self, path):
+        """
+        Change the current working directory.
+
+        Parameters:
+            path (str): The directory to change to.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
+            PermissionError: If attempting to move outside the root directory.
+        """
+
+    @abstractmethod
+    def cd_up(self):
+        """
+        Change to the parent directory.
+
+        Raises:
+            FileNotFoundError: If the parent directory does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+
+    @abstractmethod
+    def mkdir(self, path):
+        """
+        Create a new directory, including missing parents.
+
+        Parameters:
+            path (str): Path of directory to create.
+
+        Raises:
+            FileExistsError: If the directory already exists.
+        """
+
+    @abstractmethod
+    def name_ls(self, path, limit=None):
+        """
+        List the entries in a directory, the file itself, or the entries
+        matching a wildcard (see `thinftp.wildcard`) in the last component of
+        the path.
+
+        Parameters:
+            path (str): The directory, file or wildcard to list.
+            limit (int): Maximum number of entries to return, or None.
+
+        Returns:
+            list: Entries with a `name` attribute and `stat()`/`is_dir()` methods.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+        """
+
+    @abstractmethod
+    def stat(self, path):
+        """
+        Get the status of a file or directory.
+
+        Parameters:
+            path (str): The path to query.
+
+        Returns:
+            os.stat_result: The status of the path.
+
+        Raises:
+            FileNotFoundError: If the path does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+
+    @abstractmethod
+    def open(self, fname, mode='rb'):
+        """
+        Open a file for binary reading or writing.
+
+        Parameters:
+            fname (str): The file to open.
+            mode (str): One of 'rb', 'wb' or 'ab'.
+
+        Returns:
+            A binary file object, to be used as a context manager.
+
+        Raises:
+            FileNotFoundError: If reading a file that does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+
+    @abstractmethod
+    def size(self, fname):
+        """
+        Get the size of a file.
+
+        Parameters:
+            fname (str): The file to check.
+
+        Returns:
+            int: The size of the file in bytes.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+            FileHandlerError: If the path is not a file.
+        """
+
+    @abstractmethod
+    def delete(self, fname):
+        """
+        Delete a file.
+
+        Parameters:
+            fname (str): The file to delete.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+            FileHandlerError: If the path is not a file.
+        """
+
+    @abstractmethod
+    def rmdir(self, path):
+        """
+        Remove an empty directory.
+
+        Parameters:
+            path (str): The directory to remove.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
+            PermissionError: If attempting to move outside the root directory.
+        """
+
+    @abstractmethod
+    def rename_from(self, old):
+        """
+        Mark a file or directory for renaming.
+
+        Parameters:
+            old (str): Existing file/directory name.
+
+        Raises:
+            FileNotFoundError: If the original path does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+
+    @abstractmethod
+    def rename_to(self, new):
+        """
+        Rename a previously marked file or directory.
+
+        Parameters:
+            new (str): New file/directory name.
+        """
+
+    def copy_from(self, old):
+        """
+        Mark a file or directory for copying.
+
+        Backends supporting server-side copies override this and `copy_to`.
+
+        Parameters:
+            old (str): Existing file/directory name.
+
+        Raises:
+            FileNotFoundError: If the original path does not exist.
+            PermissionError: If attempting to move outside the root directory.
+            FileHandlerError: If the backend cannot copy files.
+        """
+        raise FileHandlerError('Copying is not supported by this backend')
+
+    def copy_to(self, new):
+        """
+        Prepare the copy of a previously marked file or directory.
+
+        Paths are resolved and checked immediately, while the copy itself is
+        returned as a callable, so that it can run in the background.
+
+        Parameters:
+            new (str): Destination name. Copying into an existing directory
+                places the copy inside it.
+
+        Returns:
+            callable: Performs the copy when called, from any thread.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+            FileHandlerError: If the backend cannot copy files.
+        """
+        raise FileHandlerError('Copying is not supported by this backend')
+
+    def remove_tree(self, path):
+        """
+        Prepare the removal of a directory and everything in it.
+
+        Backends supporting tree removals override this. The path is
+        resolved and checked immediately, while the removal itself is
+        performed by running the returned operation.
+
+        Parameters:
+            path (str): The directory to remove.
+
+        Returns:
+            TreeOperation: The removal.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
+            PermissionError: If attempting to move outside the root
+                directory, or to remove it.
+            FileHandlerError: If the backend cannot remove trees.
+        """
+        raise FileHandlerError('Removing trees is not supported by this backend')
+
+    def chmod(self, path, mode, recursive=False):
+        """
+        Change the permission bits of a file or directory.
+
+        Backends supporting permissions override this.
+
+        Parameters:
+            path (str): The file or directory.
+            mode (int): The new permission bits.
+            recursive (bool): Also change everything in a directory.
+
+        Returns:
+            TreeOperation: The change of a directory tree, to run, if
+            `recursive` is set and the path is a directory; otherwise the
+            change is done and None is returned.
+
+        Raises:
+            FileNotFoundError: If the path does not exist.
+            PermissionError: If attempting to move outside the root directory.
+            FileHandlerError: If the backend has no permissions.
+        """
+        raise FileHandlerError('Permissions are not supported by this backend')
+
+    def local_path(self, fname):
+        """
+        Get the location of a file on the local disk, if it has one.
+
+        Features that need a real file (extended attributes, in-kernel
+        copies and the like) use this, and fall back to `open` otherwise.
+
+        Parameters:
+            fname (str): The file to locate.
+
+        Returns:
+            Path: The confined local path, or None if the backend is not
+            backed by the local disk.
+        """
+        return None
+
+    def ls(self, path, limit=None):
+        """
+        List the contents of the specified directory.
+
+        Parameters:
+            path (str): The directory, file or wildcard to list.
+            limit (int): Maximum number of entries to list, or None.
+
+        Returns:
+            list: A list of strings representing the contents of the directory, in
+            the format:
+
+            `<permissions> <nlinks> <owner> <group> <size> <modtime> <name>`
+
+            If the directory does not exist, an empty list is returned.
+        """
+        matches = self.name_ls(path, limit)
+        return [format_entry(entry.name, entry.stat())
+                for entry in sorted(matches, key=lambda e: e.name)]
+
+    def ls_recursive(self, path, max_depth=32, max_entries=100_000):
+        """
+        Recursively list a directory tree, breadth first.
+
+        Parameters:
+            path (str): The directory to list.
+            max_depth (int): How many levels below `path` to descend.
+            max_entries (int): Maximum number of entries to produce.
+
+        Yields:
+            tuple: (rel_dir, lines) for each directory, where rel_dir is the
+            path relative to `path` ('.' for itself) and lines are in `ls`
+            format.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
+            PermissionError: If attempting to move outside the root directory.
+        """
+        if not stat.S_ISDIR(self.stat(path).st_mode):
+            raise NotADirectoryError
+        queue = deque([('.', 0)])
+        count = 0
+        while queue:
+            rel, depth = queue.popleft()
+            target = path if rel == '.' else posixpath.join(path, rel)
+            entries = sorted(self.name_ls(target), key=lambda e: e.name)
+            entries = entries[:max_entries - count]
+            count += len(entries)
+            yield rel, [format_entry(e.name, e.stat()) for e in entries]
+            if count >= max_entries:
+                return
+            if depth < max_depth:
+                queue.extend((e.name if rel == '.' else posixpath.join(rel, e.name), depth + 1)
+                             for e in entries if e.is_dir())
+
+    def read(self, fname, type, chunk_size=CHUNK_SIZE):
+        """
+        Read a file in chunks.
+
+        Parameters:
+            fname (str): The file to read.
+            type (str): The transfer type ('A' for ASCII, 'I' for binary).
+            chunk_size (int): Size of the chunks to read.
+
+        Yields:
+            bytes: Chunks of the file content.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+        with self.open(fname, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                if type == 'A':
+                    yield chunk.replace(b'\n', b'\r\n')
+                else:
+                    yield chunk
+
+    def write(self, fname, data, digests=None, expected=None):
+        """
+        Write data to a file, digesting it on the way.
+
+        This implementation cannot replace a file atomically, so when an
+        expected digest is given, the data is buffered and verified before
+        the file is opened.
+
+        Parameters:
+            fname (str): The file to write to.
+            data (iterable): An iterable of bytes to write.
+            digests (dict): Algorithms (keys of `digest.ALGORITHMS`) mapped
+                to None; each is set to the hex digest of the data written.
+            expected (tuple): (algorithm, hex digest) the data must match,
+                or None.
+
+        Returns:
+            int: The number of bytes written.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+            DigestMismatch: If the data does not match `expected`. The file
+                is left untouched.
+        """
+        hashes = new_hashes(digests, expected)
+        data = digesting(data, hashes)
+        if expected is not None:
+            data = list(data)
+            verify(hashes, expected)
+        size = 0
+        with self.open(fname, 'wb') as f:
+            for chunk in data:
+                f.write(chunk)
+                size += len(chunk)
+        if digests is not None:
+            digests.update((algo, h.hexdigest()) for algo, h in hashes.items() if algo in digests)
+        return size
+
+    def append(self, fname, data):
+        """
+        Append data to a file, creating it if it does not exist.
+
+        Parameters:
+            fname (str): The file to append to.
+            data (iterable): An iterable of bytes to append.
+
+        Returns:
+            int: The number of bytes appended.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+        """
+        size = 0
+        with self.open(fname, 'ab') as f:
+            for chunk in data:
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def create_unique(self, fname=None):
+        """
+        Create an empty file under a name that no other file has (STOU).
+
+        This implementation checks and creates in two steps; backends that
+        can create a file exclusively should override it.
+
+        Parameters:
+            fname (str): The name requested by the client, or None.
+
+        Returns:
+            str: The name of the created file.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+        """
+        for name in unique_names(fname):
+            try:
+                self.stat(name)
+            except FileNotFoundError:
+                self.open(name, 'wb').close()
+                return name
@@ -0,0 +1,127 @@
+"""
+In-kernel file copies for thinFTP.
+
+This module implements the local-disk side of `SITE CPFR`/`SITE CPTO`.
+Copies never pass through user space when the kernel can avoid it: a
+reflink (`FICLONE`) is attempted first, which shares the blocks on
+copy-on-write filesystems such as Btrfs and XFS, then `os.copy_file_range`,
+and only then a plain buffered copy.
+
+Trees are copied without following symbolic links: links are recreated as
+links, so a copy can never read outside the served root.
+
+Functions:
+    copy_file: Copy a single file.
+    copy_tree: Recursively copy a directory.
+"""
+
+import errno
+import os
+import shutil
+import stat
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+#: The FICLONE ioctl request number (linux/fs.h).
+FICLONE = 0x40049409
+
+# Errors meaning "this way of copying is not supported here"
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+
+def _reflink(src_fd, dst_fd):
+    """
+    Try to clone a file's blocks with the FICLONE ioctl.
+
+    Returns:
+        bool: True if the file was cloned.
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+
+
+def _copy_range(src_fd, dst_fd):
+    """
+    Copy a whole file with `os.copy_file_range`.
+
+    Returns:
+        bool: True if the file was copied, False if the syscall is not
+        supported for these files (nothing has been written in that case).
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, 1 << 30)
+        except OSError as e:
+            if copied == 0 and e.errno in _UNSUPPORTED:
+                return False
+            raise
+        if n == 0:
+            return True
+        copied += n
+
+
+def copy_file(src, dst):
+    """
+    Copy a single file, preserving its permission bits.
+
+    Parameters:
+        src (str): The file to copy.
+        dst (str): The destination path. Replaced if it exists.
+
+    Returns:
+        str: The method used: 'reflink', 'copy_file_range' or 'buffered'.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if _reflink(fsrc.fileno(), fdst.fileno()):
+            method = 'reflink'
+        elif _copy_range(fsrc.fileno(), fdst.fileno()):
+            method = 'copy_file_range'
+        else:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+            method = 'buffered'
+    shutil.copymode(src, dst)
+    return method
+
+
+def copy_tree(src, dst):
+    """
+    Recursively copy a directory without following symbolic links.
+
+    Parameters:
+        src (str): The directory to copy.
+        dst (str): The destination directory. Must not exist.
+
+    Returns:
+        int: The number of files copied.
+
+    Raises:
+        FileExistsError: If the destination exists.
+    """
+    os.mkdir(dst)
+    shutil.copymode(src, dst)
+    count = 0
+    with os.scandir(src) as it:
+        for entry in it:
+            target = os.path.join(dst, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target)
+            elif entry.is_dir():
+                count += copy_tree(entry.path, target)
+            elif stat.S_ISREG(entry.stat(follow_symlinks=False).st_mode):
+                copy_file(entry.path, target)
+                count += 1
+    return count
@@ -0,0 +1,341 @@
+"""
+On-demand diagnostics for a running thinFTP server.
+
+Three tools can be switched on and off at runtime, without restarting the
+server, from the `SITE DIAG` command of an admin user (and, for the
+profiler, with `SIGUSR1`):
+
+- A sampling profiler, which records the stacks of all threads at a fixed
+  interval and dumps them in the "collapsed stacks" format read by
+  flamegraph.pl and speedscope. Sampling from a separate thread keeps the
+  overhead on the sessions low and covers every thread, unlike `cProfile`,
+  which only sees the thread it was enabled in.
+- `tracemalloc` memory snapshots, dumped in the format loaded by
+  `tracemalloc.Snapshot.load` so that two of them can be compared.
+- Per-session tracing, which logs the commands, transfers and filesystem
+  operations of the sessions of one user or client IP. It is built on
+  `Hooks`, so it costs nothing while switched off.
+
+Dumps are written to the configured diagnostics directory.
+
+Classes:
+    StackSampler: Sampling profiler for all threads.
+    SessionTracer: Hook object logging the activity of selected sessions.
+    Diagnostics: Controls the diagnostics tools of a server.
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class StackSampler:
+    """
+    Sampling profiler recording the stacks of all threads.
+
+    Attributes:
+        interval (float): Seconds between samples.
+        samples (int): Number of samples taken.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        Initialize the StackSampler.
+
+        Parameters:
+            interval (float): Seconds between samples.
+        """
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start sampling in a background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='thinftp-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                # Group the threads of a pool or of the sessions together
+                stack.append(re.sub(r'\d+', 'N', names.get(ident, 'thread')))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, path):
+        """
+        Write the recorded stacks in collapsed format, one
+        `frame;frame;... count` line per distinct stack.
+
+        Parameters:
+            path (str): The file to write.
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class SessionTracer:
+    """
+    Hook object logging the activity of the sessions of one user or client IP.
+
+    One line is logged per command, with its reply, duration and the data
+    moved, plus one per filesystem operation.
+
+    Attributes:
+        target (str): The user name or client IP to trace.
+        lgr (logging.Logger): Logger receiving the trace.
+    """
+
+    def __init__(self, target, lgr):
+        """
+        Initialize the SessionTracer.
+
+        Parameters:
+            target (str): The user name or client IP to trace.
+            lgr (logging.Logger): Logger receiving the trace.
+        """
+        self.target = target
+        self.lgr = lgr
+        # Traced sessions mapped to [bytes, chunks] of the current command
+        self._traced = {}
+
+    def _matches(self, session):
+        if session in self._traced:
+            return True
+        user = session.user.name if session.user is not None else session.login_user
+        if self.target in (session.client_address[0], user):
+            self._traced[session] = [0, 0]
+            return True
+        return False
+
+    def on_disconnect(self, session):
+        if self._traced.pop(session, None) is not None:
+            self.lgr.info(f"[trace {session.client_addr()}] disconnected")
+
+    def on_command_start(self, session, verb, args):
+        if self._matches(session):
+            self._traced[session] = [0, 0]
+
+    def on_command_end(self, session, verb, args, reply, elapsed):
+        if not self._matches(session):
+            return
+        size, chunks = self._traced[session]
+        if verb == 'PASS':
+            args = '****'
+        moved = f", {size} bytes in {chunks} chunks" if chunks else ""
+        reply = (reply or '').split('\r\n')[0]
+        self.lgr.info(f"[trace {session.client_addr()}] {verb} {args} -> {reply!r} "
+                      f"in {elapsed * 1000:.1f} ms{moved}")
+
+    def on_transfer_chunk(self, session, direction, size):
+        counters = self._traced.get(session)
+        if counters is not None:
+            counters[0] += size
+            counters[1] += 1
+
+    def on_fs_op(self, backend, op, path, **info):
+        for session in list(self._traced):
+            if session.fileman is backend:
+                details = ''.join(f" {k}={v}" for k, v in info.items())
+                self.lgr.info(f"[trace {session.client_addr()}] fs {op} {path}{details}")
+                return
+
+
+class Diagnostics:
+    """
+    Controls the diagnostics tools of a server.
+
+    Attributes:
+        hooks (Hooks): The server's hook registry.
+        out_dir (str): Directory receiving the dumps.
+        lgr (logging.Logger): The server logger.
+        interval (float): Sampling interval of the profiler, in seconds.
+        sampler (StackSampler): The running profiler, or None.
+        tracer (SessionTracer): The active session tracer, or None.
+    """
+
+    def __init__(self, hooks, out_dir, lgr, interval=0.005):
+        """
+        Initialize the Diagnostics.
+
+        Parameters:
+            hooks (Hooks): The server's hook registry.
+            out_dir (str): Directory receiving the dumps.
+            lgr (logging.Logger): The server logger.
+            interval (float): Sampling interval of the profiler, in seconds.
+        """
+        self.hooks = hooks
+        self.out_dir = out_dir
+        self.lgr = lgr
+        self.interval = interval
+        self.sampler = None
+        self.tracer = None
+        self._lock = threading.Lock()
+
+    def _dump_path(self, kind, ext):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.out_dir, f"thinftp-{kind}-{os.getpid()}-{stamp}.{ext}")
+
+    def start_profiler(self):
+        """
+        Start the sampling profiler.
+
+        Returns:
+            bool: False if it was already running.
+        """
+        with self._lock:
+            if self.sampler is not None:
+                return False
+            self.sampler = StackSampler(self.interval)
+            self.sampler.start()
+        self.lgr.info("Sampling profiler started")
+        return True
+
+    def stop_profiler(self):
+        """
+        Stop the sampling profiler and dump its stacks.
+
+        Returns:
+            str: The dump file, or None if the profiler was not running.
+
+        Raises:
+            OSError: If the dump cannot be written.
+        """
+        with self._lock:
+            sampler, self.sampler = self.sampler, None
+        if sampler is None:
+            return None
+        sampler.stop()
+        path = self._dump_path('profile', 'folded')
+        sampler.dump(path)
+        self.lgr.info(f"Sampling profiler stopped after {sampler.samples} samples, dumped to {path}")
+        return path
+
+    def toggle_profiler(self, *_):
+        """
+        Start the profiler, or stop and dump it if it is running.
+        Installed as the `SIGUSR1` handler.
+        """
+        if self.sampler is None:
+            self.start_profiler()
+            return
+        try:
+            self.stop_profiler()
+        except OSError as e:
+            self.lgr.error(f"Failed to dump profile: {e}")
+
+    def start_memory(self, frames=10):
+        """
+        Start tracing memory allocations.
+
+        Parameters:
+            frames (int): Number of frames kept per allocation traceback.
+
+        Returns:
+            bool: False if tracing was already on.
+        """
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(frames)
+        self.lgr.info("Memory tracing started")
+        return True
+
+    def snapshot_memory(self):
+        """
+        Dump a snapshot of the traced allocations.
+
+        Returns:
+            str: The dump file, or None if memory tracing is off.
+
+        Raises:
+            OSError: If the dump cannot be written.
+        """
+        if not tracemalloc.is_tracing():
+            return None
+        path = self._dump_path('memory', 'tracemalloc')
+        tracemalloc.take_snapshot().dump(path)
+        self.lgr.info(f"Memory snapshot dumped to {path}")
+        return path
+
+    def stop_memory(self):
+        """
+        Stop tracing memory allocations.
+
+        Returns:
+            bool: False if tracing was off.
+        """
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        self.lgr.info("Memory tracing stopped")
+        return True
+
+    def trace(self, target):
+        """
+        Trace the sessions of a user or client IP, replacing any
+        previous trace.
+
+        Parameters:
+            target (str): The user name or client IP.
+        """
+        self.untrace()
+        self.tracer = SessionTracer(target, self.lgr)
+        self.hooks.add(self.tracer)
+        self.lgr.info(f"Tracing sessions of {target}")
+
+    def untrace(self):
+        """
+        Stop tracing sessions.
+
+        Returns:
+            bool: False if no sessions were traced.
+        """
+        tracer, self.tracer = self.tracer, None
+        if tracer is None:
+            return False
+        self.hooks.remove(tracer)
+        self.lgr.info(f"Stopped tracing sessions of {tracer.target}")
+        return True
+
+    def status(self):
+        """
+        Describe the state of the diagnostics tools.
+
+        Returns:
+            list: Lines of text.
+        """
+        sampler = self.sampler
+        lines = [f"Profiler: {'on, %d samples' % sampler.samples if sampler else 'off'}"]
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"Memory tracing: on, {current} bytes traced, peak {peak}")
+        else:
+            lines.append("Memory tracing: off")
+        lines.append(f"Session tracing: {self.tracer.target if self.tracer else 'off'}")
+        lines.append(f"Dump directory: {self.out_dir}")
+        return lines
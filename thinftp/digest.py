@@ -0,0 +1,323 @@
+"""
+Server-side file checksums for thinFTP.
+
+This module computes the digests reported by the `HASH`, `XCRC`, `XMD5`,
+`XSHA1` and `XSHA256` commands. Hashing runs on a shared thread pool;
+`hashlib` and `zlib` release the GIL while digesting large buffers, so
+several files are hashed truly in parallel while the control loops of other
+sessions keep running.
+
+Digests are cached by (device, inode, size, mtime_ns, algorithm, range), so
+that repeated queries on an unchanged file cost nothing. The cache lives in
+memory and can optionally be persisted, either to a `user.thinftp.*`
+extended attribute on each file, or to a JSON sidecar index.
+
+Classes:
+    DigestCache: Computes and caches file digests.
+
+Functions:
+    new_hash: Create a hash object by FTP algorithm name.
+    new_hashes: Create the hash objects of an upload.
+    digesting: Feed the chunks of an upload to hash objects.
+    verify: Check an upload against the digest announced by the client.
+    hash_stream: Digest (part of) a binary file object.
+"""
+
+import hashlib
+import json
+import os
+import stat
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .errors import DigestMismatch, FileHandlerError
+
+#: FTP algorithm names (as used by the HASH command) mapped to hashlib names.
+ALGORITHMS = {
+    'SHA-1': 'sha1',
+    'SHA-256': 'sha256',
+    'SHA-512': 'sha512',
+    'MD5': 'md5',
+    'CRC32': 'crc32',
+}
+
+CHUNK_SIZE = 1024 * 1024
+XATTR_PREFIX = 'user.thinftp.'
+
+
+class _CRC32:
+    """
+    A `hashlib`-like wrapper around `zlib.crc32`.
+    """
+
+    digest_size = 4
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+
+def new_hash(algo):
+    """
+    Create a hash object by FTP algorithm name.
+
+    Parameters:
+        algo (str): One of the keys of `ALGORITHMS`.
+
+    Returns:
+        An object with `update()` and `hexdigest()` methods, and a
+        `digest_size` attribute.
+    """
+    name = ALGORITHMS[algo]
+    return _CRC32() if name == 'crc32' else hashlib.new(name)
+
+
+def new_hashes(digests=None, expected=None):
+    """
+    Create the hash objects needed while writing an upload.
+
+    Parameters:
+        digests (dict): Algorithms to compute, as keys.
+        expected (tuple): (algorithm, hex digest) announced by the client,
+            or None.
+
+    Returns:
+        dict: Algorithm names mapped to hash objects.
+    """
+    algos = list(digests or ())
+    if expected is not None and expected[0] not in algos:
+        algos.append(expected[0])
+    return {algo: new_hash(algo) for algo in algos}
+
+
+def digesting(chunks, hashes):
+    """
+    Feed chunks to hash objects as they are consumed.
+
+    Parameters:
+        chunks (iterable): An iterable of bytes.
+        hashes (dict): Hash objects from `new_hashes`.
+
+    Yields:
+        bytes: The chunks, unchanged.
+    """
+    if not hashes:
+        yield from chunks
+        return
+    updates = [h.update for h in hashes.values()]
+    for chunk in chunks:
+        for update in updates:
+            update(chunk)
+        yield chunk
+
+
+def verify(hashes, expected):
+    """
+    Check the digest of an upload against the one announced by the client.
+
+    Parameters:
+        hashes (dict): Hash objects from `new_hashes`, fed with the upload.
+        expected (tuple): (algorithm, hex digest), or None to accept anything.
+
+    Raises:
+        DigestMismatch: If the digests differ.
+    """
+    if expected is None:
+        return
+    algo, value = expected
+    actual = hashes[algo].hexdigest()
+    if actual != value.lower():
+        raise DigestMismatch(f"{algo} mismatch: expected {value.lower()}, got {actual}")
+
+
+def hash_stream(f, algo, start=0, end=None):
+    """
+    Digest (part of) a binary file object.
+
+    Parameters:
+        f (file): A binary file object opened for reading.
+        algo (str): One of the keys of `ALGORITHMS`.
+        start (int): Offset of the first byte to digest.
+        end (int): Offset after the last byte to digest, or None for EOF.
+
+    Returns:
+        str: The hex digest.
+    """
+    h = new_hash(algo)
+    f.seek(start)
+    remaining = None if end is None else max(end - start, 0)
+    while remaining != 0:
+        chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        h.update(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    return h.hexdigest()
+
+
+class DigestCache:
+    """
+    Computes file digests on a thread pool and caches them.
+
+    Attributes:
+        store (str): Persistence mode: None, 'xattr', or the path of a
+            JSON sidecar index.
+        max_entries (int): Maximum number of digests kept in memory.
+    """
+
+    def __init__(self, workers=4, max_entries=10_000, store=None):
+        """
+        Initialize the DigestCache.
+
+        Parameters:
+            workers (int): Number of hashing threads.
+            max_entries (int): Maximum number of digests kept in memory.
+            store (str): None, 'xattr', or the path of a JSON sidecar index.
+        """
+        self.store = store
+        self.max_entries = max_entries
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thinftp-hash')
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = 0
+        if store and store != 'xattr' and os.path.exists(store):
+            with open(store, encoding='utf-8') as f:
+                for key, value in json.load(f).items():
+                    self._cache[tuple(key.split(':'))] = value
+
+    @staticmethod
+    def make_key(stats, algo, start, end):
+        """
+        Build the cache key identifying a version of a file's content.
+
+        Parameters:
+            stats (os.stat_result): The file's status.
+            algo (str): The algorithm name.
+            start (int): Range start.
+            end (int): Range end, or None for EOF.
+
+        Returns:
+            tuple: The key, as a tuple of strings.
+        """
+        mtime = stats.st_mtime_ns if stats.st_mtime_ns is not None else stats.st_mtime
+        return tuple(str(x) for x in (stats.st_dev, stats.st_ino, stats.st_size,
+                                      mtime, algo, start, end))
+
+    def digest(self, fileman, fname, algo, start=0, end=None):
+        """
+        Get the digest of a file, computing it if it is not cached.
+
+        Parameters:
+            fileman (FileBackend): The backend holding the file.
+            fname (str): The file to digest.
+            algo (str): One of the keys of `ALGORITHMS`.
+            start (int): Offset of the first byte to digest.
+            end (int): Offset after the last byte to digest, or None for EOF.
+
+        Returns:
+            str: The hex digest.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+            PermissionError: If attempting to move outside the root directory.
+            FileHandlerError: If the path is not a file.
+        """
+        stats = fileman.stat(fname)
+        if not stat.S_ISREG(stats.st_mode):
+            raise FileHandlerError(f'Not a file: {fname!r}')
+        if end is not None and end >= stats.st_size:
+            end = None
+        key = self.make_key(stats, algo, start, end)
+        path = fileman.local_path(fname)
+
+        value = self.lookup(key, path)
+        if value is None:
+            value = self._pool.submit(self._compute, fileman, fname, algo, start, end).result()
+            self.remember(key, value, path)
+        return value
+
+    @staticmethod
+    def _compute(fileman, fname, algo, start, end):
+        with fileman.open(fname, 'rb') as f:
+            return hash_stream(f, algo, start, end)
+
+    def lookup(self, key, path=None):
+        """
+        Look up a cached digest.
+
+        Parameters:
+            key (tuple): Key from `make_key`.
+            path (Path): The local path of the file, if any.
+
+        Returns:
+            str: The hex digest, or None if it is not cached.
+        """
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+                return value
+        if self.store == 'xattr' and path is not None:
+            try:
+                attr = os.getxattr(path, XATTR_PREFIX + key[4]).decode()
+            except (OSError, AttributeError):
+                return None
+            stored_key, _, value = attr.rpartition(':')
+            if stored_key == ':'.join(key[2:4] + key[5:]):
+                with self._lock:
+                    self._cache[key] = value
+                return value
+        return None
+
+    def remember(self, key, value, path=None):
+        """
+        Cache a digest, persisting it if configured to.
+
+        Parameters:
+            key (tuple): Key from `make_key`.
+            value (str): The hex digest.
+            path (Path): The local path of the file, if any.
+        """
+        with self._lock:
+            self._cache[key] = value
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            self._dirty += 1
+            flush = self.store not in (None, 'xattr') and self._dirty >= 64
+        if self.store == 'xattr' and path is not None:
+            try:
+                # Size, mtime and range identify the content the digest applies to
+                attr = ':'.join(key[2:4] + key[5:] + (value,))
+                os.setxattr(path, XATTR_PREFIX + key[4], attr.encode())
+            except (OSError, AttributeError):
+                pass
+        if flush:
+            self.save()
+
+    def save(self):
+        """
+        Write the sidecar index, if one is configured.
+        """
+        if self.store in (None, 'xattr'):
+            return
+        with self._lock:
+            data = {':'.join(key): value for key, value in self._cache.items()}
+            self._dirty = 0
+        tmp = f"{self.store}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.store)
+
+    def close(self):
+        """
+        Save the sidecar index and stop the hashing threads.
+        """
+        self._pool.shutdown(wait=False)
+        self.save()
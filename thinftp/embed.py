@@ -0,0 +1,164 @@
+"""
+Embedded thinFTP servers, running in the current process.
+
+`start_server` serves until interrupted, and the command line prompts for a
+password, which makes both awkward for tests. An `EmbeddedServer` runs a
+server in a background thread of the calling process instead, configured by
+keyword arguments, on an ephemeral port by default::
+
+    with EmbeddedServer(directory='/srv/data') as server:
+        ftp = server.client()
+        ftp.retrlines('LIST')
+
+Starting one costs a few milliseconds, as no process is spawned and no
+readiness has to be polled: the port is bound before `start` returns.
+Servers are independent of each other, so tests can share one (e.g. in a
+module-scoped fixture) or create one each. Without a directory, a server
+serves a fresh in-memory filesystem (`server.memfs`), which needs no
+cleanup.
+
+Embedded servers install no signal handlers, and log to the `thinftp.embed`
+logger (which has no handler of its own) unless given a logger.
+
+Classes:
+    EmbeddedServer: A thinFTP server running in a background thread.
+"""
+
+import ftplib
+import logging
+import socket
+import threading
+from argparse import Namespace
+from .handler import ThinFTP
+from .server import ThreadedThinFTP
+
+#: How often (in seconds) the serving thread checks whether it should stop.
+POLL_INTERVAL = 0.05
+
+
+class EmbeddedServer:
+    """
+    A thinFTP server running in a background thread.
+
+    Attributes:
+        config (Namespace): The server configuration.
+        server (ThreadedThinFTP): The running server, or None when stopped.
+    """
+
+    def __init__(self, directory=None, user='test', password='test', host='127.0.0.1',
+                 port=0, lgr=None, **settings):
+        """
+        Initialize the EmbeddedServer. It is not started yet.
+
+        Parameters:
+            directory (str): Directory to serve. Without one, an in-memory
+                filesystem is served.
+            user (str): Username of the single user.
+            password (str): Password of the single user.
+            host (str): Address to bind.
+            port (int): Port to listen on, 0 for an ephemeral port.
+            lgr (logging.Logger): Logger of the server.
+            **settings: Any other configuration setting (see
+                `thinftp.server.DEFAULTS`), such as `users` or `quota`.
+        """
+        if directory is None:
+            directory = '/'
+            settings.setdefault('backend', 'memory')
+        self.config = Namespace(bind=host, port=port, user=user, pswd=password,
+                                directory=str(directory), **settings)
+        self._lgr = lgr or logging.getLogger('thinftp.embed')
+        self.server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Bind the server and start serving in a background thread.
+
+        Returns:
+            tuple: The (host, port) address the server is bound to.
+
+        Raises:
+            RuntimeError: If the server is already running.
+            OSError: If the address cannot be bound.
+            ValueError: If the configuration is invalid.
+        """
+        if self.server is not None:
+            raise RuntimeError("The server is already running")
+        config = Namespace(**vars(self.config), lgr=self._lgr)
+        self.server = ThreadedThinFTP((config.bind, config.port), ThinFTP, config)
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(POLL_INTERVAL,),
+                                        name=f"thinftp-embed-{self.port}", daemon=True)
+        self._thread.start()
+        return self.address
+
+    def stop(self, timeout=5.0):
+        """
+        Stop serving and release the server's resources.
+
+        Idle sessions are closed with a 421 reply; sessions in the middle
+        of a command get up to `timeout` seconds to finish it. Stopping a
+        stopped server does nothing.
+
+        Parameters:
+            timeout (float): Seconds to wait for sessions to finish.
+        """
+        if self.server is None:
+            return
+        stopper = threading.Thread(target=self.server.shutdown)
+        stopper.start()
+        # Wake the serving thread now, rather than at its next poll
+        try:
+            self.server.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        stopper.join()
+        self._thread.join()
+        self.server.drain(timeout)
+        self.server.server_close()
+        self.server = self._thread = None
+
+    @property
+    def address(self):
+        """The (host, port) address of the running server."""
+        if self.server is None:
+            raise RuntimeError("The server is not running")
+        return self.server.server_address[:2]
+
+    @property
+    def host(self):
+        """The host address of the running server."""
+        return self.address[0]
+
+    @property
+    def port(self):
+        """The port of the running server."""
+        return self.address[1]
+
+    @property
+    def memfs(self):
+        """The in-memory filesystem of the running server, or None."""
+        return self.server.memfs if self.server is not None else None
+
+    def client(self, login=True, timeout=10):
+        """
+        Connect an `ftplib.FTP` client to the server.
+
+        Parameters:
+            login (bool): Log in as the configured user.
+            timeout (float): Timeout of the client's socket operations.
+
+        Returns:
+            ftplib.FTP: The connected client.
+        """
+        ftp = ftplib.FTP()
+        ftp.connect(self.host, self.port, timeout=timeout)
+        if login:
+            ftp.login(self.config.user, self.config.pswd)
+        return ftp
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
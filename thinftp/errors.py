@@ -32,3 +32,28 @@ class FileHandlerError(Exception):
         """
         self.message = msg
         super().__init__(self.message)
+
+class QuotaExceeded(FileHandlerError):
+    """
+    Exception raised when a write would exceed the user's disk quota.
+
+    The FTP handler reports it with a 552 reply.
+    """
+    pass
+
+class DigestMismatch(FileHandlerError):
+    """
+    Exception raised when an upload does not match the digest the client
+    announced for it. The upload is discarded.
+    """
+    pass
+
+class TransferDeferred(FileHandlerError):
+    """
+    Exception raised when a download gives up waiting for a transfer slot
+    of its disk, because the wait was too long or the server is stopping.
+
+    The FTP handler reports it with a 450 reply, so that the client tries
+    again later.
+    """
+    pass
@@ -10,7 +10,7 @@ deletion, and renaming.
 Classes:
     FileHandler: Encapsulates all file operations, enforcing confinement to 
     the FTP server's root directory. Raises appropriate exceptions for invalid 
-    actions.
+    actions. It is the default (local disk) `FileBackend`.
 
 Exceptions:
     FileHandlerError: Raised for invalid file-related operations such as 
@@ -18,34 +18,140 @@ Exceptions:
 
 Dependencies:
     - pathlib.Path: For file path resolution and operations.
-    - stat: For interpreting file permission modes.
-    - time: For formatting file modification times.
+    - .backend.FileBackend: The backend interface implemented here.
+    - .walker.walk_listing: For parallel recursive listings.
+    - .wildcard: For wildcard listings.
+    - .copier: For in-kernel server-side copies.
     - .errors.FileHandlerError: Custom exception used in this module.
 """
 
+import errno
+import os
 import stat
-import time
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from .errors import FileHandlerError
+from .backend import FileBackend, unique_names
+from .copier import copy_file, copy_tree
+from .digest import digesting, new_hashes, verify
+from .errors import FileHandlerError, QuotaExceeded
+from .treeops import chmod_path, chmod_tree, remove_tree
+from .walker import tree_usage, walk_listing
+from .wildcard import has_magic, scan
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+#: Granularity of holes: sparse uploads skip all-zero blocks of this size,
+#: and downloads only look for holes in files missing at least this much.
+SPARSE_BLOCK = 64 * 1024
+_ZERO_BLOCK = bytes(SPARSE_BLOCK)
+
+
+def _has_holes(fd):
+    """
+    Tell whether a file is likely to have holes worth skipping.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return False
+    st = os.fstat(fd)
+    return st.st_blocks * 512 + SPARSE_BLOCK <= st.st_size
+
+
+def _sparse_chunks(fd, chunk_size):
+    """
+    Read a file in chunks, producing its holes without reading them.
+
+    Data regions are found with `SEEK_DATA`/`SEEK_HOLE` and read with
+    `os.pread`; holes are produced from a buffer of zeros.
+    """
+    size = os.fstat(fd).st_size
+    zeros = bytes(chunk_size)
+    pos = 0
+    while pos < size:
+        try:
+            data = min(os.lseek(fd, pos, os.SEEK_DATA), size)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            data = size  # Only a hole is left
+        while pos < data:
+            n = min(chunk_size, data - pos)
+            yield zeros if n == chunk_size else zeros[:n]
+            pos += n
+        if pos >= size:
+            break
+        hole = min(os.lseek(fd, pos, os.SEEK_HOLE), size)
+        while pos < hole:
+            chunk = os.pread(fd, min(chunk_size, hole - pos), pos)
+            if not chunk:
+                return  # Truncated meanwhile
+            yield chunk
+            pos += len(chunk)
+
+
+class _SparseWriter:
+    """
+    Writes a new file, seeking over its all-zero blocks instead of writing
+    them, so that they remain holes.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) < SPARSE_BLOCK:
+            return
+        end = len(self.buf) - len(self.buf) % SPARSE_BLOCK
+        with memoryview(self.buf) as view:
+            for i in range(0, end, SPARSE_BLOCK):
+                with view[i:i + SPARSE_BLOCK] as block:
+                    if block == _ZERO_BLOCK:
+                        self.f.seek(SPARSE_BLOCK, os.SEEK_CUR)
+                    else:
+                        self.f.write(block)
+        del self.buf[:end]
+
+    def close(self):
+        """
+        Write the last partial block and set the size of the file, which
+        may end with a hole.
+        """
+        if self.buf.count(0) == len(self.buf):
+            self.f.seek(len(self.buf), os.SEEK_CUR)
+        else:
+            self.f.write(self.buf)
+        self.f.truncate(self.f.tell())
+
 
-class FileHandler:
+class FileHandler(FileBackend):
     """
     Custom File Handler class for thinFTP.
 
     Handles file operations such as navigating directories, listing contents,
     reading and writing files, and renaming or deleting files and directories.
+
+    Quotas (the `quota` and `usage` attributes of `FileBackend`) are
+    enforced by `write` and `append`.
     """
 
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, walk_workers=8):
         """
         Initialize the FileHandler with a root directory.
 
         Parameters:
             root_dir (str): The root directory for file operations.
+            walk_workers (int): Threads used for recursive listings.
         """
         self.root_dir = Path(root_dir).resolve()
         self.cur_dir = self.root_dir
         self.ren_old = None
+        self.cp_old = None
+        self.walk_workers = walk_workers
 
     def resolve_path(self, path):
         """
@@ -130,78 +236,147 @@ class FileHandler:
 
         Parameters:
             path (str): Path of directory to create.
+
+        Raises:
+            FileExistsError: If the path already exists.
+            PermissionError: If attempting to move outside the root directory.
+        """
+        path = self.resolve_path(path)
+        if not path.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        path.mkdir(parents=True)
+        self.fs_op('mkdir', path)
+
+    def name_ls(self, path, limit=None):
+        """
+        List the entries in a directory, the file itself, or the entries
+        matching a wildcard in the last component of the path.
+
+        The directory is read in a single `os.scandir` pass, and reading
+        stops as soon as `limit` entries have been found.
+
+        Parameters:
+            path (str): The directory, file or wildcard to list.
+            limit (int): Maximum number of entries to return, or None.
+
+        Returns:
+            list: `os.DirEntry` objects of the entries, or the Path of the
+            file itself. Empty if nothing matches.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
         """
-        self.resolve_path(path).mkdir(parents=True)
+        target = self.resolve_path(path)
+        pattern = None
+        if not target.exists():
+            if not has_magic(target.name):
+                return []
+            target, pattern = target.parent, target.name
+        if not target.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        if pattern is None and not target.is_dir():
+            return [target]
+        try:
+            return list(islice(scan(str(target), pattern, str(self.root_dir)), limit))
+        except (FileNotFoundError, NotADirectoryError):
+            return []
 
-    def name_ls(self, path):
+    def ls_recursive(self, path, max_depth=32, max_entries=100_000):
         """
-        List the names of entries in a directory.
+        Recursively list a directory tree with a parallel `os.scandir` walker.
 
         Parameters:
             path (str): The directory to list.
+            max_depth (int): How many levels below `path` to descend.
+            max_entries (int): Maximum number of entries to produce.
 
         Returns:
-            list: A list of Path objects representing entries in the directory.
-        
+            generator: Yields (rel_dir, lines) as each directory completes.
+
         Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
             PermissionError: If attempting to move outside the root directory.
         """
         target_dir = self.resolve_path(path)
+        if not target_dir.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        if not target_dir.exists():
+            raise FileNotFoundError
+        if not target_dir.is_dir():
+            raise NotADirectoryError
+        return walk_listing(str(target_dir), max_depth, max_entries, self.walk_workers)
 
-        if target_dir.exists():
-            if not target_dir.is_relative_to(self.root_dir):
-                raise PermissionError('Attempt to move behind root directory')
-            matches = target_dir.iterdir() if target_dir.is_dir() else [target_dir]
-        else:
-            matches = target_dir.glob(path)
-        
-        matches = list(matches)
-        for i in range(len(matches)):
-            try:
-                entry = matches[i].resolve()
-                if not entry.is_relative_to(self.root_dir):
-                    matches.pop(i)
-            except FileNotFoundError:
-                continue
-        
-        return matches
-    
-    def ls(self, path):
+    def stat(self, path):
         """
-        List the contents of the specified directory.
+        Get the status of a file or directory.
 
         Parameters:
-            path (str): The directory to list.
+            path (str): The path to query.
 
         Returns:
-            list: A list of strings representing the contents of the directory, in
-            the format:
+            os.stat_result: The status of the path.
+
+        Raises:
+            FileNotFoundError: If the path does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+        path = self.resolve_path(path)
+        if not path.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        return path.stat()
+
+    def local_path(self, fname):
+        """
+        Get the location of a file on the local disk.
+
+        Parameters:
+            fname (str): The file to locate.
 
-            `<permissions> <nlinks> <owner> <group> <size> <modtime> <name>`
+        Returns:
+            Path: The resolved path.
 
-            If the directory does not exist, an empty list is returned.
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
         """
-        matches = self.name_ls(path)
-        if not matches:
-            return []
-        
-        lines = []
-        for entry in sorted(matches):
-            stats = entry.stat()
-            perms = stat.filemode(stats.st_mode)
-            size = stats.st_size
-            mtime = time.strftime("%b %d %H:%M", time.localtime(stats.st_mtime))
-            lines.append(f"{perms} 1 user group {size:>8} {mtime} {entry.name}")
-        
-        return lines
-
-    def read(self, fname, type):
+        path = self.resolve_path(fname)
+        if not path.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        return path
+
+    def open(self, fname, mode='rb'):
+        """
+        Open a file for binary reading or writing.
+
+        Parameters:
+            fname (str): The file to open.
+            mode (str): One of 'rb', 'wb' or 'ab'.
+
+        Returns:
+            io.BufferedIOBase: The opened file.
+
+        Raises:
+            FileNotFoundError: If reading a file that does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+        path = self.resolve_path(fname)
+        if not path.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        return open(path, mode)
+
+    def read(self, fname, type, chunk_size=8192):
         """
         Read a file in chunks.
 
+        In binary mode, the holes of sparse files are skipped with
+        `SEEK_DATA`/`SEEK_HOLE` and produced as zeros, without reading them,
+        and large files are read past the page cache if a `cache` policy
+        is set.
+
         Parameters:
             fname (str): The file to read.
             type (str): The transfer type ('A' for ASCII, 'I' for binary).
+            chunk_size (int): Size of the chunks to read.
 
         Yields:
             bytes: Chunks of the file content.
@@ -213,14 +388,30 @@ class FileHandler:
         mode = 'rb' if type == 'I' else 'r'
         path = self.resolve_path(fname)
         with open(path, mode) as f:
-            while True:
-                chunk = f.read(8192)
-                if not chunk:
-                    break
-                if mode == 'r':
+            if mode == 'r':
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
                     yield chunk.replace('\n', '\r\n').encode('ascii')
-                else:
+                return
+            fd = f.fileno()
+            if _has_holes(fd):
+                chunks = _sparse_chunks(fd, chunk_size)
+            else:
+                chunks = iter(partial(f.read, chunk_size), b'')
+            advisor = self.cache.reader(fd, type) if self.cache is not None else None
+            if advisor is None:
+                yield from chunks
+                return
+            pos = 0
+            try:
+                for chunk in chunks:
                     yield chunk
+                    pos += len(chunk)
+                    advisor.advance(pos)
+            finally:
+                advisor.drop(pos)
 
     def size(self, fname):
         """
@@ -259,7 +450,9 @@ class FileHandler:
             raise PermissionError('Attempt to move behind root directory')
         if not path.is_file():
             raise FileHandlerError(f'Not a file: {fname!r}')
+        size = path.stat().st_size
         path.unlink()
+        self.fs_op('delete', path, size=size)
 
     def rmdir(self, path):
         """
@@ -279,10 +472,72 @@ class FileHandler:
                 if not path.is_relative_to(self.root_dir):
                     raise PermissionError('Attempt to move behind root directory')
                 path.rmdir()
+                self.fs_op('rmdir', path)
                 return
             raise NotADirectoryError
         raise FileNotFoundError
 
+    def remove_tree(self, path):
+        """
+        Prepare the removal of a directory and everything in it, on
+        `walk_workers` threads.
+
+        Parameters:
+            path (str): The directory to remove.
+
+        Returns:
+            TreeOperation: The removal.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory, or is a
+                symbolic link.
+            PermissionError: If attempting to move outside the root
+                directory, or to remove it.
+        """
+        # Unlike other commands, the removal does not follow a link to the
+        # directory to remove, as shutil.rmtree
+        if path.startswith('/') or path.startswith('\\'):
+            link = self.root_dir / path.lstrip('/\\')
+        else:
+            link = self.cur_dir / path
+        path = self.local_path(path)
+        if path == self.root_dir:
+            raise PermissionError('Attempt to remove root directory')
+        if os.path.islink(os.path.normpath(link)):
+            raise NotADirectoryError
+        if not path.is_dir():
+            raise NotADirectoryError if path.exists() else FileNotFoundError
+        finish = lambda op: self.fs_op('rmtree', path, size=op.bytes, files=op.files)
+        return remove_tree(self.root_dir, path.relative_to(self.root_dir).parts,
+                           self.walk_workers, finish)
+
+    def chmod(self, path, mode, recursive=False):
+        """
+        Change the permission bits of a file or directory.
+
+        Parameters:
+            path (str): The file or directory.
+            mode (int): The new permission bits.
+            recursive (bool): Also change everything in a directory, on
+                `walk_workers` threads.
+
+        Returns:
+            TreeOperation: The change of a directory tree, to run, if
+            `recursive` is set and the path is a directory; otherwise the
+            change is done and None is returned.
+
+        Raises:
+            FileNotFoundError: If the path does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+        path = self.local_path(path)
+        parts = path.relative_to(self.root_dir).parts
+        if recursive and path.is_dir():
+            return chmod_tree(self.root_dir, parts, mode, self.walk_workers)
+        chmod_path(self.root_dir, parts, mode)
+        return None
+
     def rename_from(self, old):
         """
         Mark a file or directory for renaming.
@@ -310,24 +565,256 @@ class FileHandler:
             new (str): New file/directory name.
         """
         new = self.resolve_path(new)
-        self.ren_old.rename(new)
-        self.ren_old = None
+        old, self.ren_old = self.ren_old, None
+        replaced = new.stat().st_size if new.is_file() and old.is_file() else None
+        old.rename(new)
+        self.fs_op('rename', old, dest=new, replaced=replaced)
     
-    def write(self, fname, data):
+    def copy_from(self, old):
+        """
+        Mark a file or directory for copying.
+
+        Parameters:
+            old (str): Existing file/directory name.
+
+        Raises:
+            FileNotFoundError: If the original path does not exist.
+            PermissionError: If attempting to move outside the root directory.
+        """
+        self.cp_old = self.resolve_path(old)
+        if not self.cp_old.is_relative_to(self.root_dir):
+            self.cp_old = None
+            raise PermissionError('Attempt to move behind root directory')
+        if not self.cp_old.exists():
+            self.cp_old = None
+            raise FileNotFoundError
+
+    def copy_to(self, new):
         """
-        Write data to a file.
+        Prepare the copy of a previously marked file or directory.
+
+        Parameters:
+            new (str): Destination name. Copying into an existing directory
+                places the copy inside it.
+
+        Returns:
+            callable: Performs the copy when called, using reflinks or
+            `os.copy_file_range` where possible. It raises `QuotaExceeded`
+            if the copy would exceed the quota.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory
+                or to copy a directory into itself.
+            FileExistsError: If copying a directory onto an existing path.
+            FileHandlerError: If source and destination are the same.
+        """
+        src, self.cp_old = self.cp_old, None
+        dst = self.resolve_path(new)
+        if not dst.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        if dst.is_dir():
+            dst = dst / src.name
+        if dst == src:
+            raise FileHandlerError('Source and destination are the same')
+        if src.is_dir():
+            if dst.is_relative_to(src):
+                raise PermissionError('Attempt to copy a directory into itself')
+            if dst.exists():
+                raise FileExistsError
+            copy = partial(copy_tree, src, dst)
+        else:
+            copy = partial(copy_file, src, dst)
+
+        def run():
+            replaced = dst.stat().st_size if dst.is_file() else None
+            reserved = 0
+            if self.quota is not None:
+                # Measured here rather than up front, as a large tree
+                # would hold up the control connection
+                reserved, _ = tree_usage(src)
+                if not self.usage.reserve(reserved, self.quota, replaced or 0):
+                    raise QuotaExceeded(f'Disk quota of {self.quota} bytes exceeded')
+            try:
+                return copy()
+            finally:
+                # Also after a failure: account for what was written
+                self.fs_op('copy', src, dest=dst, replaced=replaced)
+                if reserved:
+                    self.usage.release(reserved)
+        return run
+
+    def write(self, fname, data, digests=None, expected=None):
+        """
+        Write data to a file, digesting it on the way.
+
+        With a quota set, the upload is aborted as soon as it would exceed
+        the quota, and the partial file is removed.
+
+        With an expected digest, the data is written to a temporary file
+        next to the target, which only replaces the target once the digest
+        has been verified. A mismatching upload leaves the target untouched.
+
+        If `sparse` is set, blocks of `SPARSE_BLOCK` zero bytes are not
+        written but left as holes. Otherwise, large files are written past
+        the page cache if a `cache` policy is set.
 
         Parameters:
             fname (str): The file to write to.
             data (iterable): An iterable of bytes to write.
+            digests (dict): Algorithms (keys of `digest.ALGORITHMS`) mapped
+                to None; each is set to the hex digest of the data written.
+            expected (tuple): (algorithm, hex digest) the data must match,
+                or None.
+
+        Returns:
+            int: The number of bytes written.
 
         Raises:
             PermissionError: If attempting to move outside the root directory.
+            QuotaExceeded: If the quota would be exceeded.
+            DigestMismatch: If the data does not match `expected`.
         """
         path = self.resolve_path(fname)
         if not path.is_relative_to(self.root_dir):
             raise PermissionError('Attempt to move behind root directory')
-        with open(path, 'wb') as f:
-            for chunk in data:
-                f.write(chunk)
-                    
+        replaced = path.stat().st_size if path.is_file() else None
+        hashes = new_hashes(digests, expected)
+        if expected is None:
+            target, f = path, open(path, 'wb')
+        else:
+            # Created like the target would be, so it gets the same permissions
+            target = path.with_name(f".{path.name}.{os.urandom(4).hex()}.part")
+            f = open(target, 'xb')
+        size = reserved = 0
+        try:
+            try:
+                with f:
+                    if self.sparse:
+                        out = _SparseWriter(f)
+                    else:
+                        out = self.cache.writer(f) if self.cache is not None else f
+                    try:
+                        for chunk in digesting(data, hashes):
+                            size += len(chunk)
+                            if self.quota is not None:
+                                # Reserved as written, so that concurrent
+                                # uploads cannot exceed the quota together
+                                if not self.usage.reserve(len(chunk), self.quota, replaced or 0):
+                                    raise QuotaExceeded(f'Disk quota of {self.quota} bytes exceeded')
+                                reserved += len(chunk)
+                            out.write(chunk)
+                    finally:
+                        if out is not f:
+                            out.close()
+                verify(hashes, expected)
+            except QuotaExceeded:
+                target.unlink()
+                if target == path and replaced is not None:
+                    self.fs_op('delete', path, size=replaced)
+                raise
+            except BaseException:
+                if target != path:
+                    target.unlink()
+                elif path.is_file():
+                    # The target was truncated, and keeps what was received
+                    self.fs_op('write', path, size=path.stat().st_size, replaced=replaced)
+                elif replaced is not None:
+                    self.fs_op('delete', path, size=replaced)
+                raise
+            if target != path:
+                if replaced is not None:
+                    # The upload replaces the file, not its permissions
+                    try:
+                        os.chmod(target, stat.S_IMODE(path.stat().st_mode))
+                    except FileNotFoundError:
+                        pass
+                os.replace(target, path)
+            if digests is not None:
+                digests.update((algo, h.hexdigest()) for algo, h in hashes.items() if algo in digests)
+            self.fs_op('write', path, size=size, replaced=replaced)
+        finally:
+            if reserved:
+                self.usage.release(reserved)
+        return size
+
+    def append(self, fname, data):
+        """
+        Append data to a file, creating it if it does not exist.
+
+        The file is opened with `O_APPEND` and held under an exclusive
+        `flock` for the whole upload, so that concurrent appenders, in this
+        process or another one honouring the lock, never interleave their
+        chunks: each append lands in one piece.
+
+        An append that fails, e.g. because it would exceed the quota or
+        the data connection broke, is undone: the file is truncated back to
+        its previous size.
+
+        Parameters:
+            fname (str): The file to append to.
+            data (iterable): An iterable of bytes to append.
+
+        Returns:
+            int: The number of bytes appended.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+            QuotaExceeded: If the quota would be exceeded.
+        """
+        path = self.resolve_path(fname)
+        if not path.is_relative_to(self.root_dir):
+            raise PermissionError('Attempt to move behind root directory')
+        existed = path.is_file()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        # Unbuffered, so that nothing is left to write once truncated back
+        with open(fd, 'wb', buffering=0) as f:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            start = os.fstat(fd).st_size
+            size = reserved = 0
+            try:
+                for chunk in data:
+                    size += len(chunk)
+                    if self.quota is not None:
+                        if not self.usage.reserve(len(chunk), self.quota):
+                            raise QuotaExceeded(f'Disk quota of {self.quota} bytes exceeded')
+                        reserved += len(chunk)
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[f.write(view):]
+            except BaseException:
+                os.ftruncate(fd, start)
+                size = 0
+                raise
+            finally:
+                self.fs_op('write', path, size=start + size, replaced=start if existed else None)
+                if reserved:
+                    self.usage.release(reserved)
+        return size
+
+    def create_unique(self, fname=None):
+        """
+        Create an empty file under a name that no other file has (STOU).
+
+        Names are claimed with `O_EXCL`, so concurrent clients asking for
+        the same name always get different files.
+
+        Parameters:
+            fname (str): The name requested by the client, or None.
+
+        Returns:
+            str: The name of the created file.
+
+        Raises:
+            PermissionError: If attempting to move outside the root directory.
+        """
+        for name in unique_names(fname):
+            path = self.resolve_path(name)
+            if not path.is_relative_to(self.root_dir):
+                raise PermissionError('Attempt to move behind root directory')
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+            except FileExistsError:
+                continue
+            self.fs_op('write', path, size=0, replaced=None)
+            return name
@@ -8,27 +8,162 @@ LIST, RETR, STOR, and PASV mode for data transfers.
 
 """
 
-import socketserver
+import os
+import select
+import shlex
 import socket
-from .fileman import FileHandler
+import ssl
+import stat
+import tarfile
+import time
+from itertools import chain
+from .archive import ChunkWriter, receive_tar, send_tar
+from .backend import CHUNK_SIZE, format_time
+from .digest import ALGORITHMS, new_hash
 from .errors import *
+from .tls import TLS_CHUNK_SIZE
 
-class ThinFTP(socketserver.BaseRequestHandler):
+#: Read buffer of the control connection. Commands are short lines, and
+#: every idle session holds one of these.
+CONTROL_BUFFER_SIZE = 1024
+#: Seconds between two progress lines of a server-side tree operation.
+PROGRESS_INTERVAL = 2.0
+
+class ThinFTP:
     """
     The main handler class for the thinFTP server.
     
     This class implements methods for parsing and responding to FTP protocol
     commands from a connected client. It uses a PASV data connection model.
 
+    Each connection gets an instance, which is its session state. To keep
+    idle sessions small, it implements socketserver's request handler
+    protocol itself instead of subclassing `BaseRequestHandler`, so that its
+    state lives in `__slots__` rather than in a per-instance `__dict__`; the
+    command tables are shared by all sessions as class attributes, and the
+    filesystem backend is only opened by the first command that needs it.
+
     Attributes:
-        fileman (FileHandler): Handles file system operations.
+        request (socket.socket): The control connection.
+        client_address (tuple): The client's (host, port).
+        server (ThreadedThinFTP): The server, holding the shared configuration.
+        fileman (FileBackend): Handles file system operations. Opened on
+            first use after login.
         login_user (str): Currently logging-in or logged-in user.
         logged_in (bool): Authentication state of the client.
+        user (User): The authenticated user account.
+        vhost (VirtualHost): The virtual host selected with HOST, or None.
         transfer_type (str): Transfer type ('A' for ASCII, 'I' for binary).
+        hash_algo (str): Algorithm used by HASH, selected with OPTS HASH.
+        hash_range (tuple): (start, end) byte range for the next HASH, set by RANG.
+        expected_digest (tuple): (algorithm, hex digest) the next STOR must
+            match, set by SITE EXPECT.
+        copy_jobs (sequence): (number, destination, future) of background copies.
         data_sock (socket.socket): Passive mode server socket.
         data_conn (socket.socket): Established data connection with client.
+        conn (file): Buffered reader of the control connection.
+        pbsz (bool): Whether PBSZ has been received after AUTH TLS.
+        prot (str): Data channel protection level ('C' clear, 'P' private).
+        chunk_size (int): Size of the chunks moved per data transfer call.
     """
 
+    __slots__ = ('request', 'client_address', 'server', 'conn', '_fileman', 'login_user',
+                 'logged_in', 'user', 'vhost', 'transfer_type', 'hash_algo', 'hash_range',
+                 'expected_digest', 'copy_jobs', 'data_sock', 'data_conn', 'pbsz', 'prot',
+                 'chunk_size')
+
+    #: Commands mapped to the names of their methods.
+    verb_map = {
+        'HOST': 'ftp_host',
+        'USER': 'ftp_user',
+        'PASS': 'ftp_pass',
+        'QUIT': 'ftp_quit',
+        'NOOP': 'ftp_noop',
+        'PWD': 'ftp_pwd',
+        'CWD': 'ftp_cwd',
+        'CDUP': 'ftp_cdup',
+        'MKD': 'ftp_mkd',
+        'PASV': 'ftp_pasv',
+        'LIST': 'ftp_list',
+        'OPTS': 'ftp_opts',
+        'TYPE': 'ftp_type',
+        'RETR': 'ftp_retr',
+        'SIZE': 'ftp_size',
+        'MDTM': 'ftp_mdtm',
+        'STAT': 'ftp_stat',
+        'ALLO': 'ftp_allo',
+        'DELE': 'ftp_dele',
+        'RMD': 'ftp_rmd',
+        'RNFR': 'ftp_rnfr',
+        'RNTO': 'ftp_rnto',
+        'STOR': 'ftp_stor',
+        'APPE': 'ftp_appe',
+        'STOU': 'ftp_stou',
+        'SYST': 'ftp_syst',
+        'FEAT': 'ftp_feat',
+        'HELP': 'ftp_help',
+        'NLST': 'ftp_nlst',
+        'HASH': 'ftp_hash',
+        'RANG': 'ftp_rang',
+        'XCRC': 'ftp_xcrc',
+        'XMD5': 'ftp_xmd5',
+        'XSHA1': 'ftp_xsha1',
+        'XSHA256': 'ftp_xsha256',
+        'SITE': 'ftp_site',
+        'AUTH': 'ftp_auth',
+        'PBSZ': 'ftp_pbsz',
+        'PROT': 'ftp_prot',
+        'ABOR': 'ftp_abor',
+    }
+    before_login = frozenset(('HOST', 'USER', 'PASS', 'QUIT', 'AUTH', 'PBSZ', 'PROT', 'FEAT'))
+    data_verbs = frozenset(('LIST', 'NLST', 'RETR', 'STOR', 'APPE', 'STOU'))
+    write_verbs = frozenset(('MKD', 'RMD', 'DELE', 'RNFR', 'RNTO', 'STOR', 'APPE', 'STOU'))
+    single_arg_verbs = frozenset(('RETR', 'STOR', 'APPE', 'STOU', 'HASH', 'SITE', 'MDTM'))
+
+    def __init__(self, request, client_address, server):
+        """
+        Serve a client connection, like `socketserver.BaseRequestHandler`.
+
+        Args:
+            request (socket.socket): The control connection.
+            client_address (tuple): The client's (host, port).
+            server (ThreadedThinFTP): The server.
+        """
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.conn = None
+        self._fileman = None
+        self.login_user = ''
+        self.logged_in = False
+        self.user = None
+        self.vhost = None
+        self.transfer_type = 'I'
+        self.hash_algo = 'SHA-256'
+        self.hash_range = None
+        self.expected_digest = None
+        self.copy_jobs = ()
+        self.data_sock = None
+        self.data_conn = None
+        self.pbsz = False
+        self.prot = 'C'
+        self.chunk_size = CHUNK_SIZE
+        self.setup()
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    @property
+    def fileman(self):
+        """
+        The filesystem backend of the logged in user, opened on first use.
+        None before login.
+        """
+        if self._fileman is None and self.user is not None:
+            self._fileman = self.server.open_fileman(self.user)
+        return self._fileman
+
     def client_addr(self):
         """
         Returns the client's address as a string.
@@ -39,13 +174,15 @@ class ThinFTP(socketserver.BaseRequestHandler):
         host, port = self.client_address
         return f"{host}:{port}"
     
-    def response(self, sts_code, msg=None, **kwargs):
+    def response(self, sts_code, msg=None, end='.', **kwargs):
         """
         Sends an FTP-compliant response message to the client.
 
         Args:
             sts_code (int): FTP status code.
             msg (str, optional): Optional custom message.
+            end (str, optional): Appended to the message. Replies carrying
+                machine-readable data (sizes, digests) pass ''.
             **kwargs: Format arguments for message templating.
 
         Returns:
@@ -73,7 +210,9 @@ class ThinFTP(socketserver.BaseRequestHandler):
         }
         if msg is None:
             msg = resp_map[sts_code].format(**kwargs)
-        resp = f"{sts_code} {msg}.\r\n"
+        # Messages starting with '-' open a multi-line reply
+        sep = '' if str(msg).startswith('-') else ' '
+        resp = f"{sts_code}{sep}{msg}{end}\r\n"
         self.request.sendall(resp.encode())
         return resp
     
@@ -85,22 +224,33 @@ class ThinFTP(socketserver.BaseRequestHandler):
         handler methods. Manages login state and handles QUIT properly.
         """
         self.server.lgr.info(f"Got connection from {self.client_addr()}")
+        ip = self.client_address[0]
+        if self.server.login_limiter.blocked(ip):
+            self.server.lgr.error(f"Refused connection from {self.client_addr()}: banned for failed logins")
+            self.response(421, 'Too many failed logins. Try again later')
+            return
         self.response(220)
+        limiter = self.server.command_limiter
         
-        self.fileman = FileHandler(self.server.config.directory)
-        self.login_user = ''
-        self.logged_in = False
-        self.transfer_type = 'I'
-        self.data_sock = None
-        self.data_conn = None
-        
-        with self.request.makefile("rwb") as conn:
+        with self.request.makefile('rb', CONTROL_BUFFER_SIZE) as self.conn:
             try:
                 while True:
-                    line = conn.readline()
+                    line = self.conn.readline()
+                    if self.server.draining and line.strip().upper() != b'QUIT':
+                        self.response(421, 'Server is restarting. Please reconnect')
+                        self.server.lgr.info(f"Closed connection of {self.client_addr()} for restart")
+                        break
                     if not line:
                         self.server.lgr.error(f"Connection closed unexpectedly by client: {self.client_addr()}.")
                         break
+                    if limiter is not None:
+                        delay = limiter.acquire(ip)
+                        if delay is None:
+                            self.response(421, 'Too many commands. Slow down')
+                            self.server.lgr.error(f"Closed connection of {self.client_addr()}: command rate exceeded")
+                            break
+                        if delay:
+                            time.sleep(delay)
 
                     cmd = line.decode().strip()
                     if not cmd:
@@ -109,56 +259,122 @@ class ThinFTP(socketserver.BaseRequestHandler):
                     self.server.lgr.debug(f"Received command: [{cmd}] from client {self.client_addr()}")
                     verb, _, args = cmd.partition(' ')
 
-                    self.verb_map = {
-                        'USER': self.ftp_user,
-                        'PASS': self.ftp_pass,
-                        'QUIT': self.ftp_quit,
-                        'NOOP': lambda: self.response(200, cmd=verb),
-                        'PWD': self.ftp_pwd,
-                        'CWD': self.ftp_cwd,
-                        'CDUP': self.ftp_cdup,
-                        'MKD': self.ftp_mkd,
-                        'PASV': self.ftp_pasv,
-                        'LIST': self.ftp_list,
-                        'OPTS': lambda kind, switch: self.response(200, cmd=verb),
-                        'TYPE': self.ftp_type,
-                        'RETR': self.ftp_retr,
-                        'SIZE': self.ftp_size,
-                        'DELE': self.ftp_dele,
-                        'RMD': self.ftp_rmd,
-                        'RNFR': self.ftp_rnfr,
-                        'RNTO': self.ftp_rnto,
-                        'STOR': self.ftp_stor,
-                        'SYST': lambda: self.response(215, 'UNIX Type: L8'),
-                        'FEAT': self.ftp_feat,
-                        'HELP': self.ftp_help,
-                        'NLST': self.ftp_nlst,
-                    }
-                    before_login = ('USER', 'PASS', 'QUIT')
-                    single_arg_verbs = ('RETR', 'STOR')
-
+                    hooks = self.server.hooks
                     try:
                         verb = verb.upper()
-                        if (not self.logged_in) and (verb not in before_login):
-                            self.response(530, 'Access Denied')
+                        if hooks.on_command_start:
+                            hooks.fire('on_command_start', self, verb, args)
+                        started = time.perf_counter()
+                        resp = None
+                        if (not self.logged_in) and (verb not in self.before_login):
+                            resp = self.response(530, 'Access Denied')
                             continue
-                        
-                        fn = self.verb_map.get(verb)
-                        if not fn:
+                        if self.server.config.tls_required:
+                            if verb in ('USER', 'PASS') and not self.is_tls():
+                                resp = self.response(530, 'TLS required. Use AUTH TLS first')
+                                continue
+                            if verb in self.data_verbs and self.prot != 'P':
+                                resp = self.response(521, 'Data connections must be protected. Use PROT P')
+                                continue
+                        if (verb in self.write_verbs) and not self.user.writable:
+                            resp = self.response(550, 'Permission denied')
+                            continue
+
+                        name = self.verb_map.get(verb)
+                        if not name:
                             resp = self.response(502, cmd=verb)
                         else:
-                            resp = fn(args) if verb in single_arg_verbs else fn(*args.split())
+                            fn = getattr(self, name)
+                            resp = fn(args) if verb in self.single_arg_verbs else fn(*args.split())
                             
                         self.server.lgr.debug(f"Replied {self.client_addr()}: {resp!r}")
                     except TypeError as e:
                         if "missing" in str(e) or "positional" in str(e):
-                            self.response(501)
+                            resp = self.response(501)
                         else:
                             raise e
+                    finally:
+                        if hooks.on_command_end:
+                            hooks.fire('on_command_end', self, verb, args, resp,
+                                       time.perf_counter() - started)
             except ClientQuit:
                 self.server.lgr.info(f"Connection closed for client {self.client_addr()} upon QUIT")
+            except (ssl.SSLError, ConnectionError) as e:
+                if self.server.draining:
+                    self.server.lgr.info(f"Closed connection of {self.client_addr()} for restart")
+                else:
+                    self.server.lgr.error(f"Connection with client {self.client_addr()} failed: {e}")
+
+    def setup(self):
+        """
+        Register the session with the server.
+        """
+        # Replies are small writes: without TCP_NODELAY, the final reply of
+        # a transfer waits for the client to acknowledge the preliminary one
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.add_session(self)
+        if self.server.hooks.on_connect:
+            self.server.hooks.fire('on_connect', self)
+
+    def finish(self):
+        """
+        Close the TLS layer of the control connection, if any, and
+        unregister the session.
+        """
+        if self.server.hooks.on_disconnect:
+            self.server.hooks.fire('on_disconnect', self)
+        if self.logged_in and self.vhost is not None:
+            self.vhost.metrics.release()
+        if self.is_tls():
+            self.conn.close()
+            self.request.close()
+        self.server.remove_session(self)
+
+    def interrupt(self):
+        """
+        Stop reading commands from the client, e.g. for a restart.
+
+        The read side of the control connection is shut down, which wakes
+        up a session waiting for a command, while a command in progress can
+        still send its reply. Works for TLS connections too, as the shutdown
+        is done on a duplicate of the underlying socket.
+        """
+        try:
+            with socket.socket(fileno=os.dup(self.request.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def is_tls(self):
+        """
+        Returns:
+            bool: True if the control connection is protected by TLS.
+        """
+        return isinstance(self.request, ssl.SSLSocket)
                     
 
+    def ftp_host(self, name):
+        """
+        Handle the HOST command (RFC 7151) to select a virtual host. Must
+        be sent before USER.
+
+        Args:
+            name (str): Name of the virtual host.
+
+        Returns:
+            str: FTP response line.
+        """
+        vhosts = self.server.vhosts
+        if vhosts is None:
+            return self.response(502, cmd='HOST')
+        if self.logged_in or self.login_user:
+            return self.response(503, 'HOST must be sent before USER')
+        host = vhosts.get(name)
+        if host is None:
+            return self.response(504, f"Unknown host: {name}")
+        self.vhost = host
+        return self.response(220, f"Host {host.name} ready")
+
     def ftp_user(self, uname):
         """
         Handle the USER command.
@@ -182,16 +398,33 @@ class ThinFTP(socketserver.BaseRequestHandler):
         Returns:
             str: FTP response line.
         """
+        ip = self.client_address[0]
         if self.logged_in:
             return self.response(202, 'Already logged in')
         elif not self.login_user:
             return self.response(503, 'Login with USER first')
+        elif self.server.login_limiter.blocked(ip):
+            self.login_user = ''
+            self.server.lgr.error(f"Refused login from {self.client_addr()}: too many failed attempts")
+            return self.response(530, 'Too many failed attempts. Try again later')
         else:
-            if (self.login_user == self.server.config.user) and (pswd == self.server.config.pswd):
+            if self.vhost is None and self.server.vhosts is not None:
+                self.vhost = self.server.vhosts.default
+            user = self.server.authenticate(self.login_user, pswd, self.vhost)
+            if user is not None:
+                if self.vhost is not None and not self.vhost.metrics.acquire(self.vhost.max_sessions):
+                    self.login_user = ''
+                    return self.response(530, 'Too many sessions for this host. Try again later')
+                self.user = user
                 self.logged_in = True
                 return self.response(230)
             else:
+                delay = self.server.login_limiter.record_failure(ip)
                 self.login_user = ''
+                if self.vhost is not None:
+                    self.vhost.metrics.count('failed_logins')
+                if delay:
+                    time.sleep(delay)
                 return self.response(530)
 
     def ftp_pwd(self):
@@ -255,6 +488,15 @@ class ThinFTP(socketserver.BaseRequestHandler):
             return self.response(257, path=self.fileman.get_abs(path))
         except FileExistsError:
             return self.response(550, msg=f"{self.fileman.get_abs(path)}: Directory already exists")
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except FileNotFoundError:
+            return self.response(550, msg=f"Cannot create {path!r}: Parent directory does not exist")
+        except NotADirectoryError:
+            return self.response(550, msg=f"Cannot create {path!r}: A parent is not a directory")
+        except OSError as e:
+            return self.response(550, msg=f"Cannot create {path!r}: {e.strerror or e}")
 
     def ftp_pasv(self):
         """
@@ -275,27 +517,93 @@ class ThinFTP(socketserver.BaseRequestHandler):
         self.server.lgr.debug(f"Opened PASV Data connection at {ip}:{port}")
         return self.response(227, host=ip.replace('.',','), p1=p1, p2=p2)
     
-    def ftp_list(self, path='.'):
+    def parse_list_args(self, args):
+        """
+        Split the arguments of a listing command into options and path.
+
+        Leading arguments starting with '-' (as in `LIST -la`) are options.
+        The remaining arguments form the path.
+
+        Args:
+            args (tuple): Arguments of the command.
+
+        Returns:
+            tuple: (options, path) where options is a set of option letters
+            and path defaults to '.'.
+        """
+        opts = set()
+        args = list(args)
+        while args and args[0].startswith('-') and len(args[0]) > 1:
+            opts.update(args.pop(0)[1:])
+        return opts, ' '.join(args) or '.'
+
+    def ftp_list(self, *args):
         """
         Handle the LIST command to list files and directories.
 
+        With the `-R` option, the whole tree below the path is listed,
+        each directory being streamed as soon as it has been read.
+
         Args:
-            path (str): Path to list. Defaults to '.'.
+            *args: Options and path to list. The path defaults to '.'.
 
         Returns:
             str: FTP response line.
         """
         if not self.data_sock:
             return self.response(503, cmd='PASV')
+        opts, path = self.parse_list_args(args)
+        if 'R' in opts:
+            return self.list_recursive(path)
+        limit = self.server.config.list_max_entries
         try:
-            lsts = '\r\n'.join(self.fileman.ls(path))
+            lines = self.fileman.ls(path, limit)
+            lsts = '\r\n'.join(lines)
             self.open_data_conn()
-            self.response(150)
             self.server.lgr.debug(f"Sending to client {self.client_addr()} via Data conn: \n" + lsts)
             self.data_conn.sendall(lsts.encode())
             self.close_data_conn()
+            if len(lines) >= limit:
+                return self.response(226, f"Listing truncated after {len(lines)} entries")
+            return self.response(226)
+        except PermissionError as e:
+            self.close_data_conn()
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+
+    def list_recursive(self, path):
+        """
+        Stream a recursive listing (`LIST -R`) over the data connection.
+
+        Args:
+            path (str): Directory to list.
+
+        Returns:
+            str: FTP response line.
+        """
+        config = self.server.config
+        try:
+            walk = self.fileman.ls_recursive(path, config.list_max_depth, config.list_max_entries)
+            self.open_data_conn()
+            count = 0
+            for rel, lines in walk:
+                header = path if rel == '.' else f"{path.rstrip('/')}/{rel}"
+                block = '\r\n'.join([f"{header}:", *lines, '', ''])
+                self.data_conn.sendall(block.encode())
+                count += len(lines)
+            self.server.lgr.debug(f"Sent recursive listing of {count} entries to {self.client_addr()}")
+            self.close_data_conn()
+            if count >= config.list_max_entries:
+                return self.response(226, f"Listing truncated after {count} entries")
             return self.response(226)
+        except FileNotFoundError:
+            self.close_data_conn()
+            return self.response(550, obj_kind="Directory", fname=path)
+        except NotADirectoryError:
+            self.close_data_conn()
+            return self.response(550, msg=f"The directory name is invalid: {path!r}")
         except PermissionError as e:
+            self.close_data_conn()
             self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
             return self.response(550, msg=e)
 
@@ -327,21 +635,34 @@ class ThinFTP(socketserver.BaseRequestHandler):
         if not self.data_sock:
             return self.response(503, cmd='PASV')
         try:
-            self.open_data_conn()
-            self.response(150)
-            self.server.lgr.debug(f"Sending to client {self.client_addr()} via Data conn:")
-            for chunk in self.fileman.read(fname, self.transfer_type):
-                self.data_conn.sendall(chunk)
-            try:
-                data = chunk.decode('utf-8', errors='replace')
-                self.server.lgr.debug("The file ends as follows: \n" + data)
-            except UnboundLocalError:
-                pass
-            self.close_data_conn()
+            path = self.fileman.local_path(fname)
+            # Large files may have to wait for a slot of their disk, which
+            # is only taken once the client has connected
+            self.accept_data_conn()
+            with self.server.scheduler.slot(path):
+                self.open_data_conn(accept=False)
+                self.server.lgr.debug(f"Sending to client {self.client_addr()} via Data conn:")
+                hooks = self.server.hooks
+                for chunk in self.fileman.read(fname, self.transfer_type, self.chunk_size):
+                    self.data_conn.sendall(chunk)
+                    if hooks.on_transfer_chunk:
+                        hooks.fire('on_transfer_chunk', self, 'send', len(chunk))
+                try:
+                    data = chunk.decode('utf-8', errors='replace')
+                    self.server.lgr.debug("The file ends as follows: \n" + data)
+                except UnboundLocalError:
+                    pass
+                self.close_data_conn()
             return self.response(226)
+        except TransferDeferred as e:
+            self.close_data_conn()
+            self.server.lgr.info(f"Deferred download of {fname!r} by {self.client_addr()}: {e}")
+            return self.response(450, msg=e)
         except FileNotFoundError:
+            self.close_data_conn()
             return self.response(550, obj_kind="File", fname=fname)
         except PermissionError as e:
+            self.close_data_conn()
             self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
             return self.response(550, msg=e)
     
@@ -349,31 +670,156 @@ class ThinFTP(socketserver.BaseRequestHandler):
         """
         Handle the STOR command to upload a file.
 
+        The digests configured in `upload_digests` are computed while the
+        file is written, cached like those of HASH, and reported in the 226
+        reply as `<algo>=<hex>` pairs. After SITE EXPECT, an upload that
+        does not match the announced digest is rejected with 550, leaving
+        any existing file untouched.
+
         Args:
             fname (str): File to store.
 
+        Returns:
+            str: FTP response line.
+        """
+        return self.receive_file(fname)
+
+    def ftp_appe(self, fname):
+        """
+        Handle the APPE command to append to a file, creating it if needed.
+
+        Concurrent appends to the same file are serialized, each landing in
+        one piece.
+
+        Args:
+            fname (str): File to append to.
+
+        Returns:
+            str: FTP response line.
+        """
+        return self.receive_file(fname, append=True)
+
+    def ftp_stou(self, fname=''):
+        """
+        Handle the STOU command to upload a file under a unique name.
+
+        The requested name is used if it is free, otherwise a variant of it.
+        The name chosen is announced in the 150 reply, as `150 FILE: <name>`
+        (RFC 1123).
+
+        Args:
+            fname (str): Optional name to base the unique name on.
+
         Returns:
             str: FTP response line.
         """
         if not self.data_sock:
             return self.response(503, cmd='PASV')
         try:
-            self.open_data_conn()
-            self.response(150)
+            name = self.fileman.create_unique(fname or None)
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except OSError as e:
+            return self.response(550, msg=e.strerror)
+        try:
+            return self.receive_file(name, announce=f"FILE: {name}")
+        except BaseException:
+            # The data connection failed: do not leave the name taken by an
+            # empty file
+            try:
+                if self.fileman.size(name) == 0:
+                    self.fileman.delete(name)
+            except (OSError, FileHandlerError):
+                pass
+            raise
+
+    def recv_data(self):
+        """
+        Receive the data connection's content in chunks, until the client
+        closes it.
+
+        Yields:
+            bytes: The received chunks.
+        """
+        hooks = self.server.hooks
+        while True:
+            chunk = self.data_conn.recv(self.chunk_size)
+            if not chunk:
+                break
+            if hooks.on_transfer_chunk:
+                hooks.fire('on_transfer_chunk', self, 'recv', len(chunk))
+            yield chunk
+
+    def receive_file(self, fname, append=False, announce=None):
+        """
+        Receive an upload over the data connection (STOR, APPE and STOU).
+
+        Args:
+            fname (str): File to write.
+            append (bool): Append to the file instead of replacing it.
+                Digests are neither computed nor checked then.
+            announce (str): Message of the 150 reply, instead of the default.
+
+        Returns:
+            str: FTP response line.
+        """
+        if not self.data_sock:
+            return self.response(503, cmd='PASV')
+        expected, self.expected_digest = self.expected_digest, None
+        try:
+            self.open_data_conn(announce)
             self.server.lgr.debug(f"Receiving from client {self.client_addr()} via Data conn:")
-            
-            def data_recv():
-                while True:
-                    chunk = self.data_conn.recv(8192)
-                    if not chunk:
-                        break
-                    yield chunk
-            self.fileman.write(fname, data_recv())
+            if append:
+                self.fileman.append(fname, self.recv_data())
+                self.close_data_conn()
+                return self.response(226)
+            digests = dict.fromkeys(self.server.config.upload_digests)
+            self.fileman.write(fname, self.recv_data(), digests, expected)
             self.close_data_conn()
-            return self.response(226)
+            if not digests:
+                return self.response(226)
+            self.remember_digests(fname, digests)
+            facts = ' '.join(f"{algo}={value}" for algo, value in digests.items())
+            return self.response(226, f"Closing data connection. {facts}", end='')
+        except QuotaExceeded as e:
+            self.close_data_conn()
+            self.server.lgr.info(f"Aborted upload of {fname!r} by {self.client_addr()}: {e}")
+            return self.response(552, msg=e)
+        except DigestMismatch as e:
+            self.close_data_conn()
+            self.server.lgr.info(f"Rejected upload of {fname!r} by {self.client_addr()}: {e}")
+            return self.response(550, msg=f"Upload rejected: {e}")
         except PermissionError as e:
+            self.close_data_conn()
             self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
             return self.response(550, msg=e)
+        except (ConnectionError, ssl.SSLError):
+            # The data (or control) connection broke: end the session
+            self.close_data_conn()
+            raise
+        except OSError as e:
+            # E.g. uploading to a directory, or into a missing one
+            self.close_data_conn()
+            return self.response(550, msg=e.strerror or e)
+
+    def remember_digests(self, fname, digests):
+        """
+        Cache the digests computed during an upload, so that HASH and the
+        X* commands answer without reading the file again.
+
+        Args:
+            fname (str): The uploaded file.
+            digests (dict): Algorithm names mapped to hex digests.
+        """
+        try:
+            stats = self.fileman.stat(fname)
+            path = self.fileman.local_path(fname)
+        except (OSError, FileHandlerError):
+            return
+        cache = self.server.digests
+        for algo, value in digests.items():
+            cache.remember(cache.make_key(stats, algo, 0, None), value, path)
 
     def ftp_size(self, fname):
         """
@@ -387,13 +833,129 @@ class ThinFTP(socketserver.BaseRequestHandler):
         """
         try:
             size = self.fileman.size(fname)
-            return self.response(213, msg=size)
+            return self.response(213, msg=size, end='')
         except PermissionError as e:
             self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
             return self.response(550, msg=e)
         except FileHandlerError as e:
             return self.response(550, msg=e)
 
+    def ftp_mdtm(self, fname):
+        """
+        Handle the MDTM command (RFC 3659) to get a file's modification time.
+
+        Args:
+            fname (str): File to check.
+
+        Returns:
+            str: FTP response line, in the form `213 YYYYMMDDHHMMSS` (UTC).
+        """
+        try:
+            stats = self.fileman.stat(fname)
+        except FileNotFoundError:
+            return self.response(550, obj_kind="File", fname=fname)
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        if not stat.S_ISREG(stats.st_mode):
+            return self.response(550, msg=f"Not a file: {fname!r}")
+        return self.response(213, format_time(stats.st_mtime), end='')
+
+    def ftp_stat(self, *args):
+        """
+        Handle the STAT command.
+
+        Without arguments, the status of the session is reported. With a
+        path, its listing is sent inline on the control connection, in the
+        same format as LIST, so that no data connection is needed. The `-R`
+        option lists the whole tree below the path. A listing cut short by
+        `list_max_entries` ends with a truncation notice instead of "End".
+
+        Args:
+            *args: Options and path to list.
+
+        Returns:
+            str: FTP response line.
+        """
+        if not args:
+            return self.stat_session()
+        opts, path = self.parse_list_args(args)
+        config = self.server.config
+        try:
+            if 'R' in opts:
+                walk = self.fileman.ls_recursive(path, config.list_max_depth, config.list_max_entries)
+                # The first block is read before replying, so that errors
+                # on the path itself still get a single-line reply
+                first = next(walk, None)
+                if first is None:
+                    # Nothing matching the path
+                    return self.response(550, obj_kind="File", fname=path)
+                blocks = [first]
+            else:
+                lines = self.fileman.ls(path, config.list_max_entries)
+                if not lines:
+                    # An empty directory, or nothing matching the path
+                    self.fileman.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return self.response(550, obj_kind="File", fname=path)
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+
+        self.response(213, f"-Status of {path}", end=':')
+        if 'R' in opts:
+            count = 0
+            for rel, lines in chain(blocks, walk):
+                header = path if rel == '.' else f"{path.rstrip('/')}/{rel}"
+                self.request.sendall(''.join(f" {ln}\r\n" for ln in [f"{header}:", *lines, '']).encode())
+                count += len(lines)
+        else:
+            self.request.sendall(''.join(f" {ln}\r\n" for ln in lines).encode())
+            count = len(lines)
+        if count >= config.list_max_entries:
+            return self.response(213, f"Listing truncated after {count} entries")
+        return self.response(213, "End")
+
+    def stat_session(self):
+        """
+        Report the status of the session, as `STAT` without arguments.
+
+        Returns:
+            str: FTP response line.
+        """
+        status = [
+            f"Connected from {self.client_addr()}",
+            f"Logged in as {self.user.name}",
+            f"TYPE: {'ASCII' if self.transfer_type == 'A' else 'BINARY'}",
+            f"Control connection: {self.request.version() if self.is_tls() else 'clear'}",
+            f"Data protection: {'private' if self.prot == 'P' else 'clear'}",
+            f"Passive listener: {'open' if self.data_sock else 'none'}",
+        ]
+        self.response(211, custom='thinFTP status')
+        self.request.sendall(''.join(f" {ln}\r\n" for ln in status).encode())
+        return self.response(211, msg="End")
+
+    def ftp_allo(self, size, *args):
+        """
+        Handle the ALLO command, checking that an upload fits in the quota.
+
+        Args:
+            size (str): Number of bytes about to be uploaded.
+            *args: The optional record size (`R <size>`), ignored.
+
+        Returns:
+            str: FTP response line.
+        """
+        if not size.isdigit():
+            return self.response(501)
+        quota, usage = self.fileman.quota, self.fileman.usage
+        if quota is None:
+            return self.response(202, 'No storage allocation necessary')
+        left = quota - usage.used - usage.reserved
+        if int(size) > left:
+            return self.response(552, f"Not enough space: {max(left, 0)} bytes left in quota")
+        return self.response(200, cmd='ALLO')
+
     def ftp_dele(self, fname):
         """
         Handle the DELE command to delete a file.
@@ -468,98 +1030,1030 @@ class ThinFTP(socketserver.BaseRequestHandler):
             return self.response(250, "File renamed")
         except FileNotFoundError:
             return self.response(550, obj_kind="File", fname=new)
+        except IsADirectoryError:
+            return self.response(550, msg=f"Cannot replace a directory with a file: {new!r}")
+        except NotADirectoryError:
+            return self.response(550, msg=f"Cannot replace a file with a directory: {new!r}")
+        except FileExistsError:
+            return self.response(550, msg=f"Directory not empty: {new!r}")
         except PermissionError as e:
             self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
             return self.response(550, msg=e)
+        except OSError as e:
+            return self.response(550, msg=e.strerror or e)
     
-    def ftp_feat(self):
+    def ftp_opts(self, kind, *args):
         """
-        Handle the FEAT command to list supported features.
+        Handle the OPTS command to set options of other commands.
+
+        `OPTS HASH <algo>` selects the algorithm used by HASH; `OPTS HASH`
+        alone reports the current one. Other options are accepted as is.
+
+        Args:
+            kind (str): The command whose options are set.
+            *args: The options.
 
         Returns:
             str: FTP response line.
         """
-        features = ('PASV', 'SIZE', 'UTF8')
-        self.response(211, custom='Features')
-        for feat in features:
-            self.request.sendall(f" {feat}\r\n".encode())
-        return self.response(211, msg="End")
-    
-    def ftp_help(self, *args):
+        if kind.upper() != 'HASH':
+            return self.response(200, cmd='OPTS')
+        if not args:
+            return self.response(200, self.hash_algo, end='')
+        algo = args[0].upper()
+        if algo not in ALGORITHMS:
+            return self.response(504, f"Unknown algorithm {args[0]!r}")
+        self.hash_algo = algo
+        return self.response(200, algo, end='')
+
+    def ftp_rang(self, start, end):
         """
-        Handle the HELP command.
+        Handle the RANG command to set the byte range of the next HASH.
 
         Args:
-            *args: Optional command to get help for.
+            start (str): First byte of the range.
+            end (str): Last byte of the range, inclusive. `RANG 1 0` resets
+                the range.
 
         Returns:
             str: FTP response line.
         """
-        if args:
-            cmd = args[0].upper()
-            return self.response(214, f"No Detailed help available for {cmd}")
-        cmds = sorted(self.verb_map.keys())
-        cmd_ln = [cmds[i:i+8] for i in range(0, len(cmds), 8)]
-        self.response(214, custom='The following commands are implemented')
-        for ln in cmd_ln:
-            self.request.sendall(f" {' '.join(ln)}\r\n".encode())
-        return self.response(214, "Help OK")
-
-    def ftp_nlst(self, path='.'):
+        try:
+            start, end = int(start), int(end)
+        except ValueError:
+            return self.response(501)
+        if (start, end) == (1, 0):
+            self.hash_range = None
+            return self.response(350, "Restarting at 0. End byte range at EOF")
+        if start < 0 or end < start:
+            return self.response(501)
+        self.hash_range = (start, end + 1)
+        return self.response(350, f"Restarting at {start}. End byte range at {end}")
+
+    def ftp_hash(self, fname):
         """
-        Handle the NLST command to list names only.
+        Handle the HASH command (draft-bryan-ftpext-hash) to get a file's digest.
 
         Args:
-            path (str): Path to list. Defaults to '.'.
+            fname (str): File to digest.
 
         Returns:
-            str: FTP response line.
+            str: FTP response line, in the form
+            `213 <algo> <start>-<end> <digest> <fname>`.
         """
-        if not self.data_sock:
-            return self.response(503, cmd='PASV')
+        start, end = self.hash_range or (0, None)
+        self.hash_range = None
         try:
-            lsts = '\r\n'.join([x.name for x in self.fileman.name_ls(path)])
-            self.open_data_conn()
-            self.response(150)
-            self.server.lgr.debug(f"Sending to client {self.client_addr()} via Data conn: \n" + lsts)
-            self.data_conn.sendall(lsts.encode())
-            self.close_data_conn()
-            return self.response(226)
+            digest = self.server.digests.digest(self.fileman, fname, self.hash_algo, start, end)
+            size = self.fileman.stat(fname).st_size
+        except FileNotFoundError:
+            return self.response(550, obj_kind="File", fname=fname)
         except PermissionError as e:
             self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
             return self.response(550, msg=e)
-    
-                         
-    def ftp_quit(self):
+        except FileHandlerError as e:
+            return self.response(550, msg=e)
+        last = max(min(end, size) - 1 if end is not None else size - 1, start)
+        return self.response(213, f"{self.hash_algo} {start}-{last} {digest} {fname}", end='')
+
+    def ftp_xhash(self, algo, *args):
         """
-        Handle the QUIT command to end the session.
+        Handle the XCRC, XMD5, XSHA1 and XSHA256 commands.
+
+        Args:
+            algo (str): The algorithm implied by the command.
+            *args: The file name, optionally followed by a start offset and
+                an end offset (exclusive).
 
         Returns:
-            None
+            str: FTP response line, in the form `250 <digest>`.
+        """
+        if not args:
+            return self.response(501)
+        args = list(args)
+        offsets = []
+        while len(args) > 1 and len(offsets) < 2 and args[-1].isdigit():
+            offsets.insert(0, int(args.pop()))
+        fname = ' '.join(args)
+        start = offsets[0] if offsets else 0
+        end = offsets[1] if len(offsets) > 1 and offsets[1] > 0 else None
+        try:
+            digest = self.server.digests.digest(self.fileman, fname, algo, start, end)
+            return self.response(250, digest, end='')
+        except FileNotFoundError:
+            return self.response(550, obj_kind="File", fname=fname)
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except FileHandlerError as e:
+            return self.response(550, msg=e)
 
-        Raises:
-            ClientQuit: Raised to break from the main loop.
+    def ftp_xcrc(self, *args):
         """
-        self.response(221)
-        raise ClientQuit
+        Handle the XCRC command. See `ftp_xhash`.
+        """
+        return self.ftp_xhash('CRC32', *args)
 
-    def open_data_conn(self):
+    def ftp_xmd5(self, *args):
         """
-        Accepts the incoming data connection from the client.
+        Handle the XMD5 command. See `ftp_xhash`.
         """
-        if self.data_conn:
+        return self.ftp_xhash('MD5', *args)
+
+    def ftp_xsha1(self, *args):
+        """
+        Handle the XSHA1 command. See `ftp_xhash`.
+        """
+        return self.ftp_xhash('SHA-1', *args)
+
+    def ftp_xsha256(self, *args):
+        """
+        Handle the XSHA256 command. See `ftp_xhash`.
+        """
+        return self.ftp_xhash('SHA-256', *args)
+
+    def ftp_site(self, args):
+        """
+        Handle the SITE command by dispatching to its subcommands.
+
+        Args:
+            args (str): The subcommand followed by its arguments.
+
+        Returns:
+            str: FTP response line.
+        """
+        sub, _, rest = args.strip().partition(' ')
+        sub = sub.upper()
+        site_map = {
+            'CPFR': self.site_cpfr,
+            'CPTO': self.site_cpto,
+            'CPSTAT': self.site_cpstat,
+            'STATMANY': self.site_statmany,
+            'DIAG': self.site_diag,
+            'QUOTA': self.site_quota,
+            'DU': self.site_du,
+            'FIND': self.site_find,
+            'EXPECT': self.site_expect,
+            'RETRTAR': self.site_retrtar,
+            'STORTAR': self.site_stortar,
+            'HOSTS': self.site_hosts,
+            'RMTREE': self.site_rmtree,
+            'CHMOD': self.site_chmod,
+        }
+        site_write_cmds = ('CPTO', 'STORTAR', 'RMTREE', 'CHMOD')
+        site_admin_cmds = ('DIAG', 'HOSTS')
+
+        if not sub:
+            return self.response(501)
+        fn = site_map.get(sub)
+        if not fn:
+            return self.response(502, cmd=f"SITE {sub}")
+        if (sub in site_write_cmds) and not self.user.writable:
+            return self.response(550, 'Permission denied')
+        if (sub in site_admin_cmds) and not self.user.admin:
+            return self.response(550, 'Permission denied')
+        return fn(rest.strip())
+
+    def site_cpfr(self, old):
+        """
+        Handle SITE CPFR (copy from), the first half of a server-side copy.
+
+        Args:
+            old (str): Existing file/directory name.
+
+        Returns:
+            str: FTP response line.
+        """
+        try:
+            self.fileman.copy_from(old)
+            return self.response(350, cmd='SITE CPTO')
+        except FileNotFoundError:
+            return self.response(550, obj_kind="File", fname=old)
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except FileHandlerError as e:
+            return self.response(550, msg=e)
+
+    def site_cpto(self, new):
+        """
+        Handle SITE CPTO (copy to), starting the copy marked by SITE CPFR.
+
+        Directories are copied recursively. The copy runs in the background,
+        so the control connection stays responsive; SITE CPSTAT reports
+        its progress.
+
+        Args:
+            new (str): Destination name.
+
+        Returns:
+            str: FTP response line.
+        """
+        if not self.fileman.cp_old:
+            return self.response(503, cmd='SITE CPFR')
+        try:
+            job = self.fileman.copy_to(new)
+        except FileExistsError:
+            return self.response(550, msg=f"{self.fileman.get_abs(new)}: Already exists")
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except FileHandlerError as e:
+            return self.response(550, msg=e)
+
+        num = self.copy_jobs[-1][0] + 1 if self.copy_jobs else 1
+        dest = self.fileman.get_abs(new)
+        lgr = self.server.lgr
+        client = self.client_addr()
+
+        def report(fut):
+            if fut.exception():
+                lgr.error(f"Copy job {num} of {client} to {dest} failed: {fut.exception()}")
+            else:
+                lgr.info(f"Copy job {num} of {client} to {dest} finished")
+
+        fut = self.server.copy_pool.submit(job)
+        fut.add_done_callback(report)
+        self.copy_jobs = [j for j in self.copy_jobs if not j[2].done()][-31:]
+        self.copy_jobs.append((num, dest, fut))
+        return self.response(200, f"Copy to {dest} started as job {num}")
+
+    def site_cpstat(self, _=''):
+        """
+        Handle SITE CPSTAT, reporting the state of this session's copies.
+
+        Returns:
+            str: FTP response line.
+        """
+        self.response(211, custom='Copy jobs')
+        for num, dest, fut in self.copy_jobs:
+            if not fut.done():
+                state = 'running'
+            elif fut.exception():
+                state = f'failed: {fut.exception()}'
+            else:
+                state = 'done'
+            self.request.sendall(f" {num} {dest} {state}\r\n".encode())
+        return self.response(211, msg="End")
+
+    def site_statmany(self, args):
+        """
+        Handle SITE STATMANY, reporting the type, size and modification time
+        of many paths in a single reply.
+
+        Paths are separated by spaces; paths containing spaces must be
+        quoted, as in a shell. Each path gets one line of RFC 3659 style
+        facts, followed by a space and the path:
+
+            type=file;size=1024;modify=20250602120000; data/a.csv
+            error=not-found; data/b.csv
+
+        Args:
+            args (str): The paths to query.
+
+        Returns:
+            str: FTP response line.
+        """
+        try:
+            paths = shlex.split(args)
+        except ValueError:
+            return self.response(501)
+        if not paths:
+            return self.response(501)
+        limit = self.server.config.statmany_max_paths
+        if len(paths) > limit:
+            return self.response(501, f"At most {limit} paths per request")
+
+        lines = []
+        for path in paths:
+            try:
+                stats = self.fileman.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                lines.append(f" error=not-found; {path}\r\n")
+                continue
+            except PermissionError:
+                lines.append(f" error=permission-denied; {path}\r\n")
+                continue
+            except OSError:
+                lines.append(f" error=failed; {path}\r\n")
+                continue
+            kind = 'dir' if stat.S_ISDIR(stats.st_mode) else 'file'
+            lines.append(f" type={kind};size={stats.st_size};modify={format_time(stats.st_mtime)}; {path}\r\n")
+        self.response(213, f"-Status of {len(paths)} paths", end=':')
+        self.request.sendall(''.join(lines).encode())
+        return self.response(213, "End")
+
+    def usage_index(self):
+        """
+        Get the usage index of the user's home, creating it if the user
+        has no quota.
+
+        Returns:
+            UsageIndex: The index, or None if the backend is not the local disk.
+        """
+        if self.fileman.usage is not None:
+            return self.fileman.usage
+        if self.fileman.local_path('/') is None:
+            return None
+        return self.server.quotas.index_for(self.user.home)
+
+    def site_quota(self, _=''):
+        """
+        Handle SITE QUOTA, reporting the user's disk usage and quota.
+
+        Returns:
+            str: FTP response line.
+        """
+        usage = self.usage_index()
+        if usage is None:
+            return self.response(550, 'Disk usage is not available with this backend')
+        quota = self.fileman.quota
+        lines = [f"Used: {usage.used} bytes in {usage.files} files"]
+        if not usage.ready.is_set():
+            lines[0] += " (still measuring)"
+        if quota is None:
+            lines.append("Quota: none")
+        else:
+            lines.append(f"Quota: {quota} bytes")
+            lines.append(f"Available: {max(quota - usage.used, 0)} bytes")
+        self.response(211, custom=f'Quota of {self.user.name}')
+        self.request.sendall(''.join(f" {ln}\r\n" for ln in lines).encode())
+        return self.response(211, msg="End")
+
+    def site_du(self, _=''):
+        """
+        Handle SITE DU, reporting the disk usage of the user's home.
+
+        Returns:
+            str: FTP response line, in the form `213 <bytes> <files>`.
+        """
+        usage = self.usage_index()
+        if usage is None:
+            return self.response(550, 'Disk usage is not available with this backend')
+        return self.response(213, f"{usage.used} {usage.files}", end='')
+
+    def site_expect(self, args):
+        """
+        Handle SITE EXPECT, announcing the digest of the next upload.
+
+        Syntax: `SITE EXPECT <algo> <hex digest>`, with an algorithm of
+        OPTS HASH. The next STOR is rejected unless its data matches.
+
+        Args:
+            args (str): Algorithm and digest.
+
+        Returns:
+            str: FTP response line.
+        """
+        try:
+            algo, value = args.split()
+        except ValueError:
+            return self.response(501)
+        algo = algo.upper()
+        if algo not in ALGORITHMS:
+            return self.response(504, f"Unknown algorithm {algo}")
+        if not all(c in '0123456789abcdefABCDEF' for c in value):
+            return self.response(501)
+        digits = new_hash(algo).digest_size * 2
+        if len(value) != digits:
+            return self.response(501, f"A {algo} digest has {digits} hex digits")
+        self.expected_digest = (algo, value.lower())
+        return self.response(200, f"Next upload must match {algo} {value.lower()}")
+
+    def refuse_data_conn(self):
+        """
+        Check that a SITE subcommand may use the data connection, like the
+        data transfer commands.
+
+        Returns:
+            str: The FTP response line refusing it, or None if it may.
+        """
+        if not self.data_sock:
+            return self.response(503, cmd='PASV')
+        if self.server.config.tls_required and self.prot != 'P':
+            return self.response(521, 'Data connections must be protected. Use PROT P')
+        return None
+
+    def site_retrtar(self, args):
+        """
+        Handle SITE RETRTAR, sending a whole directory as a tar stream over
+        a single data connection.
+
+        Syntax: `SITE RETRTAR [-z] <dir>`, where `-z` compresses the stream
+        with gzip. Member names are relative to the directory.
+
+        Args:
+            args (str): Options and directory.
+
+        Returns:
+            str: FTP response line.
+        """
+        compress = args.startswith('-z ') or args == '-z'
+        path = args[2:].strip() if compress else args
+        path = path or '.'
+        refused = self.refuse_data_conn()
+        if refused:
+            return refused
+        try:
+            if not stat.S_ISDIR(self.fileman.stat(path).st_mode):
+                return self.response(550, msg=f"Not a directory: {path}")
+            self.open_data_conn()
+            hooks = self.server.hooks
+
+            def send(chunk):
+                self.data_conn.sendall(chunk)
+                if hooks.on_transfer_chunk:
+                    hooks.fire('on_transfer_chunk', self, 'send', len(chunk))
+            count = send_tar(self.fileman, path, ChunkWriter(send), compress)
+            self.close_data_conn()
+            self.server.lgr.debug(f"Sent {count} entries of {path!r} as tar to {self.client_addr()}")
+            return self.response(226, f"Sent {count} entries")
+        except FileNotFoundError:
+            return self.response(550, obj_kind="Directory", fname=path)
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except FileHandlerError as e:
+            return self.response(550, msg=e)
+
+    def site_stortar(self, path):
+        """
+        Handle SITE STORTAR, extracting a tar stream received over a single
+        data connection into a directory, created if needed.
+
+        The stream may be gzip-compressed. Only regular files and
+        directories are extracted, and never outside the directory; other
+        members are skipped. Each file is written like an upload, so quotas
+        apply.
+
+        Args:
+            path (str): Target directory.
+
+        Returns:
+            str: FTP response line.
+        """
+        path = path or '.'
+        refused = self.refuse_data_conn()
+        if refused:
+            return refused
+        try:
+            self.open_data_conn()
+            with self.data_conn.makefile('rb') as inp:
+                files, dirs, skipped = receive_tar(self.fileman, path, inp)
+            self.close_data_conn()
+            self.server.lgr.debug(f"Extracted {files} files from {self.client_addr()} into {path!r}")
+            msg = f"Extracted {files} files and {dirs} directories"
+            if skipped:
+                msg += f", skipped {skipped} unsafe or special entries"
+            return self.response(226, msg)
+        except QuotaExceeded as e:
+            self.close_data_conn()
+            self.server.lgr.info(f"Aborted archive upload into {path!r} by {self.client_addr()}: {e}")
+            return self.response(552, msg=e)
+        except tarfile.TarError as e:
+            self.close_data_conn()
+            return self.response(550, msg=f"Invalid archive: {e}")
+        except PermissionError as e:
+            self.close_data_conn()
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except (OSError, FileHandlerError) as e:
+            self.close_data_conn()
+            return self.response(550, msg=e)
+
+    def site_find(self, args):
+        """
+        Handle SITE FIND, searching the user's home for files by name.
+
+        The matching paths are streamed over the data connection, one per
+        line, as absolute paths; directories end with '/'. They come from
+        the server's filename index, so files changed outside of thinFTP may
+        only show up after its next rescan.
+
+        Syntax: `SITE FIND [-n LIMIT] <pattern>`, where a pattern containing
+        `*`, `?` or `[` is a case-sensitive wildcard matched against whole
+        names, and any other pattern is a case-insensitive substring.
+
+        Args:
+            args (str): Options and pattern.
+
+        Returns:
+            str: FTP response line.
+        """
+        config = self.server.config
+        index = self.server.name_index
+        if index is None:
+            return self.response(550, 'The filename index is not enabled')
+        limit = config.find_max_results
+        opt, _, rest = args.partition(' ')
+        if opt == '-n':
+            num, _, args = rest.strip().partition(' ')
+            if not num.isdigit():
+                return self.response(501)
+            limit = min(int(num), limit)
+        pattern = args.strip()
+        if not pattern:
+            return self.response(501)
+        refused = self.refuse_data_conn()
+        if refused:
+            return refused
+        home = self.fileman.local_path('/')
+        if home is None or not home.is_relative_to(index.root):
+            return self.response(550, 'The filename index does not cover this directory')
+        if not index.ready.is_set():
+            return self.response(450, 'The filename index is still being built. Try again later')
+
+        prefix = home.relative_to(index.root).as_posix() + '/' if home != index.root else ''
+        self.open_data_conn()
+        count = 0
+        batch = []
+        for path in index.search(pattern, prefix, limit):
+            batch.append(f"/{path}\r\n")
+            count += 1
+            if len(batch) == 256:
+                self.data_conn.sendall(''.join(batch).encode(errors='surrogateescape'))
+                batch = []
+        self.data_conn.sendall(''.join(batch).encode(errors='surrogateescape'))
+        self.close_data_conn()
+        self.server.lgr.debug(f"SITE FIND {pattern!r} of {self.client_addr()} matched {count} paths")
+        if count >= limit:
+            return self.response(226, f"Stopped at the limit of {limit} matches")
+        return self.response(226, f"Found {count} matches")
+
+    def site_diag(self, args):
+        """
+        Handle SITE DIAG, the admin command switching diagnostics on and off
+        at runtime:
+
+            SITE DIAG                        state of the diagnostics
+            SITE DIAG PROFILE ON|OFF         sampling profiler, dumped when OFF
+            SITE DIAG MEMORY ON|SNAPSHOT|OFF tracemalloc snapshots
+            SITE DIAG TRACE <user|ip>|OFF    per-session tracing to the log
+
+        Args:
+            args (str): The tool and the action.
+
+        Returns:
+            str: FTP response line.
+        """
+        diag = self.server.diagnostics
+        words = args.split()
+        if not words:
+            self.response(211, custom='Diagnostics')
+            lines = diag.status() + self.server.cache_policy.status() + self.server.scheduler.status()
+            self.request.sendall(''.join(f" {ln}\r\n" for ln in lines).encode())
+            return self.response(211, msg="End")
+        if len(words) != 2:
+            return self.response(501)
+        tool, action = words[0].upper(), words[1]
+        try:
+            if tool == 'PROFILE' and action.upper() == 'ON':
+                if not diag.start_profiler():
+                    return self.response(503, 'Profiler is already running')
+                return self.response(200, 'Profiler started')
+            if tool == 'PROFILE' and action.upper() == 'OFF':
+                path = diag.stop_profiler()
+                if path is None:
+                    return self.response(503, 'Profiler is not running')
+                return self.response(200, f"Profile written to {path}")
+            if tool == 'MEMORY' and action.upper() == 'ON':
+                if not diag.start_memory():
+                    return self.response(503, 'Memory tracing is already on')
+                return self.response(200, 'Memory tracing started')
+            if tool == 'MEMORY' and action.upper() == 'SNAPSHOT':
+                path = diag.snapshot_memory()
+                if path is None:
+                    return self.response(503, 'Memory tracing is off')
+                return self.response(200, f"Snapshot written to {path}")
+            if tool == 'MEMORY' and action.upper() == 'OFF':
+                if not diag.stop_memory():
+                    return self.response(503, 'Memory tracing is off')
+                return self.response(200, 'Memory tracing stopped')
+            if tool == 'TRACE' and action.upper() == 'OFF':
+                if not diag.untrace():
+                    return self.response(503, 'No sessions are traced')
+                return self.response(200, 'Tracing stopped')
+            if tool == 'TRACE':
+                diag.trace(action)
+                return self.response(200, f"Tracing sessions of {action}")
+        except OSError as e:
+            self.server.lgr.error(f"Failed to write diagnostics dump: {e}")
+            return self.response(550, msg=e)
+        return self.response(501)
+
+    def site_rmtree(self, path):
+        """
+        Handle SITE RMTREE, removing a directory and everything in it on
+        the server. See `run_tree_op` for the replies.
+
+        Args:
+            path (str): The directory to remove.
+
+        Returns:
+            str: FTP response line.
+        """
+        if not path:
+            return self.response(501)
+        try:
+            op = self.fileman.remove_tree(path)
+        except FileNotFoundError:
+            return self.response(550, obj_kind="Directory", fname=path)
+        except NotADirectoryError:
+            return self.response(550, msg=f"The directory name is invalid: {path!r}")
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except FileHandlerError as e:
+            return self.response(550, msg=e)
+        return self.run_tree_op(op, f"Removing {path}", "Removed")
+
+    def site_chmod(self, args):
+        """
+        Handle SITE CHMOD, changing the permission bits of a file or
+        directory, or with `-R` of a whole tree (see `run_tree_op`).
+
+        Syntax: `SITE CHMOD [-R] <mode> <path>`, the mode being octal.
+
+        Args:
+            args (str): Options, mode and path.
+
+        Returns:
+            str: FTP response line.
+        """
+        recursive = args.startswith('-R ')
+        if recursive:
+            args = args[3:].lstrip()
+        mode, _, path = args.partition(' ')
+        path = path.strip()
+        if not path or not 1 <= len(mode) <= 4 or mode.strip('01234567'):
+            return self.response(501)
+        try:
+            op = self.fileman.chmod(path, int(mode, 8), recursive)
+        except FileNotFoundError:
+            return self.response(550, obj_kind="File", fname=path)
+        except PermissionError as e:
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+        except (FileHandlerError, OSError) as e:
+            return self.response(550, msg=e)
+        if op is None:
+            return self.response(200, cmd='SITE CHMOD')
+        return self.run_tree_op(op, f"Changing the mode of {path}", "Changed")
+
+    def run_tree_op(self, op, title, verb):
+        """
+        Run a server-side tree operation, reporting its progress and
+        watching for ABOR.
+
+        The reply is 250 on success and 550 if some entries failed. If the
+        operation lasts longer than `PROGRESS_INTERVAL`, its progress is
+        sent as lines of a multi-line 250 reply, opened with `250-`, a line
+        every `PROGRESS_INTERVAL` seconds, and closed once the operation
+        has ended; as a multi-line reply keeps its code, failed entries are
+        then only counted in its last line. ABOR cancels the operation,
+        which then ends with 426 (or the multi-line reply, if opened),
+        followed by 226 for the ABOR. Other commands sent meanwhile are
+        refused with 503 after that.
+
+        Args:
+            op (TreeOperation): The operation.
+            title (str): What the operation does, for the first line.
+            verb (str): Past tense of the operation, for the final reply.
+
+        Returns:
+            str: FTP response line.
+        """
+        refused = []
+        opened = False
+        next_report = time.monotonic() + PROGRESS_INTERVAL
+        for _ in op.run():
+            if not op.cancelled and self.poll_abort(refused):
+                op.cancel()
+            if time.monotonic() >= next_report:
+                if not opened:
+                    self.request.sendall(f"250-{title}\r\n".encode())
+                    opened = True
+                self.request.sendall(f" {verb} {op.status()} so far\r\n".encode())
+                next_report = time.monotonic() + PROGRESS_INTERVAL
+        self.server.lgr.debug(f"{title} for {self.client_addr()}: {verb.lower()} {op.status()}")
+        if op.cancelled:
+            if opened:
+                self.response(250, f"Aborted: {verb.lower()} {op.status()}")
+            else:
+                self.response(426, 'Operation aborted')
+            resp = self.response(226, 'ABOR command successful')
+        elif op.errors:
+            failed = f"{op.errors} entries could not be processed"
+            if opened:
+                resp = self.response(250, f"{verb} {op.status()}: {failed}")
+            else:
+                resp = self.response(550, failed)
+        else:
+            resp = self.response(250, f"{verb} {op.status()}")
+        for _ in refused:
+            self.response(503, 'Command refused during a tree operation')
+        return resp
+
+    def peek_control(self):
+        """
+        Look at the input of the control connection without consuming it,
+        nor waiting for it.
+
+        Returns:
+            bytes: The input already received (which may end with a partial
+            line), b'' if the client disconnected, or None if there is
+            none.
+        """
+        readable = select.select([self.request], [], [], 0)[0]
+        timeout = self.request.gettimeout()
+        self.request.settimeout(0)
+        try:
+            data = self.conn.peek()
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return None
+        finally:
+            self.request.settimeout(timeout)
+        # A socket readable before the peek that had nothing is at its end
+        if not data and not readable:
+            return None
+        return data
+
+    def poll_abort(self, refused):
+        """
+        Read the commands the client sent, without waiting, during a
+        server-side operation.
+
+        Only complete lines are read, the input buffered by `self.conn`
+        included; a partial line is left to be read once the operation has
+        ended.
+
+        Args:
+            refused (list): Gets the commands other than ABOR.
+
+        Returns:
+            bool: True if ABOR was received, or the client disconnected.
+        """
+        while True:
+            data = self.peek_control()
+            if data is None or (data and b'\n' not in data):
+                return False
+            if not data:
+                return True
+            line = self.conn.readline()
+            # ABOR may come after Telnet "Interrupt Process" and "Synch" codes
+            cmd = line.translate(None, b'\xff\xf4\xf2').strip().upper()
+            if cmd == b'ABOR':
+                return True
+            refused.append(cmd)
+
+    def site_hosts(self, args):
+        """
+        Handle SITE HOSTS, the admin command reporting the sessions, logins,
+        commands and transferred bytes of each virtual host.
+
+        Args:
+            args (str): Unused.
+
+        Returns:
+            str: FTP response line.
+        """
+        vhosts = self.server.vhosts
+        if vhosts is None:
+            return self.response(550, 'Virtual hosts are not enabled')
+        self.response(211, custom='Virtual hosts')
+        lines = [host.status() for host in vhosts]
+        self.request.sendall(''.join(f" {ln}\r\n" for ln in lines).encode())
+        return self.response(211, msg="End")
+
+    def ftp_abor(self):
+        """
+        Handle the ABOR command outside of a server-side operation, which
+        is the only kind of command that can be aborted.
+
+        Returns:
+            str: FTP response line.
+        """
+        return self.response(226, 'No operation to abort')
+
+    def ftp_auth(self, mech):
+        """
+        Handle the AUTH command (RFC 4217) to secure the control connection.
+
+        Args:
+            mech (str): The security mechanism. Only TLS (or its alias SSL)
+                is supported.
+
+        Returns:
+            str: FTP response line.
+        """
+        if self.server.ssl_context is None:
+            return self.response(502, cmd='AUTH')
+        if mech.upper() not in ('TLS', 'TLS-C', 'SSL'):
+            return self.response(504, f"AUTH {mech} not supported")
+        if self.is_tls():
+            return self.response(503, 'Already using TLS')
+        resp = self.response(234, 'AUTH TLS successful')
+        self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        self.conn = self.request.makefile('rb', CONTROL_BUFFER_SIZE)
+        # A new security context resets the login state (RFC 4217, 4)
+        self.login_user = ''
+        self.server.lgr.debug(f"Control connection of {self.client_addr()} secured with {self.request.version()}")
+        return resp
+
+    def ftp_pbsz(self, size):
+        """
+        Handle the PBSZ command. The buffer size of TLS is always 0.
+
+        Args:
+            size (str): The requested protection buffer size.
+
+        Returns:
+            str: FTP response line.
+        """
+        if not self.is_tls():
+            return self.response(503, cmd='AUTH TLS')
+        self.pbsz = True
+        return self.response(200, 'PBSZ=0', end='')
+
+    def ftp_prot(self, level):
+        """
+        Handle the PROT command to set the data channel protection level.
+
+        Args:
+            level (str): 'C' (clear) or 'P' (private).
+
+        Returns:
+            str: FTP response line.
+        """
+        if not self.pbsz:
+            return self.response(503, cmd='PBSZ')
+        level = level.upper()
+        if level == 'P':
+            self.prot = 'P'
+            self.chunk_size = TLS_CHUNK_SIZE
+            return self.response(200, cmd='PROT')
+        if level == 'C':
+            if self.server.config.tls_required:
+                return self.response(534, 'Clear data connections are refused by policy')
+            self.prot = 'C'
+            self.chunk_size = CHUNK_SIZE
+            return self.response(200, cmd='PROT')
+        if level in ('S', 'E'):
+            return self.response(536, f"Protection level {level} not supported")
+        return self.response(504, f"Unknown protection level {level}")
+
+    def ftp_feat(self):
+        """
+        Handle the FEAT command to list supported features.
+
+        Returns:
+            str: FTP response line.
+        """
+        algos = ';'.join(f"{a}*" if a == self.hash_algo else a for a in ALGORITHMS)
+        features = ('PASV', 'SIZE', 'MDTM', 'UTF8', f'HASH {algos}', 'RANG STREAM',
+                    'XCRC', 'XMD5', 'XSHA1', 'XSHA256')
+        if self.server.ssl_context is not None:
+            features += ('AUTH TLS', 'PBSZ', 'PROT')
+        if self.server.vhosts is not None:
+            features += ('HOST',)
+        self.response(211, custom='Features')
+        for feat in features:
+            self.request.sendall(f" {feat}\r\n".encode())
+        return self.response(211, msg="End")
+    
+    def ftp_help(self, *args):
+        """
+        Handle the HELP command.
+
+        Args:
+            *args: Optional command to get help for.
+
+        Returns:
+            str: FTP response line.
+        """
+        if args:
+            cmd = args[0].upper()
+            return self.response(214, f"No Detailed help available for {cmd}")
+        cmds = sorted(self.verb_map.keys())
+        cmd_ln = [cmds[i:i+8] for i in range(0, len(cmds), 8)]
+        self.response(214, custom='The following commands are implemented')
+        for ln in cmd_ln:
+            self.request.sendall(f" {' '.join(ln)}\r\n".encode())
+        return self.response(214, "Help OK")
+
+    def ftp_nlst(self, *args):
+        """
+        Handle the NLST command to list names only.
+
+        Args:
+            *args: Options (ignored) and path to list. The path defaults to '.'.
+
+        Returns:
+            str: FTP response line.
+        """
+        if not self.data_sock:
+            return self.response(503, cmd='PASV')
+        _, path = self.parse_list_args(args)
+        limit = self.server.config.list_max_entries
+        try:
+            names = [x.name for x in self.fileman.name_ls(path, limit)]
+            lsts = '\r\n'.join(names)
+            self.open_data_conn()
+            self.server.lgr.debug(f"Sending to client {self.client_addr()} via Data conn: \n" + lsts)
+            self.data_conn.sendall(lsts.encode())
             self.close_data_conn()
+            if len(names) >= limit:
+                return self.response(226, f"Listing truncated after {len(names)} entries")
+            return self.response(226)
+        except PermissionError as e:
+            self.close_data_conn()
+            self.server.lgr.error(f"Attempt by client {self.client_addr()} to violate server: {e}")
+            return self.response(550, msg=e)
+    
+                         
+    def ftp_noop(self):
+        """
+        Handle the NOOP command.
+
+        Returns:
+            str: FTP response line.
+        """
+        return self.response(200, cmd='NOOP')
+
+    def ftp_syst(self):
+        """
+        Handle the SYST command.
+
+        Returns:
+            str: FTP response line.
+        """
+        return self.response(215, 'UNIX Type: L8')
+
+    def ftp_quit(self):
+        """
+        Handle the QUIT command to end the session.
+
+        Returns:
+            None
+
+        Raises:
+            ClientQuit: Raised to break from the main loop.
+        """
+        self.response(221)
+        raise ClientQuit
+
+    def accept_data_conn(self):
+        """
+        Accepts the incoming data connection from the client, ahead of
+        `open_data_conn`.
+        """
+        if self.data_conn is not None:
+            # Left over by a transfer that failed; the listening socket is
+            # the one just opened by PASV
+            self.data_conn.close()
+            self.data_conn = None
         self.data_conn, addr = self.data_sock.accept()
         self.server.lgr.debug(f"Accepted PASV Data connection from {addr}")
+
+    def open_data_conn(self, announce=None, accept=True):
+        """
+        Accepts the incoming data connection from the client and announces
+        the transfer with a 150 reply.
+
+        With PROT P, the TLS handshake on the data connection follows the
+        150 reply, as clients only start it once they have received it.
+
+        Args:
+            announce (str, optional): Machine-readable message of the 150
+                reply, instead of the default one.
+            accept (bool): Whether to accept the connection, rather than
+                use the one accepted by `accept_data_conn`.
+        """
+        if accept:
+            self.accept_data_conn()
+        if announce is None:
+            self.response(150)
+        else:
+            self.response(150, announce, end='')
+        if self.prot == 'P':
+            self.data_conn = self.server.ssl_context.wrap_socket(self.data_conn, server_side=True)
+            resumed = 'resumed' if self.data_conn.session_reused else 'new'
+            self.server.lgr.debug(f"Data connection secured with {resumed} TLS session")
     
     def close_data_conn(self):
         """
         Closes the current data connection and socket.
         """
-        if hasattr(self, 'data_sock'):
+        if self.data_sock is not None:
             self.data_sock.close()
             self.data_sock = None
-        if hasattr(self, 'data_conn'):
+        if self.data_conn is not None:
+            if isinstance(self.data_conn, ssl.SSLSocket):
+                # Send close_notify, so clients can tell the transfer is complete
+                try:
+                    self.data_conn.unwrap()
+                except (ssl.SSLError, OSError):
+                    pass
             self.data_conn.close()
             self.data_conn = None
         self.server.lgr.debug("Closed PASV Data connection")
@@ -0,0 +1,129 @@
+"""
+Instrumentation hooks for thinFTP.
+
+A `Hooks` registry holds the callbacks invoked at the instrumentation points
+of the server. Each event is stored as a tuple of callbacks, which is empty
+(and thus false) when nothing is registered, so call sites guard each event
+with a plain attribute test and cost nothing more than that::
+
+    if hooks.on_command_start:
+        hooks.fire('on_command_start', session, verb, args)
+
+Registering replaces the tuple instead of mutating it, so sessions iterate
+over callbacks without taking any lock.
+
+Events and the arguments their callbacks receive:
+
+- `on_connect(session)`: a client connected.
+- `on_disconnect(session)`: a client disconnected.
+- `on_command_start(session, verb, args)`: a command is about to run.
+- `on_command_end(session, verb, args, reply, elapsed)`: a command has
+  replied; `elapsed` is in seconds.
+- `on_transfer_chunk(session, direction, size)`: a chunk of `size` bytes was
+  sent ('send') or received ('recv') over the data connection.
+- `on_fs_op(backend, op, path, **info)`: a backend completed a modifying
+  operation: 'mkdir', 'write' (`size`, `replaced`), 'delete' (`size`),
+  'rmdir', 'rename' (`dest`, `replaced`) or 'copy' (`dest`). `replaced` is
+  the size of the file overwritten, if any. Paths are the backend's resolved
+  paths: `Path` objects for `FileHandler`, store paths for the memory
+  backend.
+
+Classes:
+    Hooks: Registry of instrumentation callbacks.
+"""
+
+import threading
+
+#: The events hooks can be registered for.
+EVENTS = ('on_connect', 'on_disconnect', 'on_command_start', 'on_command_end',
+          'on_transfer_chunk', 'on_fs_op')
+
+
+class Hooks:
+    """
+    Registry of instrumentation callbacks.
+
+    Each event of `EVENTS` is an attribute holding the tuple of callbacks
+    registered for it. Exceptions raised by callbacks are logged and do not
+    affect the session that fired the event.
+
+    Attributes:
+        lgr (logging.Logger): Logger for failing callbacks, or None.
+    """
+
+    def __init__(self, lgr=None):
+        """
+        Initialize an empty registry.
+
+        Parameters:
+            lgr (logging.Logger): Logger for failing callbacks.
+        """
+        self.lgr = lgr
+        self._lock = threading.Lock()
+        for event in EVENTS:
+            setattr(self, event, ())
+
+    def register(self, event, fn):
+        """
+        Register a callback for an event.
+
+        Parameters:
+            event (str): One of `EVENTS`.
+            fn (callable): The callback.
+
+        Raises:
+            ValueError: If the event is unknown.
+        """
+        if event not in EVENTS:
+            raise ValueError(f"Unknown event: {event!r}")
+        with self._lock:
+            setattr(self, event, getattr(self, event) + (fn,))
+
+    def unregister(self, event, fn):
+        """
+        Unregister a callback. Unknown callbacks are ignored.
+
+        Parameters:
+            event (str): One of `EVENTS`.
+            fn (callable): The callback.
+        """
+        with self._lock:
+            setattr(self, event, tuple(f for f in getattr(self, event) if f != fn))
+
+    def add(self, obj):
+        """
+        Register every method of an object named after an event.
+
+        Parameters:
+            obj: An object with some of the `on_*` methods of `EVENTS`.
+        """
+        for event in EVENTS:
+            if hasattr(obj, event):
+                self.register(event, getattr(obj, event))
+
+    def remove(self, obj):
+        """
+        Unregister the methods registered by `add`.
+
+        Parameters:
+            obj: An object previously passed to `add`.
+        """
+        for event in EVENTS:
+            if hasattr(obj, event):
+                self.unregister(event, getattr(obj, event))
+
+    def fire(self, event, *args, **kwargs):
+        """
+        Invoke the callbacks of an event.
+
+        Parameters:
+            event (str): One of `EVENTS`.
+            *args: Positional arguments for the callbacks.
+            **kwargs: Keyword arguments for the callbacks.
+        """
+        for fn in getattr(self, event):
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                if self.lgr is not None:
+                    self.lgr.error(f"Hook {fn!r} failed on {event}: {e}")
@@ -0,0 +1,719 @@
+"""
+In-memory filesystem backend for thinFTP.
+
+This module provides a filesystem held entirely in RAM. It is useful for
+serving ephemeral, generated content at memory speed, and for benchmarks
+that need to measure protocol overhead without any disk I/O.
+
+A single `MemoryFS` store is shared by all sessions of a server, while each
+session gets its own `MemoryFileHandler` tracking its working directory.
+The store can be populated programmatically before or while serving::
+
+    server.memfs.write_file('/reports/today.csv', generate_report())
+
+Classes:
+    MemoryNode: A file or directory in the store.
+    MemoryFS: The shared, thread-safe in-memory tree.
+    MemoryFileHandler: `FileBackend` serving a `MemoryFS`.
+"""
+
+import io
+import itertools
+import os
+import posixpath
+import stat
+import threading
+import time
+from .backend import FileBackend
+from .errors import FileHandlerError
+from .treeops import YIELD_INTERVAL, TreeOperation
+from .wildcard import compile_pattern, has_magic
+
+_inodes = itertools.count(1)
+
+
+class MemoryNode:
+    """
+    A file or directory held in memory.
+
+    Attributes:
+        name (str): The entry name.
+        children (dict): Child nodes by name, or None for files.
+        data (bytes): File content, or None for directories.
+        mtime (float): Last modification time.
+        ino (int): Unique inode number.
+    """
+
+    __slots__ = ('name', 'children', 'data', 'mtime', 'ino')
+
+    def __init__(self, name, is_dir):
+        """
+        Initialize the MemoryNode.
+
+        Parameters:
+            name (str): The entry name.
+            is_dir (bool): Whether the node is a directory.
+        """
+        self.name = name
+        self.children = {} if is_dir else None
+        self.data = None if is_dir else b''
+        self.mtime = time.time()
+        self.ino = next(_inodes)
+
+    def is_dir(self):
+        """
+        Returns:
+            bool: True if the node is a directory.
+        """
+        return self.children is not None
+
+    def stat(self):
+        """
+        Get the status of the node.
+
+        Returns:
+            os.stat_result: A stat result describing the node.
+        """
+        if self.is_dir():
+            mode, size = stat.S_IFDIR | 0o755, 0
+        else:
+            mode, size = stat.S_IFREG | 0o644, len(self.data)
+        mtime = int(self.mtime)
+        times = {'st_atime': self.mtime, 'st_mtime': self.mtime, 'st_ctime': self.mtime,
+                 'st_mtime_ns': int(self.mtime * 1e9)}
+        return os.stat_result((mode, self.ino, 0, 1, 0, 0, size, mtime, mtime, mtime), times)
+
+
+class MemoryFS:
+    """
+    A thread-safe tree of `MemoryNode` objects.
+
+    Paths are absolute POSIX paths within the store.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty MemoryFS.
+        """
+        self.root = MemoryNode('', True)
+        self.lock = threading.RLock()
+
+    def lookup(self, path):
+        """
+        Find the node at a path.
+
+        Parameters:
+            path (str): Normalized absolute path.
+
+        Returns:
+            MemoryNode: The node.
+
+        Raises:
+            FileNotFoundError: If the path does not exist.
+            NotADirectoryError: If a parent component is a file.
+        """
+        node = self.root
+        for part in path.strip('/').split('/'):
+            if not part:
+                continue
+            if not node.is_dir():
+                raise NotADirectoryError(path)
+            node = node.children.get(part)
+            if node is None:
+                raise FileNotFoundError(path)
+        return node
+
+    def parent_of(self, path):
+        """
+        Find the parent directory node of a path.
+
+        Parameters:
+            path (str): Normalized absolute path.
+
+        Returns:
+            tuple: (parent MemoryNode, entry name).
+
+        Raises:
+            FileNotFoundError: If the parent does not exist.
+            NotADirectoryError: If the parent is a file.
+        """
+        head, name = posixpath.split(path)
+        parent = self.lookup(head)
+        if not parent.is_dir():
+            raise NotADirectoryError(head)
+        return parent, name
+
+    def makedirs(self, path):
+        """
+        Create a directory and any missing parents.
+
+        Parameters:
+            path (str): Normalized absolute path.
+
+        Returns:
+            MemoryNode: The directory node.
+
+        Raises:
+            NotADirectoryError: If a component is an existing file.
+        """
+        with self.lock:
+            node = self.root
+            for part in path.strip('/').split('/'):
+                if not part:
+                    continue
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = MemoryNode(part, True)
+                    node.mtime = time.time()
+                elif not child.is_dir():
+                    raise NotADirectoryError(path)
+                node = child
+            return node
+
+    def write_file(self, path, data):
+        """
+        Create or replace a file, creating missing parent directories.
+
+        Parameters:
+            path (str): Absolute path of the file.
+            data (bytes): The file content.
+        """
+        path = posixpath.normpath('/' + path)
+        with self.lock:
+            parent = self.makedirs(posixpath.dirname(path))
+            name = posixpath.basename(path)
+            node = parent.children.get(name)
+            if node is not None and node.is_dir():
+                raise IsADirectoryError(path)
+            if node is None:
+                node = parent.children[name] = MemoryNode(name, False)
+            node.data = bytes(data)
+            node.mtime = parent.mtime = time.time()
+
+
+def _clone(node):
+    """
+    Deep-copy a node and its children.
+    """
+    copy = MemoryNode(node.name, node.is_dir())
+    if node.is_dir():
+        copy.children = {name: _clone(child) for name, child in node.children.items()}
+    else:
+        copy.data = node.data
+    return copy
+
+
+class _MemoryWriter(io.BytesIO):
+    """
+    A writable buffer that stores its content into a node when closed.
+
+    In append mode, the content is added to the node's data as it is when
+    the buffer is closed, so concurrent appends are all kept, each in one
+    piece.
+    """
+
+    def __init__(self, fs, node, append=False):
+        super().__init__()
+        self._fs = fs
+        self._node = node
+        self._append = append
+
+    def close(self):
+        if not self.closed:
+            with self._fs.lock:
+                if self._append:
+                    self._node.data += self.getvalue()
+                else:
+                    self._node.data = self.getvalue()
+                self._node.mtime = time.time()
+        super().close()
+
+
+class _MemoryTreeRemoval(TreeOperation):
+    """
+    The removal of a tree of a `MemoryFS`, which detaches it at once.
+    """
+
+    def __init__(self, handler, path):
+        super().__init__(path, (), None, None, workers=0)
+        self.handler = handler
+
+    def run(self, interval=YIELD_INTERVAL):
+        fs = self.handler.fs
+        with fs.lock:
+            try:
+                parent, name = fs.parent_of(self.root)
+                node = parent.children.pop(name)
+            except (FileNotFoundError, NotADirectoryError, KeyError):
+                node = None
+            else:
+                parent.mtime = time.time()
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            if node.is_dir():
+                self.dirs += 1
+                stack.extend(node.children.values())
+            else:
+                self.files += 1
+                self.bytes += len(node.data)
+        self.handler.fs_op('rmtree', self.root, size=self.bytes, files=self.files)
+        return iter(())
+
+
+class MemoryFileHandler(FileBackend):
+    """
+    File backend serving a `MemoryFS`.
+
+    Attributes:
+        fs (MemoryFS): The shared store.
+        root_dir (str): The session's root within the store.
+        cur_dir (str): The current working directory within the store.
+    """
+
+    def __init__(self, fs, root_dir='/'):
+        """
+        Initialize the MemoryFileHandler.
+
+        Parameters:
+            fs (MemoryFS): The shared store.
+            root_dir (str): The root directory within the store. Created if missing.
+        """
+        self.fs = fs
+        self.root_dir = posixpath.normpath('/' + root_dir)
+        self.cur_dir = self.root_dir
+        self.ren_old = None
+        self.cp_old = None
+        fs.makedirs(self.root_dir)
+
+    def resolve_path(self, path):
+        """
+        Resolve a given path to an absolute path within the store.
+
+        Since paths are normalized lexically against the root, `..`
+        components can never climb above it.
+
+        Parameters:
+            path (str): The path to resolve.
+
+        Returns:
+            str: An absolute path within the store.
+        """
+        path = path.replace('\\', '/')
+        if not path.startswith('/'):
+            path = posixpath.join(self.pwd(), path)
+        rel = posixpath.normpath('/' + path).lstrip('/')
+        return posixpath.join(self.root_dir, rel) if rel else self.root_dir
+
+    def pwd(self):
+        """
+        Get the current working directory relative to the root directory.
+
+        Returns:
+            str: The current directory as a string.
+        """
+        return self._virtual(self.cur_dir)
+
+    def get_abs(self, path):
+        """
+        Get the absolute path of a given path relative to the root directory.
+
+        Parameters:
+            path (str): The path to resolve.
+
+        Returns:
+            str: The absolute path as a string.
+        """
+        return self._virtual(self.resolve_path(path))
+
+    def _virtual(self, path):
+        """
+        Convert a path within the store to an FTP path.
+        """
+        rel = posixpath.relpath(path, self.root_dir)
+        return '/' if rel == '.' else '/' + rel
+
+    def cwd(self, path):
+        """
+        Change the current working directory.
+
+        Parameters:
+            path (str): The directory to change to.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
+        """
+        new_path = self.resolve_path(path)
+        with self.fs.lock:
+            if not self.fs.lookup(new_path).is_dir():
+                raise NotADirectoryError
+        self.cur_dir = new_path
+
+    def cd_up(self):
+        """
+        Change to the parent directory, staying at the root if already there.
+        """
+        self.cwd('..')
+
+    def mkdir(self, path):
+        """
+        Create a new directory.
+
+        Parameters:
+            path (str): Path of directory to create.
+
+        Raises:
+            FileExistsError: If the path already exists.
+        """
+        path = self.resolve_path(path)
+        with self.fs.lock:
+            try:
+                self.fs.lookup(path)
+            except FileNotFoundError:
+                self.fs.makedirs(path)
+            else:
+                raise FileExistsError
+        self.fs_op('mkdir', path)
+
+    def name_ls(self, path, limit=None):
+        """
+        List the entries in a directory, the file itself, or the entries
+        matching a wildcard in the last component of the path.
+
+        Parameters:
+            path (str): The directory, file or wildcard to list.
+            limit (int): Maximum number of entries to return, or None.
+
+        Returns:
+            list: A list of MemoryNode objects. Empty if nothing matches.
+        """
+        path = self.resolve_path(path)
+        with self.fs.lock:
+            try:
+                node = self.fs.lookup(path)
+            except (FileNotFoundError, NotADirectoryError):
+                parent, pattern = posixpath.split(path)
+                if not has_magic(pattern):
+                    return []
+                try:
+                    node = self.fs.lookup(parent)
+                except (FileNotFoundError, NotADirectoryError):
+                    return []
+                if not node.is_dir():
+                    return []
+                match = compile_pattern(pattern)
+                entries = (child for name, child in node.children.items() if match(name))
+                return list(itertools.islice(entries, limit))
+            if not node.is_dir():
+                return [node]
+            return list(itertools.islice(node.children.values(), limit))
+
+    def stat(self, path):
+        """
+        Get the status of a file or directory.
+
+        Parameters:
+            path (str): The path to query.
+
+        Returns:
+            os.stat_result: The status of the path.
+
+        Raises:
+            FileNotFoundError: If the path does not exist.
+        """
+        with self.fs.lock:
+            return self.fs.lookup(self.resolve_path(path)).stat()
+
+    def open(self, fname, mode='rb'):
+        """
+        Open a file for binary reading or writing.
+
+        Readers see a snapshot of the file taken when it is opened; writers
+        publish their content when the file is closed.
+
+        Parameters:
+            fname (str): The file to open.
+            mode (str): One of 'rb', 'wb' or 'ab'.
+
+        Returns:
+            io.BytesIO: The opened file.
+
+        Raises:
+            FileNotFoundError: If reading a file that does not exist.
+            IsADirectoryError: If the path is a directory.
+        """
+        path = self.resolve_path(fname)
+        with self.fs.lock:
+            if mode == 'rb':
+                node = self.fs.lookup(path)
+                if node.is_dir():
+                    raise IsADirectoryError(fname)
+                return io.BytesIO(node.data)
+            parent, name = self.fs.parent_of(path)
+            node = parent.children.get(name)
+            if node is None:
+                node = parent.children[name] = MemoryNode(name, False)
+                parent.mtime = time.time()
+            elif node.is_dir():
+                raise IsADirectoryError(fname)
+            return _MemoryWriter(self.fs, node, append=(mode == 'ab'))
+
+    def write(self, fname, data, digests=None, expected=None):
+        """
+        Write data to a file.
+
+        Parameters:
+            fname (str): The file to write to.
+            data (iterable): An iterable of bytes to write.
+            digests (dict): Algorithms to compute while writing, see
+                `FileBackend.write`.
+            expected (tuple): (algorithm, hex digest) the data must match.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        size = super().write(fname, data, digests, expected)
+        self.fs_op('write', self.resolve_path(fname), size=size)
+        return size
+
+    def append(self, fname, data):
+        """
+        Append data to a file, creating it if it does not exist.
+
+        Parameters:
+            fname (str): The file to append to.
+            data (iterable): An iterable of bytes to append.
+
+        Returns:
+            int: The number of bytes appended.
+        """
+        size = super().append(fname, data)
+        total = self.size(fname)
+        self.fs_op('write', self.resolve_path(fname), size=total, replaced=total - size)
+        return size
+
+    def create_unique(self, fname=None):
+        """
+        Create an empty file under a name that no other file has (STOU).
+
+        Parameters:
+            fname (str): The name requested by the client, or None.
+
+        Returns:
+            str: The name of the created file.
+        """
+        with self.fs.lock:
+            name = super().create_unique(fname)
+        self.fs_op('write', self.resolve_path(name), size=0)
+        return name
+
+    def size(self, fname):
+        """
+        Get the size of a file.
+
+        Parameters:
+            fname (str): The file to check.
+
+        Returns:
+            int: The size of the file in bytes.
+
+        Raises:
+            FileHandlerError: If the path is not a file.
+        """
+        with self.fs.lock:
+            try:
+                node = self.fs.lookup(self.resolve_path(fname))
+            except (FileNotFoundError, NotADirectoryError):
+                node = None
+            if node is None or node.is_dir():
+                raise FileHandlerError(f'Not a file: {fname!r}')
+            return len(node.data)
+
+    def delete(self, fname):
+        """
+        Delete a file.
+
+        Parameters:
+            fname (str): The file to delete.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+            FileHandlerError: If the path is not a file.
+        """
+        path = self.resolve_path(fname)
+        with self.fs.lock:
+            parent, name = self.fs.parent_of(path)
+            node = parent.children.get(name)
+            if node is None:
+                raise FileNotFoundError
+            if node.is_dir():
+                raise FileHandlerError(f'Not a file: {fname!r}')
+            del parent.children[name]
+            parent.mtime = time.time()
+        self.fs_op('delete', path, size=len(node.data))
+
+    def rmdir(self, path):
+        """
+        Remove an empty directory.
+
+        Parameters:
+            path (str): The directory to remove.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
+            PermissionError: If attempting to remove the root directory.
+            OSError: If the directory is not empty.
+        """
+        path = self.resolve_path(path)
+        if path == self.root_dir:
+            raise PermissionError('Attempt to remove root directory')
+        with self.fs.lock:
+            parent, name = self.fs.parent_of(path)
+            node = parent.children.get(name)
+            if node is None:
+                raise FileNotFoundError
+            if not node.is_dir():
+                raise NotADirectoryError
+            if node.children:
+                raise OSError(f'Directory not empty: {path!r}')
+            del parent.children[name]
+            parent.mtime = time.time()
+        self.fs_op('rmdir', path)
+
+    def remove_tree(self, path):
+        """
+        Prepare the removal of a directory and everything in it.
+
+        Parameters:
+            path (str): The directory to remove.
+
+        Returns:
+            TreeOperation: The removal, done at once when run.
+
+        Raises:
+            FileNotFoundError: If the directory does not exist.
+            NotADirectoryError: If the path is not a directory.
+            PermissionError: If attempting to remove the root directory.
+        """
+        path = self.resolve_path(path)
+        if path == self.root_dir:
+            raise PermissionError('Attempt to remove root directory')
+        if not self.fs.lookup(path).is_dir():
+            raise NotADirectoryError
+        return _MemoryTreeRemoval(self, path)
+
+    def rename_from(self, old):
+        """
+        Mark a file or directory for renaming.
+
+        Parameters:
+            old (str): Existing file/directory name.
+
+        Raises:
+            FileNotFoundError: If the original path does not exist.
+            PermissionError: If attempting to rename the root directory.
+        """
+        path = self.resolve_path(old)
+        if path == self.root_dir:
+            raise PermissionError('Attempt to rename root directory')
+        with self.fs.lock:
+            self.fs.lookup(path)
+        self.ren_old = path
+
+    def rename_to(self, new):
+        """
+        Rename a previously marked file or directory.
+
+        Parameters:
+            new (str): New file/directory name.
+
+        Raises:
+            FileNotFoundError: If the marked path vanished meanwhile.
+            IsADirectoryError: If renaming a file over a directory.
+            NotADirectoryError: If renaming a directory over a file.
+            FileExistsError: If renaming a directory over a directory that
+                is not empty.
+            PermissionError: If moving a directory into itself.
+        """
+        new = self.resolve_path(new)
+        old, self.ren_old = self.ren_old, None
+        if new == old or new.startswith(old + '/'):
+            raise PermissionError('Attempt to move a directory into itself')
+        with self.fs.lock:
+            old_parent, old_name = self.fs.parent_of(old)
+            new_parent, new_name = self.fs.parent_of(new)
+            node = old_parent.children.get(old_name)
+            if node is None:
+                raise FileNotFoundError
+            # Like os.rename: files replace files, and directories empty
+            # directories
+            target = new_parent.children.get(new_name)
+            if target is not None:
+                if target.is_dir() and not node.is_dir():
+                    raise IsADirectoryError(new)
+                if node.is_dir() and not target.is_dir():
+                    raise NotADirectoryError(new)
+                if target.is_dir() and target.children:
+                    raise FileExistsError(new)
+            del old_parent.children[old_name]
+            node.name = new_name
+            new_parent.children[new_name] = node
+            old_parent.mtime = new_parent.mtime = time.time()
+        self.fs_op('rename', old, dest=new)
+
+    def copy_from(self, old):
+        """
+        Mark a file or directory for copying.
+
+        Parameters:
+            old (str): Existing file/directory name.
+
+        Raises:
+            FileNotFoundError: If the original path does not exist.
+        """
+        path = self.resolve_path(old)
+        with self.fs.lock:
+            self.fs.lookup(path)
+        self.cp_old = path
+
+    def copy_to(self, new):
+        """
+        Prepare the copy of a previously marked file or directory.
+
+        File contents are immutable bytes, so copies share them.
+
+        Parameters:
+            new (str): Destination name. Copying into an existing directory
+                places the copy inside it.
+
+        Returns:
+            callable: Performs the copy when called.
+
+        Raises:
+            PermissionError: If copying a directory into itself.
+            FileHandlerError: If source and destination are the same.
+        """
+        src, self.cp_old = self.cp_old, None
+        dst = self.resolve_path(new)
+        with self.fs.lock:
+            try:
+                if self.fs.lookup(dst).is_dir():
+                    dst = posixpath.join(dst, posixpath.basename(src))
+            except FileNotFoundError:
+                pass
+        if dst == src:
+            raise FileHandlerError('Source and destination are the same')
+        if dst.startswith(src + '/'):
+            raise PermissionError('Attempt to copy a directory into itself')
+
+        def run():
+            with self.fs.lock:
+                node = _clone(self.fs.lookup(src))
+                parent, name = self.fs.parent_of(dst)
+                node.name = name
+                parent.children[name] = node
+                parent.mtime = time.time()
+            self.fs_op('copy', src, dest=dst)
+        return run
@@ -0,0 +1,341 @@
+"""
+Filename index for thinFTP (SITE FIND).
+
+Finding a file by name should not mean crawling the tree with LIST, so the
+server keeps an index of every path below its root, in the spirit of
+`locate`:
+
+- The index is built by a background walk, and rebuilt periodically to pick
+  up changes made outside of thinFTP.
+- Changes made through thinFTP (uploads, deletions, renames, copies and new
+  directories) are applied as they happen, from the server's `on_fs_op`
+  hooks, to a small delta kept next to the last full walk.
+- It can be persisted to a file, so that a restarted server can answer
+  searches immediately while its first walk is still running.
+
+Searches never examine names one by one in Python: the lowercased names of
+the last walk are kept in one string, in which the literal part of the
+pattern is located with `str.find`. Only the names containing it are then
+matched against the full pattern, so a search costs milliseconds even over
+millions of names.
+
+Classes:
+    NameIndex: Searchable index of the paths below a directory.
+"""
+
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+from .wildcard import compile_pattern, has_magic
+
+INDEX_MAGIC = 'thinftp-name-index 1'
+
+
+def _walk(root):
+    """
+    List every path below a directory, without following symbolic links.
+
+    Directories are listed with a trailing '/'. Names containing newlines,
+    which cannot be indexed, are skipped.
+    """
+    paths = []
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, rel)) as it:
+                for entry in it:
+                    if '\n' in entry.name:
+                        continue
+                    path = rel + entry.name
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        paths.append(path + '/')
+                        stack.append(path + '/')
+                    else:
+                        paths.append(path)
+        except OSError:
+            continue
+    return paths
+
+
+def _basename(path):
+    """
+    Get the last component of an indexed path.
+    """
+    return path.rstrip('/').rpartition('/')[2]
+
+
+class _Snapshot:
+    """
+    The paths found by a full walk, with their lowercased names joined into
+    one searchable string.
+    """
+
+    __slots__ = ('paths', 'names', 'starts')
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.names = ''.join(_basename(p).lower() + '\n' for p in paths)
+        self.starts = array('q', [0])
+        pos = 0
+        for p in paths:
+            pos += len(_basename(p)) + 1
+            self.starts.append(pos)
+
+    def candidates(self, literal):
+        """
+        Yield the paths whose lowercased name contains `literal`, in order.
+        """
+        if not literal:
+            yield from self.paths
+            return
+        names, starts, pos = self.names, self.starts, 0
+        while True:
+            pos = names.find(literal, pos)
+            if pos < 0:
+                return
+            line = bisect_right(starts, pos) - 1
+            yield self.paths[line]
+            pos = starts[line + 1]
+
+
+class NameIndex:
+    """
+    Searchable index of the paths below a directory.
+
+    Attributes:
+        root (Path): The indexed directory.
+        store (str): File the index is persisted to, or None.
+        rescan_interval (float): Seconds between full walks.
+        ready (threading.Event): Set once the index can answer searches.
+        scanned_at (float): Time of the last completed walk, or None.
+    """
+
+    #: Pending changes that trigger an early walk.
+    MAX_DELTA = 100_000
+
+    def __init__(self, root, store=None, rescan_interval=3600.0):
+        """
+        Initialize the NameIndex, loading the persisted index if there is
+        one. Call `start` to begin walking.
+
+        Parameters:
+            root (str): The directory to index.
+            store (str): File to persist the index to, or None.
+            rescan_interval (float): Seconds between full walks.
+        """
+        self.root = Path(root).resolve()
+        self.store = store
+        self.rescan_interval = rescan_interval
+        self.ready = threading.Event()
+        self.scanned_at = None
+        self._snapshot = _Snapshot([])
+        self._added = {}
+        self._removed = set()
+        self._removed_dirs = set()
+        self._journal = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        if store:
+            self._load()
+
+    def __len__(self):
+        return len(self._snapshot.paths) + len(self._added)
+
+    def _load(self):
+        try:
+            with open(self.store, encoding='utf-8', errors='surrogateescape') as f:
+                header = f.readline().rstrip('\n').split('\t')
+                if header[0] != INDEX_MAGIC or header[1] != str(self.root):
+                    return
+                paths = f.read().split('\n')[:-1]
+        except (OSError, IndexError):
+            return
+        self._snapshot = _Snapshot(paths)
+        self.scanned_at = float(header[2])
+        self.ready.set()
+
+    def _save(self, paths):
+        tmp = f"{self.store}.tmp"
+        with open(tmp, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write(f"{INDEX_MAGIC}\t{self.root}\t{self.scanned_at}\n")
+            for path in paths:
+                f.write(path + '\n')
+        os.replace(tmp, self.store)
+
+    def start(self):
+        """
+        Walk the tree in a background thread, and again every
+        `rescan_interval` seconds.
+        """
+        threading.Thread(target=self._run, name='thinftp-nameindex', daemon=True).start()
+
+    def stop(self):
+        """
+        Stop the background walks.
+        """
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.rescan()
+            self._wakeup.wait(self.rescan_interval)
+            self._wakeup.clear()
+
+    def rescan(self):
+        """
+        Walk the tree and replace the index with the result.
+
+        Changes reported while the walk runs are applied again on top of it,
+        as the walk may or may not have seen them.
+        """
+        with self._lock:
+            self._journal = []
+        started = time.time()
+        paths = _walk(str(self.root))
+        snapshot = _Snapshot(paths)
+        with self._lock:
+            journal, self._journal = self._journal, None
+            self._snapshot = snapshot
+            self._added = {}
+            self._removed = set()
+            self._removed_dirs = set()
+            for op, rel in journal:
+                self._apply(op, rel)
+        self.scanned_at = started
+        self.ready.set()
+        if self.store:
+            try:
+                self._save(paths)
+            except OSError:
+                pass
+
+    def _apply(self, op, rel):
+        # Called with the lock held
+        if op == 'add':
+            self._removed.discard(rel)
+            self._added[rel] = None
+        elif op == 'remove':
+            self._added.pop(rel, None)
+            self._removed.add(rel)
+        elif op == 'remove_dir':
+            for path in [p for p in self._added if p.startswith(rel)]:
+                del self._added[path]
+            self._removed_dirs.add(rel)
+        if self._journal is not None:
+            self._journal.append((op, rel))
+        elif len(self._added) + len(self._removed) > self.MAX_DELTA:
+            self._wakeup.set()
+
+    def _relative(self, path):
+        if not isinstance(path, Path) or not path.is_relative_to(self.root) or path == self.root:
+            return None
+        return path.relative_to(self.root).as_posix()
+
+    def _add_tree(self, path):
+        rel = self._relative(path)
+        if rel is None:
+            return
+        if path.is_dir() and not path.is_symlink():
+            changes = [('add', rel + '/')] + [('add', f"{rel}/{p}") for p in _walk(str(path))]
+        else:
+            changes = [('add', rel)]
+        with self._lock:
+            for op, p in changes:
+                self._apply(op, p)
+
+    def _remove(self, path, is_dir):
+        rel = self._relative(path)
+        if rel is None:
+            return
+        with self._lock:
+            if is_dir:
+                self._apply('remove', rel + '/')
+                self._apply('remove_dir', rel + '/')
+            else:
+                self._apply('remove', rel)
+
+    def on_fs_op(self, backend, op, path, dest=None, **info):
+        """
+        Apply a filesystem operation reported by a backend.
+        """
+        if op in ('write', 'mkdir'):
+            self._add_tree(path)
+        elif op == 'delete':
+            self._remove(path, False)
+        elif op == 'rmdir':
+            self._remove(path, True)
+        elif op == 'rmtree':
+            self._remove(path, True)
+            if isinstance(path, Path) and path.exists():
+                # Partly removed (cancelled, or with errors)
+                self._add_tree(path)
+        elif op == 'rename':
+            self._remove(path, isinstance(dest, Path) and dest.is_dir())
+            self._add_tree(dest)
+        elif op == 'copy':
+            self._add_tree(dest)
+
+    def search(self, pattern, prefix='', limit=1000):
+        """
+        Find the paths whose name matches a pattern.
+
+        A pattern containing `*`, `?` or `[` is a case-sensitive shell
+        wildcard matched against whole names; any other pattern is a
+        case-insensitive substring of the name.
+
+        Parameters:
+            pattern (str): The wildcard or substring.
+            prefix (str): Only return paths below this relative directory
+                (ending with '/'), with the prefix removed.
+            limit (int): Maximum number of paths to return.
+
+        Yields:
+            str: Matching paths relative to `prefix`. Directories end with '/'.
+        """
+        if has_magic(pattern):
+            match = compile_pattern(pattern)
+            pieces = re.split(r'\[[^\]]*\]?|[*?]', pattern)
+            literal = max(pieces, key=len).lower()
+        else:
+            literal = pattern.lower()
+            match = lambda name: literal in name.lower()
+
+        with self._lock:
+            snapshot = self._snapshot
+            added = list(self._added)
+            removed = set(self._removed)
+            removed_dirs = tuple(self._removed_dirs)
+
+        seen = set()
+        count = 0
+        for source, path in self._iter_candidates(snapshot, literal, added):
+            if count >= limit:
+                return
+            if not path.startswith(prefix) or path in seen:
+                continue
+            if source == 'snapshot' and (path in removed or path.startswith(removed_dirs)):
+                continue
+            if not match(_basename(path)):
+                continue
+            seen.add(path)
+            count += 1
+            yield path[len(prefix):]
+
+    @staticmethod
+    def _iter_candidates(snapshot, literal, added):
+        for path in snapshot.candidates(literal):
+            yield 'snapshot', path
+        for path in added:
+            if literal in _basename(path).lower():
+                yield 'added', path
@@ -0,0 +1,296 @@
+"""
+Page cache policy for large transfers in thinFTP.
+
+A one-off download or upload of a multi-gigabyte file goes through the
+kernel's page cache like any other I/O, and evicts the small, hot files
+that most clients keep asking for. A `CachePolicy` keeps such transfers
+from trashing the cache, based on the size of the file (and, for reads, on
+the transfer mode, as only binary transfers are streamed this way):
+
+- Reads of files of at least `threshold` bytes are advised as sequential,
+  with the next window read ahead (`POSIX_FADV_SEQUENTIAL`/`WILLNEED`), and
+  the pages behind the cursor are dropped (`POSIX_FADV_DONTNEED`) after
+  each window.
+- Writes beyond `threshold` bytes are advised `POSIX_FADV_DONTNEED` after
+  each window, twice: right away, which starts the writeback of the window
+  without waiting for it (dirty pages cannot be dropped), and one window
+  later, which drops its pages once written back. Uploads never wait for
+  the disk (no `fdatasync`): pages still dirty are just left to the kernel.
+- Optionally, writes beyond `direct_threshold` bytes switch to `O_DIRECT`,
+  going from an aligned buffer straight to the disk. Where the filesystem
+  refuses it, the upload goes on through the cache.
+
+Counters of the bytes that bypassed the cache, this way or the other, are
+reported by `SITE DIAG`. Where `posix_fadvise` (or `O_DIRECT`) is not
+available, the policy does nothing.
+
+Classes:
+    CachePolicy: The policy, and its counters.
+"""
+
+import mmap
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+#: Bytes read or written between two drops of the pages behind the cursor.
+DROP_WINDOW = 8 * 1024 * 1024
+#: Size of the aligned staging buffer of O_DIRECT writes.
+DIRECT_BUFFER = 1024 * 1024
+#: Alignment of O_DIRECT writes (file offsets and lengths).
+DIRECT_ALIGN = 4096
+
+
+def _advise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+
+def _write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+
+
+class _ReadAdvisor:
+    """
+    Advises the kernel about a streaming read of a file.
+    """
+
+    def __init__(self, policy, fd):
+        self.policy = policy
+        self.fd = fd
+        self.dropped = 0
+        self.next_drop = policy.window
+        _advise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        _advise(fd, 0, policy.window, os.POSIX_FADV_WILLNEED)
+
+    def advance(self, pos):
+        """
+        Note that the file has been read up to `pos`.
+        """
+        if pos >= self.next_drop:
+            self.drop(pos)
+            _advise(self.fd, pos, self.policy.window, os.POSIX_FADV_WILLNEED)
+            self.next_drop = pos + self.policy.window
+
+    def drop(self, pos):
+        """
+        Drop the pages read up to `pos`.
+        """
+        if pos > self.dropped:
+            _advise(self.fd, self.dropped, pos - self.dropped, os.POSIX_FADV_DONTNEED)
+            self.policy.count('read_dropped', pos - self.dropped)
+            self.dropped = pos
+
+
+class _PolicyWriter:
+    """
+    Writes a new file, keeping it out of the page cache once it is large.
+    """
+
+    def __init__(self, policy, f):
+        self.policy = policy
+        self.f = f
+        self.fd = f.fileno()
+        self.pos = 0
+        self.dropped = 0  # Advised twice up to there
+        self.flushed = 0  # Advised once up to there
+        self.next_drop = max(policy.threshold, policy.window)
+        # Per upload, as O_DIRECT support depends on the filesystem
+        self.direct_threshold = policy.direct_threshold
+        self.direct = None  # The aligned staging buffer, once in O_DIRECT mode
+        self.staged = 0
+
+    def write(self, data):
+        if self.direct is not None:
+            self._stage(data)
+            return
+        limit = self.direct_threshold
+        if limit is not None and self.pos + len(data) >= limit:
+            # Switch at the next aligned offset
+            head = (-self.pos) % DIRECT_ALIGN
+            if len(data) >= head:
+                self.f.write(data[:head])
+                self.pos += head
+                if self._start_direct():
+                    self._stage(data[head:])
+                    return
+                data = data[head:]
+        self.f.write(data)
+        self.pos += len(data)
+        if self.pos >= self.next_drop:
+            self._flush_and_drop()
+            self.next_drop = self.pos + self.policy.window
+
+    def _flush_and_drop(self):
+        if not self.flushed:
+            self.policy.count('write_files', 1)
+        self.f.flush()
+        # Starts the writeback of the new pages, and drops the clean ones
+        if self.pos > self.flushed:
+            _advise(self.fd, self.flushed, self.pos - self.flushed, os.POSIX_FADV_DONTNEED)
+        # The previous window has had time to be written back since
+        if self.flushed > self.dropped:
+            _advise(self.fd, self.dropped, self.flushed - self.dropped, os.POSIX_FADV_DONTNEED)
+            self.policy.count('write_dropped', self.flushed - self.dropped)
+        self.dropped, self.flushed = self.flushed, self.pos
+
+    def _start_direct(self):
+        self._flush_and_drop()
+        try:
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+        except OSError:
+            # Not supported by the filesystem: keep dropping pages instead
+            self.direct_threshold = None
+            return False
+        self.direct = mmap.mmap(-1, DIRECT_BUFFER)
+        self.policy.count('direct_uploads', 1)
+        return True
+
+    def _stage(self, data):
+        with memoryview(data) as view:
+            while view:
+                n = min(len(view), DIRECT_BUFFER - self.staged)
+                self.direct[self.staged:self.staged + n] = view[:n]
+                self.staged += n
+                view = view[n:]
+                if self.staged == DIRECT_BUFFER:
+                    self._write_direct(DIRECT_BUFFER)
+
+    def _write_direct(self, length):
+        with memoryview(self.direct) as view:
+            _write_all(self.fd, view[:length])
+        self.pos += length
+        self.policy.count('direct', length)
+        self.direct[:self.staged - length] = self.direct[length:self.staged]
+        self.staged -= length
+
+    def close(self):
+        """
+        Write what is left, leaving O_DIRECT mode, and drop the last pages.
+        """
+        if self.direct is not None:
+            aligned = self.staged - self.staged % DIRECT_ALIGN
+            if aligned:
+                self._write_direct(aligned)
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            if self.staged:
+                _write_all(self.fd, self.direct[:self.staged])
+                self.pos += self.staged
+                self.staged = 0
+            self.direct.close()
+            self.direct = None
+        elif self.pos >= self.policy.threshold:
+            self._flush_and_drop()
+            # What is still dirty is left to the kernel's writeback
+            self._flush_and_drop()
+
+
+class CachePolicy:
+    """
+    Decides how large transfers use the page cache, and counts the bytes
+    that bypassed it.
+
+    Attributes:
+        threshold (int): Size from which reads and writes are streamed past
+            the cache, or None to disable the policy.
+        direct_threshold (int): Size from which uploads use O_DIRECT, or
+            None.
+        window (int): Bytes between two drops of pages behind the cursor.
+    """
+
+    def __init__(self, threshold, direct_threshold=None, window=DROP_WINDOW):
+        """
+        Initialize the CachePolicy.
+
+        Parameters:
+            threshold (int): Size from which transfers are streamed past the
+                page cache, or None (or 0) to disable the policy.
+            direct_threshold (int): Size from which uploads use O_DIRECT, or
+                None to never use it.
+            window (int): Bytes between two drops of pages.
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            threshold = None
+        self.threshold = threshold or None
+        self.direct_threshold = None
+        if direct_threshold is not None and self.threshold and fcntl is not None and hasattr(os, 'O_DIRECT'):
+            self.direct_threshold = direct_threshold
+        self.window = window
+        self.counters = dict.fromkeys(('read_files', 'read_dropped', 'write_files', 'write_dropped',
+                                       'direct_uploads', 'direct'), 0)
+        self._lock = threading.Lock()
+
+    def count(self, counter, n):
+        """
+        Add to one of the counters.
+
+        Parameters:
+            counter (str): The counter.
+            n (int): The amount to add.
+        """
+        with self._lock:
+            self.counters[counter] += n
+
+    def reader(self, fd, type='I'):
+        """
+        Get the advisor of a read, which is told the position of the cursor
+        as the file is read.
+
+        Parameters:
+            fd (int): The file descriptor of the open file.
+            type (str): The transfer type ('A' for ASCII, 'I' for binary).
+
+        Returns:
+            An object whose `advance(pos)` and `drop(pos)` methods are called
+            as the file is read and when it is done, or None if the read
+            should use the cache as usual.
+        """
+        if self.threshold is None or type != 'I' or os.fstat(fd).st_size < self.threshold:
+            return None
+        self.count('read_files', 1)
+        return _ReadAdvisor(self, fd)
+
+    def writer(self, f):
+        """
+        Wrap a binary file object open for writing a new file.
+
+        Parameters:
+            f: The file object, positioned at the start.
+
+        Returns:
+            An object with `write(data)` and `close()` methods (the latter to
+            call before closing `f`), or `f` itself if the policy is
+            disabled.
+        """
+        if self.threshold is None:
+            return f
+        return _PolicyWriter(self, f)
+
+    def status(self):
+        """
+        Describe the policy and its counters.
+
+        Returns:
+            list: Lines of text.
+        """
+        if self.threshold is None:
+            return ["Page cache policy: off"]
+        c = dict(self.counters)
+        mib = lambda n: f"{n / (1 << 20):.1f} MiB"
+        direct = f", O_DIRECT beyond {mib(self.direct_threshold)}" if self.direct_threshold else ""
+        return [f"Page cache policy: streaming beyond {mib(self.threshold)}{direct}",
+                f"Page cache bypassed by reads: {mib(c['read_dropped'])} in {c['read_files']} files",
+                f"Page cache bypassed by writes: {mib(c['write_dropped'] + c['direct'])}"
+                f" in {c['write_files']} files ({mib(c['direct'])} with O_DIRECT"
+                f" in {c['direct_uploads']} files)"]
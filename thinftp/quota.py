@@ -0,0 +1,228 @@
+"""
+Per-user disk quotas for thinFTP.
+
+Checking a quota must not mean walking the user's tree on every upload, so
+the usage of each quota-limited home directory is kept in a `UsageIndex`:
+the tree is measured once by a background thread at first use, and the
+total is then kept current from the filesystem operations reported through
+the server's `on_fs_op` hooks (uploads, deletions, renames and copies). Both
+checking and reporting usage are then O(1).
+
+Uploads and copies in progress reserve the space they take as they go, so
+that concurrent ones cannot together exceed a quota that each would fit in
+alone; a reservation is released once the operation has been accounted for
+(or has failed).
+
+Operations that happen while the initial scan is still running are applied
+on top of the scanned total, so the figure is approximate until the scan has
+finished; changes made to the tree outside of thinFTP are not seen until the
+next restart.
+
+Classes:
+    UsageIndex: Incrementally maintained usage of a directory tree.
+    QuotaManager: The usage indexes of a server.
+
+Functions:
+    parse_size: Parse a size such as '10G'.
+"""
+
+import threading
+from pathlib import Path
+from .walker import tree_usage
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value):
+    """
+    Parse a size in bytes, optionally with a binary unit suffix.
+
+    Parameters:
+        value (int or str): A number of bytes, or a string such as '500M'
+            or '10G' (K, M, G and T are powers of 1024).
+
+    Returns:
+        int: The size in bytes, or None if `value` is None.
+
+    Raises:
+        ValueError: If the size is malformed or negative.
+    """
+    if value is None or isinstance(value, int):
+        if value is not None and value < 0:
+            raise ValueError(f"Negative size: {value!r}")
+        return value
+    text = str(value).strip().upper().removesuffix('B').removesuffix('I')
+    unit = text[-1:] if text[-1:] in _UNITS else ''
+    number = text[:-1] if unit else text
+    try:
+        size = int(float(number) * _UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid size: {value!r}") from None
+    if size < 0:
+        raise ValueError(f"Negative size: {value!r}")
+    return size
+
+
+class UsageIndex:
+    """
+    Incrementally maintained usage of a directory tree.
+
+    Attributes:
+        root (Path): The measured directory.
+        used (int): Total size of the regular files, in bytes.
+        files (int): Number of regular files.
+        reserved (int): Bytes reserved by operations in progress, not yet
+            accounted for in `used`.
+        ready (threading.Event): Set once the initial scan has finished.
+    """
+
+    def __init__(self, root):
+        """
+        Initialize the UsageIndex. Call `start` to measure the tree.
+
+        Parameters:
+            root (str): The directory to measure.
+        """
+        self.root = Path(root).resolve()
+        self.used = 0
+        self.files = 0
+        self.reserved = 0
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Measure the tree in a background thread.
+        """
+        threading.Thread(target=self._scan, name='thinftp-usage', daemon=True).start()
+
+    def _scan(self):
+        size, files = tree_usage(self.root)
+        self.add(size, files)
+        self.ready.set()
+
+    def add(self, size, files=0):
+        """
+        Account for a change of the tree.
+
+        Parameters:
+            size (int): Change of the total size, in bytes.
+            files (int): Change of the number of files.
+        """
+        with self._lock:
+            self.used += size
+            self.files += files
+
+    def reserve(self, size, limit, credit=0):
+        """
+        Reserve space for an operation in progress, if it fits in a limit.
+
+        Parameters:
+            size (int): The bytes to reserve.
+            limit (int): The quota the usage must stay within.
+            credit (int): Bytes the operation frees, e.g. by replacing a
+                file.
+
+        Returns:
+            bool: True if the space was reserved, False if it would exceed
+            the limit.
+        """
+        with self._lock:
+            if self.used + self.reserved - credit + size > limit:
+                return False
+            self.reserved += size
+            return True
+
+    def release(self, size):
+        """
+        Release space reserved with `reserve`.
+
+        Parameters:
+            size (int): The bytes to release.
+        """
+        with self._lock:
+            self.reserved -= size
+
+    def covers(self, path):
+        """
+        Parameters:
+            path (Path): A resolved local path.
+
+        Returns:
+            bool: True if the path is inside the measured tree.
+        """
+        return isinstance(path, Path) and path.is_relative_to(self.root)
+
+
+class QuotaManager:
+    """
+    The usage indexes of a server, one per quota-limited home directory.
+
+    Once it has an index, it registers itself as a hook object, keeping
+    every index covering a changed path current. Indexes may nest, as homes
+    may.
+
+    Attributes:
+        hooks (Hooks): The server's hook registry.
+        indexes (dict): Resolved home directories mapped to their UsageIndex.
+    """
+
+    def __init__(self, hooks):
+        """
+        Initialize the QuotaManager with no indexes.
+
+        Parameters:
+            hooks (Hooks): The server's hook registry.
+        """
+        self.hooks = hooks
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def index_for(self, root):
+        """
+        Get the index of a directory, creating and starting it on first use.
+
+        Parameters:
+            root (Path): The directory.
+
+        Returns:
+            UsageIndex: The index.
+        """
+        root = Path(root).resolve()
+        with self._lock:
+            index = self.indexes.get(root)
+            if index is None:
+                if not self.indexes:
+                    self.hooks.add(self)
+                index = self.indexes[root] = UsageIndex(root)
+                index.start()
+        return index
+
+    def on_fs_op(self, backend, op, path, size=None, replaced=None, dest=None, **info):
+        """
+        Update the indexes affected by a filesystem operation.
+        """
+        for index in list(self.indexes.values()):
+            if op == 'write' and index.covers(path):
+                index.add(size - (replaced or 0), 0 if replaced is not None else 1)
+            elif op == 'delete' and index.covers(path):
+                index.add(-size, -1)
+            elif op == 'rmtree' and index.covers(path):
+                index.add(-size, -info['files'])
+            elif op == 'rmtree' and isinstance(path, Path) and index.root.is_relative_to(path):
+                # The tree held the whole home: measure what is left of it
+                size, files = tree_usage(index.root)
+                index.add(size - index.used, files - index.files)
+            elif op == 'copy' and index.covers(dest):
+                size, files = tree_usage(dest)
+                if replaced is not None:
+                    # The copy overwrote a file
+                    size, files = size - replaced, files - 1
+                index.add(size, files)
+            elif op == 'rename' and index.covers(path) != index.covers(dest):
+                # Moved into or out of the tree: only possible with nested homes
+                moved, files = tree_usage(dest)
+                sign = 1 if index.covers(dest) else -1
+                index.add(sign * moved, sign * files)
+            if op == 'rename' and replaced is not None and index.covers(dest):
+                index.add(-replaced, -1)
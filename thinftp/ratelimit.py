@@ -0,0 +1,94 @@
+"""
+Per-IP command-rate limiting for thinFTP.
+
+A session processes commands as fast as its client sends them, so a single
+scripted client could keep a thread busy with `NOOP` spam. The
+`CommandLimiter` gives each client IP a token bucket shared by all of its
+connections: a command costs a token, tokens refill at a steady rate up to
+a burst size, and a client out of tokens is made to wait for the next one.
+Waiting sessions sleep instead of burning CPU, and a client that keeps
+sending regardless eventually owes so much time that it is disconnected.
+
+The table of buckets is bounded, so that the defence itself cannot be used
+to exhaust memory: when it is full, the least recently seen IP is
+forgotten. Buckets of idle IPs are full again after a while, which is the
+same as not being tracked, so they are expired as the table is used.
+
+Classes:
+    CommandLimiter: Per-IP token buckets for commands.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class CommandLimiter:
+    """
+    Limits the rate of commands per client IP with token buckets.
+
+    Attributes:
+        rate (float): Tokens (commands) refilled per second.
+        burst (int): Capacity of a bucket, the commands allowed at once.
+        max_delay (float): Longest wait for a token before a client is
+            considered abusive.
+        max_entries (int): Maximum number of tracked IPs.
+    """
+
+    def __init__(self, rate, burst, max_delay=5.0, max_entries=16384):
+        """
+        Initialize the CommandLimiter.
+
+        Parameters:
+            rate (float): Commands allowed per second, on average.
+            burst (int): Commands allowed at once.
+            max_delay (float): Longest wait for a token, in seconds.
+            max_entries (int): Maximum number of tracked IPs.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, ip):
+        """
+        Take a token for a command of an IP.
+
+        Parameters:
+            ip (str): The client IP.
+
+        Returns:
+            float: Seconds to wait before processing the command (0 if a
+            token was available), or None if the IP already owes more than
+            `max_delay` and the command should be refused.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(ip, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens - 1 < -self.max_delay * self.rate:
+                self._buckets[ip] = (tokens, now)
+                return None
+            tokens -= 1
+            self._buckets[ip] = (tokens, now)
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            else:
+                self._expire(now)
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+    def _expire(self, now):
+        """
+        Forget the least recently seen IP if its bucket is full again.
+        """
+        ip, (tokens, stamp) = next(iter(self._buckets.items()))
+        if tokens + (now - stamp) * self.rate >= self.burst:
+            del self._buckets[ip]
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,123 @@
+"""
+Zero-downtime restarts for thinFTP.
+
+Upon `SIGUSR2`, a running server starts a fresh copy of itself (re-executing
+the original command line, so new code and configuration are picked up) and
+hands it the listening socket. Once the new process reports that it is
+ready, the old one stops accepting connections and lets its sessions finish
+their current transfers before exiting. Since the listening socket is never
+closed, clients are not refused at any point.
+
+The handoff uses the following environment variables, each holding an
+inherited file descriptor:
+
+- `THINFTP_LISTEN_FD`: the listening socket.
+- `THINFTP_READY_FD`: a pipe the new process writes to once it is serving.
+- `THINFTP_PSWD_FD`: a pipe holding the single-user password, so that the
+  new process does not prompt for it again.
+
+Functions:
+    inherited_listen_fd: Get the listening socket passed by a predecessor.
+    inherited_password: Get the password passed by a predecessor.
+    notify_ready: Tell the predecessor that this process is serving.
+    spawn_successor: Start a new server process on the same socket.
+"""
+
+import os
+import select
+import subprocess
+import sys
+
+LISTEN_FD_ENV = 'THINFTP_LISTEN_FD'
+READY_FD_ENV = 'THINFTP_READY_FD'
+PSWD_FD_ENV = 'THINFTP_PSWD_FD'
+
+
+def _pop_fd(name):
+    """
+    Remove a file descriptor variable from the environment.
+
+    Returns:
+        int: The file descriptor, or None if the variable is not set.
+    """
+    value = os.environ.pop(name, None)
+    return int(value) if value is not None else None
+
+
+def inherited_listen_fd():
+    """
+    Get the listening socket passed by a predecessor process.
+
+    Returns:
+        int: The socket's file descriptor, or None if this process was not
+        started by a restart.
+    """
+    return _pop_fd(LISTEN_FD_ENV)
+
+
+def inherited_password():
+    """
+    Get the password passed by a predecessor process.
+
+    Returns:
+        str: The password, or None if none was passed.
+    """
+    fd = _pop_fd(PSWD_FD_ENV)
+    if fd is None:
+        return None
+    with os.fdopen(fd, encoding='utf-8') as f:
+        return f.read()
+
+
+def notify_ready():
+    """
+    Tell the predecessor process, if any, that this process is serving.
+    """
+    fd = _pop_fd(READY_FD_ENV)
+    if fd is not None:
+        os.write(fd, b'1')
+        os.close(fd)
+
+
+def spawn_successor(listen_fd, pswd=None, timeout=30.0):
+    """
+    Start a new server process sharing the listening socket.
+
+    The process runs the same command line as the current one.
+
+    Parameters:
+        listen_fd (int): File descriptor of the listening socket.
+        pswd (str): Single-user password to pass on, if any.
+        timeout (float): Seconds to wait for the new process to be ready.
+
+    Returns:
+        subprocess.Popen: The new process, or None if it failed to start
+        serving within the timeout (it is then terminated).
+    """
+    ready_r, ready_w = os.pipe()
+    env = dict(os.environ)
+    env[LISTEN_FD_ENV] = str(listen_fd)
+    env[READY_FD_ENV] = str(ready_w)
+    pass_fds = [listen_fd, ready_w]
+    if pswd is not None:
+        pswd_r, pswd_w = os.pipe()
+        os.write(pswd_w, pswd.encode())
+        os.close(pswd_w)
+        env[PSWD_FD_ENV] = str(pswd_r)
+        pass_fds.append(pswd_r)
+
+    try:
+        proc = subprocess.Popen(sys.orig_argv, env=env, pass_fds=pass_fds)
+    finally:
+        for fd in pass_fds[1:]:
+            os.close(fd)
+
+    try:
+        readable, _, _ = select.select([ready_r], [], [], timeout)
+        ready = bool(readable) and os.read(ready_r, 1) == b'1'
+    finally:
+        os.close(ready_r)
+    if not ready:
+        proc.terminate()
+        return None
+    return proc
@@ -0,0 +1,195 @@
+"""
+Disk-aware scheduling of downloads for thinFTP.
+
+Each session transfers in its own thread, so when hundreds of clients start
+downloading different large files at once, a spinning disk seeks between
+hundreds of read streams and its total throughput collapses. A
+`TransferScheduler` caps the number of downloads of large files running at
+once on each device (as identified by `st_dev`), while the others wait in
+a first-come, first-served queue, and get the slot of a finishing download
+in turn.
+
+Files smaller than `small_size` take the priority lane: they are sent right
+away, as they cost a seek or two and would otherwise wait behind large
+transfers. Metadata commands (listings, `SIZE`, `MDTM` and the like) never
+wait.
+
+A download waits at most `timeout` seconds, after which it gives up with
+`TransferDeferred`, as do the waiting downloads when the server drains for
+a restart (`close`).
+
+The scheduler counts, per device, the transfers it ran, the ones that had
+to wait and for how long, the ones that gave up, and the depth of the
+queue, as reported by `SITE DIAG`.
+
+Classes:
+    TransferScheduler: Per-device limits and queues of downloads.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from .errors import TransferDeferred
+
+
+class _Device:
+    __slots__ = ('active', 'waiters', 'transfers', 'small', 'waited', 'wait_time', 'max_wait',
+                 'max_depth', 'deferred')
+
+    def __init__(self):
+        self.active = 0
+        self.waiters = deque()
+        self.transfers = 0
+        self.small = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+        self.deferred = 0
+
+
+class _Waiter:
+    __slots__ = ('event', 'granted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+
+class TransferScheduler:
+    """
+    Limits the downloads of large files running at once on each device.
+
+    Attributes:
+        per_device (int): Large downloads running at once per device, or
+            None (or 0) for no limit.
+        small_size (int): Size below which files are sent without waiting.
+        timeout (float): Seconds a download waits for a slot at most, or
+            None to wait as long as needed.
+    """
+
+    def __init__(self, per_device, small_size=1 << 20, timeout=None):
+        """
+        Initialize the TransferScheduler.
+
+        Parameters:
+            per_device (int): Large downloads running at once per device,
+                or None (or 0) to disable the scheduler.
+            small_size (int): Size below which files are sent without
+                waiting.
+            timeout (float): Seconds a download waits for a slot at most,
+                or None to wait as long as needed.
+        """
+        self.per_device = per_device or None
+        self.small_size = small_size
+        self.timeout = timeout
+        self._devices = {}
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, path):
+        """
+        Hold a transfer slot of the device of a file, waiting for one if
+        they are all taken.
+
+        Parameters:
+            path (Path): The local file to send, or None for files that are
+                not on a local disk, which never wait.
+
+        Raises:
+            TransferDeferred: If no slot was free within `timeout`, or the
+                scheduler was closed.
+        """
+        if self.per_device is None or path is None:
+            yield
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Let the transfer itself report the error
+            yield
+            return
+        with self._lock:
+            device = self._devices.get(st.st_dev)
+            if device is None:
+                device = self._devices[st.st_dev] = _Device()
+            device.transfers += 1
+            small = st.st_size < self.small_size
+            if small:
+                device.small += 1
+                waiter = None
+            elif device.active < self.per_device and not device.waiters:
+                device.active += 1
+                waiter = None
+            elif self._closed:
+                device.deferred += 1
+                raise TransferDeferred('Server is restarting')
+            else:
+                waiter = _Waiter()
+                device.waiters.append(waiter)
+                device.max_depth = max(device.max_depth, len(device.waiters))
+        if small:
+            yield
+            return
+        if waiter is not None:
+            started = time.monotonic()
+            waiter.event.wait(self.timeout)
+            waited = time.monotonic() - started
+            with self._lock:
+                # Decided under the lock, as the slot may be handed over
+                # right as the wait times out
+                if not waiter.granted:
+                    if waiter in device.waiters:
+                        device.waiters.remove(waiter)
+                    device.deferred += 1
+                    if self._closed:
+                        raise TransferDeferred('Server is restarting')
+                    raise TransferDeferred(f'No transfer slot free within {self.timeout:g} seconds')
+                device.waited += 1
+                device.wait_time += waited
+                device.max_wait = max(device.max_wait, waited)
+        try:
+            yield
+        finally:
+            with self._lock:
+                if device.waiters:
+                    # Hand the slot over to the longest waiting transfer
+                    waiter = device.waiters.popleft()
+                    waiter.granted = True
+                    waiter.event.set()
+                else:
+                    device.active -= 1
+
+    def close(self):
+        """
+        Wake up the waiting downloads, which give up, as will the ones that
+        would have to wait from now on. Running downloads go on.
+        """
+        with self._lock:
+            self._closed = True
+            for device in self._devices.values():
+                while device.waiters:
+                    device.waiters.popleft().event.set()
+
+    def status(self):
+        """
+        Describe the scheduler and the queues of the devices.
+
+        Returns:
+            list: Lines of text.
+        """
+        if self.per_device is None:
+            return ["Transfer scheduler: off"]
+        lines = [f"Transfer scheduler: {self.per_device} large downloads per device,"
+                 f" priority below {self.small_size} bytes"]
+        with self._lock:
+            for dev, d in sorted(self._devices.items()):
+                average = d.wait_time / d.waited if d.waited else 0.0
+                lines.append(f"Device {os.major(dev)}:{os.minor(dev)}: {d.active} active,"
+                             f" {len(d.waiters)} queued (max {d.max_depth}), {d.transfers} transfers"
+                             f" ({d.small} small), {d.waited} waited {average:.2f} s on average"
+                             f" (max {d.max_wait:.2f} s), {d.deferred} gave up")
+        return lines
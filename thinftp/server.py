@@ -7,8 +7,72 @@ It uses Python's built-in `socketserver.ThreadingTCPServer` to
 handle multiple client connections concurrently.
 """
 
+import hmac
+import signal
+import socket
 import socketserver
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from .auth import User, UserStore, FailureLimiter
+from .diagnostics import Diagnostics
+from .digest import ALGORITHMS, DigestCache
+from .fileman import FileHandler
 from .handler import ThinFTP
+from .hooks import Hooks
+from .memfs import MemoryFS, MemoryFileHandler
+from .nameindex import NameIndex
+from .pagecache import CachePolicy
+from .quota import QuotaManager, parse_size
+from .ratelimit import CommandLimiter
+from .scheduler import TransferScheduler
+from .reload import inherited_listen_fd, notify_ready, spawn_successor
+from .tls import make_server_context
+from .trace import TraceRecorder
+from .vhosts import VirtualHosts
+
+#: Default values for optional configuration settings.
+DEFAULTS = {
+    'backend': 'local',
+    'users': None,
+    'vhosts': None,
+    'login_max_failures': 5,
+    'login_window': 60.0,
+    'login_ban_time': 60.0,
+    'login_max_ban': 3600.0,
+    'login_failure_delay': 0.5,
+    'command_rate': 50.0,
+    'command_burst': 200,
+    'command_max_delay': 5.0,
+    'rate_limit_ips': 16384,
+    'list_max_depth': 32,
+    'list_max_entries': 100_000,
+    'walk_workers': 8,
+    'hash_workers': 4,
+    'digest_store': None,
+    'upload_digests': (),
+    'copy_workers': 2,
+    'certfile': None,
+    'keyfile': None,
+    'tls_required': False,
+    'drain_timeout': 300.0,
+    'statmany_max_paths': 10_000,
+    'diag_dir': None,
+    'profile_interval': 0.005,
+    'quota': None,
+    'find_index': False,
+    'find_index_store': None,
+    'find_rescan_interval': 3600.0,
+    'find_max_results': 1000,
+    'trace_file': None,
+    'sparse_uploads': False,
+    'cache_threshold': '64M',
+    'direct_uploads': None,
+    'transfers_per_device': 0,
+    'small_transfer_size': '1M',
+    'transfer_queue_timeout': 300.0,
+}
 
 class ThreadedThinFTP(socketserver.ThreadingTCPServer):
     """
@@ -17,12 +81,30 @@ class ThreadedThinFTP(socketserver.ThreadingTCPServer):
     Attributes:
         config (Namespace): A configuration object containing server settings.
         lgr (logging.Logger): Logger instance used for logging server events.
+        users (UserStore): The user database, or None in single-user mode.
+        vhosts (VirtualHosts): The virtual hosts selected with HOST, or None.
+        login_limiter (FailureLimiter): Tracks failed logins per client IP.
+        memfs (MemoryFS): The shared store of the 'memory' backend, or None.
+        digests (DigestCache): Computes and caches file checksums.
+        copy_pool (ThreadPoolExecutor): Runs background server-side copies.
+        ssl_context (ssl.SSLContext): Context shared by all TLS connections,
+            or None if FTPS is not configured.
+        hooks (Hooks): Instrumentation callbacks of the sessions and backends.
+        diagnostics (Diagnostics): The runtime profiling and tracing tools.
+        quotas (QuotaManager): Disk usage of the quota-limited homes.
+        quota (int): Disk quota of the single configured user, or None.
+        cache_policy (CachePolicy): How large transfers use the page cache.
+        scheduler (TransferScheduler): Limits the large downloads per disk.
+        name_index (NameIndex): Filename index of the served directory for
+            SITE FIND, or None if disabled.
+        sessions (set): Handlers of the currently connected clients.
+        draining (bool): Set once the server stops serving for a restart.
     """
 
     # Ensure each request is handled in a separate daemon thread
     daemon_threads = True
     
-    def __init__(self, addr, handler, config):
+    def __init__(self, addr, handler, config, listen_fd=None):
         """
         Initialize the threaded FTP server.
 
@@ -30,12 +112,220 @@ class ThreadedThinFTP(socketserver.ThreadingTCPServer):
             addr (tuple): (host, port) address tuple to bind the server.
             handler (BaseRequestHandler): Handler class for processing requests.
             config (Namespace): Configuration object with server parameters.
+            listen_fd (int, optional): An already listening socket to serve
+                on instead of binding `addr`, as passed on restarts.
         """
-        super().__init__(addr, handler)
+        super().__init__(addr, handler, bind_and_activate=listen_fd is None)
+        if listen_fd is not None:
+            self.socket.close()
+            self.socket = socket.socket(fileno=listen_fd)
+            self.server_address = self.socket.getsockname()
+        for key, value in DEFAULTS.items():
+            if not hasattr(config, key):
+                setattr(config, key, value)
         self.config = config
         self.lgr = config.lgr
         del config.lgr
 
+        self.users = UserStore(config.users, config.directory) if config.users else None
+        self.vhosts = VirtualHosts(config.vhosts, config.directory) if config.vhosts else None
+        self.login_limiter = FailureLimiter(config.login_max_failures, config.login_window,
+                                            config.rate_limit_ips, config.login_ban_time,
+                                            config.login_max_ban, config.login_failure_delay)
+        self.command_limiter = CommandLimiter(config.command_rate, config.command_burst,
+                                              config.command_max_delay, config.rate_limit_ips
+                                              ) if config.command_rate else None
+        if config.backend not in ('local', 'memory'):
+            raise ValueError(f"Unknown backend: {config.backend!r}")
+        self.memfs = MemoryFS() if config.backend == 'memory' else None
+        self.digests = DigestCache(config.hash_workers, store=config.digest_store)
+        if isinstance(config.upload_digests, str):
+            config.upload_digests = [a for a in config.upload_digests.upper().split(',') if a]
+        for algo in config.upload_digests:
+            if algo not in ALGORITHMS:
+                raise ValueError(f"Unknown digest algorithm: {algo!r}")
+        self.copy_pool = ThreadPoolExecutor(config.copy_workers, thread_name_prefix='thinftp-copy')
+        self.ssl_context = make_server_context(config.certfile, config.keyfile) if config.certfile else None
+        if config.tls_required and self.ssl_context is None:
+            raise ValueError("tls_required needs a certfile")
+        self.hooks = Hooks(self.lgr)
+        self.diagnostics = Diagnostics(self.hooks, config.diag_dir or tempfile.gettempdir(),
+                                       self.lgr, config.profile_interval)
+        self.quotas = QuotaManager(self.hooks)
+        self.cache_policy = CachePolicy(parse_size(config.cache_threshold),
+                                        parse_size(config.direct_uploads))
+        self.scheduler = TransferScheduler(config.transfers_per_device,
+                                           parse_size(config.small_transfer_size),
+                                           config.transfer_queue_timeout)
+        self.quota = parse_size(config.quota)
+        if self.memfs is None:
+            # Measure the quota-limited homes now, rather than at first login
+            if self.users is not None:
+                homes = [user.home for user in self.users if user.quota is not None]
+            else:
+                homes = [config.directory] if self.quota is not None else []
+            for host in self.vhosts or ():
+                homes += [user.home for user in host.users if user.quota is not None]
+            for home in homes:
+                self.quotas.index_for(home)
+        self.name_index = None
+        if config.find_index and self.memfs is None:
+            self.name_index = NameIndex(config.directory, config.find_index_store,
+                                        config.find_rescan_interval)
+            self.hooks.add(self.name_index)
+            self.name_index.start()
+        if self.vhosts is not None:
+            self.hooks.add(self.vhosts)
+        self.trace = None
+        if config.trace_file:
+            self.trace = TraceRecorder(config.trace_file)
+            self.hooks.add(self.trace)
+        self.sessions = set()
+        self.draining = False
+        self._sessions_cond = threading.Condition()
+
+    def add_session(self, session):
+        """
+        Register the handler of a newly connected client.
+
+        Parameters:
+            session (ThinFTP): The handler.
+        """
+        with self._sessions_cond:
+            self.sessions.add(session)
+
+    def remove_session(self, session):
+        """
+        Unregister the handler of a disconnected client.
+
+        Parameters:
+            session (ThinFTP): The handler.
+        """
+        with self._sessions_cond:
+            self.sessions.discard(session)
+            self._sessions_cond.notify_all()
+
+    def graceful_restart(self):
+        """
+        Hand the listening socket to a new server process and stop serving.
+
+        Runs in its own thread (the `SIGUSR2` handler starts it). If the new
+        process fails to start, this one keeps serving.
+        """
+        self.lgr.info("Starting a new server process for graceful restart")
+        proc = spawn_successor(self.socket.fileno(), self.config.pswd)
+        if proc is None:
+            self.lgr.error("New server process failed to start. Keeping this one running")
+            return
+        self.lgr.success(f"New server process {proc.pid} is serving. Draining this one")
+        self.draining = True
+        self.shutdown()
+
+    def drain(self, timeout):
+        """
+        Wait for the connected clients to finish, for a restart.
+
+        Idle sessions are closed right away with a 421 reply; the others
+        finish the command in progress (typically a transfer) first, except
+        for downloads still waiting for a slot of their disk, which give up.
+
+        Parameters:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            int: The number of sessions still connected at the end.
+        """
+        self.draining = True
+        self.scheduler.close()
+        with self._sessions_cond:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.interrupt()
+        with self._sessions_cond:
+            self._sessions_cond.wait_for(lambda: not self.sessions, timeout)
+            return len(self.sessions)
+
+    def server_close(self):
+        """
+        Close the listening socket, persist the digest cache and stop
+        accepting background jobs.
+        """
+        super().server_close()
+        self.digests.close()
+        if self.name_index is not None:
+            self.name_index.stop()
+        if self.trace is not None:
+            self.trace.close()
+        self.copy_pool.shutdown(wait=False)
+
+    def open_fileman(self, user):
+        """
+        Create the filesystem backend for a newly logged in user.
+
+        With the 'memory' backend, the user's home is mapped to the same
+        location relative to the served directory inside the shared store.
+        Quotas only apply to the local disk.
+
+        Parameters:
+            user (User): The authenticated user.
+
+        Returns:
+            FileBackend: The backend rooted at the user's home.
+        """
+        if self.memfs is None:
+            fileman = FileHandler(user.home, self.config.walk_workers)
+            fileman.sparse = self.config.sparse_uploads
+            fileman.cache = self.cache_policy
+            if user.quota is not None:
+                fileman.quota = user.quota
+                fileman.usage = self.quotas.index_for(user.home)
+        else:
+            base = Path(self.config.directory).resolve()
+            home = user.home.relative_to(base).as_posix() if user.home.is_relative_to(base) else '.'
+            fileman = MemoryFileHandler(self.memfs, home)
+        fileman.hooks = self.hooks
+        return fileman
+
+    def authenticate(self, uname, pswd, vhost=None):
+        """
+        Authenticate a user against the users of a virtual host, the user
+        database or the single configured user.
+
+        Parameters:
+            uname (str): The login name.
+            pswd (str): The plaintext password.
+            vhost (VirtualHost): The host selected by the session, if any.
+
+        Returns:
+            User: The authenticated user, or None if authentication failed.
+        """
+        if vhost is not None:
+            return vhost.users.verify(uname, pswd)
+        if self.users is not None:
+            return self.users.verify(uname, pswd)
+        if (uname == self.config.user) and hmac.compare_digest(pswd.encode(), self.config.pswd.encode()):
+            # The single configured user is the server's operator
+            return User(uname, None, self.config.directory, admin=True, quota=self.quota)
+        return None
+
+    def reload_users(self, *_):
+        """
+        Reload the user database and the virtual hosts. Installed as the
+        `SIGHUP` handler.
+        """
+        if self.users is not None:
+            try:
+                self.users.reload()
+                self.lgr.success(f"Reloaded {len(self.users)} users from {self.config.users}")
+            except (OSError, ValueError) as e:
+                self.lgr.error(f"Failed to reload users, keeping the old ones: {e}")
+        if self.vhosts is not None:
+            try:
+                self.vhosts.reload()
+                self.lgr.success(f"Reloaded {len(self.vhosts)} virtual hosts from {self.config.vhosts}")
+            except (OSError, ValueError) as e:
+                self.lgr.error(f"Failed to reload virtual hosts, keeping the old ones: {e}")
+
 def start_server(config):
     """
     Start and run the FTP server using the provided configuration.
@@ -50,18 +340,62 @@ def start_server(config):
             - user (str): FTP username.
             - pswd (str): FTP password.
             - directory (str): Directory to serve.
+            - users (str, optional): Path to a users file. Overrides user/pswd.
+            - vhosts (str, optional): Path to a virtual hosts file, serving
+              tenants selected with HOST.
+            - backend (str, optional): 'local' (default) or 'memory'.
+            - certfile/keyfile (str, optional): Enable FTPS (AUTH TLS).
+            - upload_digests (list, optional): Digests computed during
+              uploads and reported in their 226 replies.
+            - drain_timeout (float, optional): Seconds to let sessions finish
+              after a graceful restart (`SIGUSR2`).
+            - diag_dir (str, optional): Where profiles and memory snapshots
+              are written (`SIGUSR1`, `SITE DIAG`).
+            - find_index (bool, optional): Index the served directory for
+              `SITE FIND`.
             - lgr (Logger): Preconfigured logger instance.
     """
-    with ThreadedThinFTP((config.bind, config.port), ThinFTP, config) as server:
-        server.lgr.success(f"Server is now running at {config.bind}:{config.port}")
-        server.lgr.debug(f"The Credentials are: [username: {config.user!r}, password: {config.pswd!r}]")
-        server.lgr.success(f"The directory served is: {config.directory}")
+    listen_fd = inherited_listen_fd()
+    with ThreadedThinFTP((config.bind, config.port), ThinFTP, config, listen_fd) as server:
+        host, port = server.server_address[:2]
+        if listen_fd is not None:
+            server.lgr.success(f"Server took over the listening socket at {host}:{port}")
+        else:
+            server.lgr.success(f"Server is now running at {host}:{port}")
+        if server.users is not None:
+            server.lgr.success(f"Loaded {len(server.users)} users from {config.users}")
+        else:
+            server.lgr.debug(f"The Credentials are: [username: {config.user!r}, password: {config.pswd!r}]")
+        if server.vhosts is not None:
+            server.lgr.success(f"Serving {len(server.vhosts)} virtual hosts from {config.vhosts}")
+        if (server.users is not None or server.vhosts is not None) and hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, server.reload_users)
+        if server.ssl_context is not None:
+            required = " (required)" if config.tls_required else ""
+            server.lgr.success(f"FTPS is enabled{required}")
+        if server.memfs is not None:
+            server.lgr.success("Serving an in-memory filesystem")
+        else:
+            server.lgr.success(f"The directory served is: {config.directory}")
+            if server.name_index is not None:
+                server.lgr.success("Indexing file names for SITE FIND")
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, lambda *_: threading.Thread(target=server.graceful_restart).start())
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, server.diagnostics.toggle_profiler)
+        notify_ready()
         try:
             server.serve_forever()
+            if server.draining:
+                server.socket.close()
+                left = server.drain(config.drain_timeout)
+                if left:
+                    server.lgr.error(f"Drain timeout reached, dropping {left} sessions")
+                else:
+                    server.lgr.info("All sessions finished")
         except KeyboardInterrupt:
             server.lgr.info("Gracefully Shutting down Server upon user interrupt")
             server.shutdown()
             server.server_close()
         finally:
             server.lgr.info("Server Shutdown Successfully")
-        
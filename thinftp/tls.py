@@ -0,0 +1,49 @@
+"""
+TLS support for thinFTP (FTPS, RFC 4217).
+
+This module builds the `ssl.SSLContext` shared by every control and data
+connection of a server. Sharing one context matters: OpenSSL keeps its
+server-side session cache and session-ticket keys per context, so a client
+that resumes its control connection's TLS session on each PASV data
+connection skips the full handshake for every transfer.
+
+Where the kernel and the ssl module support it, kernel TLS is enabled so
+that record encryption happens in the kernel instead of in user space.
+
+A self-signed certificate for local testing can be generated with::
+
+    openssl req -x509 -newkey rsa:2048 -nodes -days 365 \\
+        -subj /CN=localhost -keyout key.pem -out cert.pem
+
+Functions:
+    make_server_context: Create the server-side TLS context.
+"""
+
+import ssl
+
+#: Read size for encrypted transfers. Larger reads let each SSL_write
+#: fill several maximum-size (16 KiB) records per system call.
+TLS_CHUNK_SIZE = 256 * 1024
+
+
+def make_server_context(certfile, keyfile=None):
+    """
+    Create the server-side TLS context.
+
+    Parameters:
+        certfile (str): PEM file holding the certificate chain.
+        keyfile (str): PEM file holding the private key, if not in `certfile`.
+
+    Returns:
+        ssl.SSLContext: The configured context.
+
+    Raises:
+        OSError: If the certificate or key cannot be read.
+        ssl.SSLError: If the certificate or key is invalid.
+    """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    ctx.load_cert_chain(certfile, keyfile)
+    # Kernel TLS (Python 3.12+ on Linux with the tls module loaded)
+    ctx.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+    return ctx
@@ -0,0 +1,264 @@
+"""
+Session traces for thinFTP: recording real traffic to replay it later.
+
+Synthetic benchmarks rarely match the command mix of production traffic. A
+`TraceRecorder` registered on the server's hooks records every session as a
+sequence of commands, with their timing, reply codes and the bytes they
+moved over the data connection, so that `benchmarks/replay.py` can drive a
+test server with the same traffic shape.
+
+Traces are anonymized as they are recorded: credentials are dropped, and
+every path component is replaced by a keyed hash (keeping short file
+extensions), the key being random for each trace. Names thus stay
+consistent within a trace, so that a replay reads back what it wrote, but
+cannot be recovered nor linked across traces.
+
+A trace is a gzip-compressed file of JSON lines. The first line is a header,
+each further line a session, written when it ends::
+
+    {"format": "thinftp-trace", "version": 1, "started": 1767225600.0}
+    {"start": 12.5, "cmds": [[0, "USER", "", 331, 0.1, 0],
+                             [40, "RETR", "5f0c2e9ab1d4.csv", 226, 8.2, 52211], ...]}
+
+`start` is the offset of the session from the start of the trace, in
+seconds. Each command is `[offset, verb, args, reply code, elapsed, bytes]`:
+its offset from the start of the session in milliseconds, its anonymized
+arguments, the code of its final reply, the milliseconds it took and the
+bytes it sent or received over the data connection.
+
+Recording to an existing trace appends to it, with a header of its own (a
+restarted server thus continues the trace of its predecessor).
+
+Classes:
+    Anonymizer: Keyed pseudonymization of command arguments.
+    TraceRecorder: Hook object recording sessions to a trace file.
+
+Functions:
+    read_trace: Read the header and sessions of a trace file.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from .wildcard import has_magic
+
+#: Identifies trace files.
+TRACE_FORMAT = 'thinftp-trace'
+#: Version of the trace format.
+TRACE_VERSION = 1
+
+#: Verbs whose arguments carry no names, and are recorded as is.
+PLAIN_ARGS_VERBS = frozenset({
+    'ABOR', 'ALLO', 'AUTH', 'CDUP', 'EPSV', 'FEAT', 'HELP', 'MODE', 'NOOP',
+    'OPTS', 'PASV', 'PBSZ', 'PROT', 'PWD', 'QUIT', 'RANG', 'REST', 'STRU',
+    'SYST', 'TYPE',
+})
+#: Verbs whose arguments are dropped.
+SECRET_ARGS_VERBS = frozenset({'USER', 'PASS', 'ACCT', 'PORT', 'EPRT', 'HOST'})
+
+
+class Anonymizer:
+    """
+    Replaces the names in command arguments by keyed hashes.
+    """
+
+    def __init__(self, key=None):
+        """
+        Initialize the Anonymizer.
+
+        Parameters:
+            key (bytes): Key of the hashes. Random by default.
+        """
+        self.key = key or os.urandom(16)
+
+    def name(self, name):
+        """
+        Pseudonymize a single path component.
+
+        Parameters:
+            name (str): The component.
+
+        Returns:
+            str: The pseudonym, with the extension of `name` if it is short.
+        """
+        if name in ('', '.', '..'):
+            return name
+        stem, dot, ext = name.rpartition('.')
+        if not (stem and dot and len(ext) <= 5 and ext.isalnum()):
+            stem, ext = name, ''
+        if has_magic(stem):
+            stem = '*'
+        else:
+            stem = hashlib.blake2b(stem.encode(errors='surrogateescape'), key=self.key,
+                                   digest_size=6).hexdigest()
+        return f"{stem}.{ext}" if ext else stem
+
+    def path(self, path):
+        """
+        Pseudonymize every component of a path.
+
+        Parameters:
+            path (str): The path.
+
+        Returns:
+            str: The path with the same structure and pseudonymous names.
+        """
+        return '/'.join(self.name(part) for part in path.split('/'))
+
+    def args(self, verb, args):
+        """
+        Anonymize the arguments of a command.
+
+        Options (words starting with '-') and the subcommand of `SITE` are
+        kept; the rest is taken as a path.
+
+        Parameters:
+            verb (str): The command verb, in upper case.
+            args (str): Its arguments.
+
+        Returns:
+            str: The anonymized arguments.
+        """
+        if verb in PLAIN_ARGS_VERBS or not args:
+            return args
+        if verb in SECRET_ARGS_VERBS:
+            return ''
+        words = args.split(' ')
+        kept = []
+        if verb == 'SITE':
+            kept.append(words.pop(0).upper())
+        while words and words[0].startswith('-'):
+            kept.append(words.pop(0))
+        if words:
+            kept.append(self.path(' '.join(words)))
+        return ' '.join(kept)
+
+
+class _SessionRecord:
+    __slots__ = ('start', 'cmds', 'transferred')
+
+    def __init__(self, start):
+        self.start = start
+        self.cmds = []
+        self.transferred = 0
+
+
+class TraceRecorder:
+    """
+    Records sessions to a trace file, as hooks of the server.
+
+    Attributes:
+        path (str): The trace file.
+        anonymizer (Anonymizer): Pseudonymizes command arguments.
+        sessions (int): Number of sessions written.
+    """
+
+    def __init__(self, path, anonymizer=None):
+        """
+        Initialize the TraceRecorder and write the header of the trace.
+
+        Parameters:
+            path (str): The trace file, appended to if it exists.
+            anonymizer (Anonymizer): Pseudonymizes command arguments.
+                Defaults to one with a random key.
+        """
+        self.path = path
+        self.anonymizer = anonymizer or Anonymizer()
+        self.sessions = 0
+        self._started = time.monotonic()
+        self._records = {}
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._write({'format': TRACE_FORMAT, 'version': TRACE_VERSION, 'started': time.time()})
+
+    def _write(self, obj):
+        self._file.write(json.dumps(obj, separators=(',', ':')) + '\n')
+        self._file.flush()
+
+    def on_connect(self, session):
+        with self._lock:
+            self._records[session] = _SessionRecord(time.monotonic())
+
+    def on_transfer_chunk(self, session, direction, size):
+        record = self._records.get(session)
+        if record is not None:
+            record.transferred += size
+
+    def on_command_end(self, session, verb, args, reply, elapsed):
+        record = self._records.get(session)
+        if record is None:
+            return
+        now = time.monotonic()
+        code = int(reply[:3]) if reply and reply[:3].isdigit() else 0
+        record.cmds.append([round((now - elapsed - record.start) * 1000), verb,
+                            self.anonymizer.args(verb, args), code,
+                            round(elapsed * 1000, 1), record.transferred])
+        record.transferred = 0
+
+    def on_disconnect(self, session):
+        with self._lock:
+            record = self._records.pop(session, None)
+            if record is None or not record.cmds or self._file is None:
+                return
+            self._write({'start': round(record.start - self._started, 3), 'cmds': record.cmds})
+            self.sessions += 1
+
+    def close(self):
+        """
+        Close the trace file. Sessions still open are not recorded.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_trace(path):
+    """
+    Read a trace file.
+
+    Recordings appended to the same file are merged, the start of their
+    sessions being made relative to the first recording.
+
+    Parameters:
+        path (str): The trace file.
+
+    Returns:
+        tuple: (header, sessions), where header is the first header and
+        sessions is a list of dicts with `start` and `cmds` keys, ordered by
+        start.
+
+    Raises:
+        ValueError: If the file is not a trace.
+    """
+    header = None
+    sessions = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                obj = None
+            if not isinstance(obj, dict):
+                raise ValueError(f"Not a thinFTP trace: {path}")
+            if 'format' in obj:
+                if obj['format'] != TRACE_FORMAT:
+                    raise ValueError(f"Not a thinFTP trace: {path}")
+                if obj.get('version') != TRACE_VERSION:
+                    raise ValueError(f"Unsupported trace version: {obj.get('version')!r}")
+                header = header or obj
+                shift = obj['started'] - header['started']
+            elif header is None:
+                raise ValueError(f"Not a thinFTP trace: {path}")
+            else:
+                obj['start'] += shift
+                sessions.append(obj)
+    if header is None:
+        raise ValueError(f"Not a thinFTP trace: {path}")
+    sessions.sort(key=lambda s: s['start'])
+    return header, sessions
@@ -0,0 +1,345 @@
+"""
+Parallel server-side tree operations for thinFTP.
+
+Removing a directory tree over FTP takes a `DELE` or `RMD` round trip per
+entry, which for a build-artifact tree of a few hundred thousand files adds
+up to minutes. `SITE RMTREE` and `SITE CHMOD -R` instead run the whole
+operation on the server, as a `TreeOperation`: directories are scanned with
+`os.scandir` on a pool of threads, their files processed as they are
+listed, and each directory itself once its whole subtree is done (post
+order), since a directory can only be removed once empty, and must stay
+readable until it has been scanned.
+
+Like `shutil.rmtree` on platforms that support it, the operations walk the
+tree with directory file descriptors: each directory is opened relative to
+its parent with `O_NOFOLLOW`, from a trusted base directory down, and its
+entries are processed relative to it. A directory replaced by a symbolic
+link while the operation runs is thus never followed out of the tree.
+Symbolic links are removed like files, and left alone by chmod. Entries
+that fail (e.g. for lack of permissions) are counted and skipped, and the
+operation goes on with the rest.
+
+An operation is run by iterating over `run()`, which yields regularly so
+that the caller can report progress and `cancel()` it. Cancelling stops
+the scans at the next entry; what was done stays done.
+
+Classes:
+    TreeOperation: A parallel post-order operation over a directory tree.
+
+Functions:
+    remove_tree: Prepare the removal of a directory tree.
+    chmod_tree: Prepare the change of the mode of a directory tree.
+    chmod_path: Change the mode of a file or directory without following
+        symbolic links.
+"""
+
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+#: Seconds between two yields of `TreeOperation.run`, by default.
+YIELD_INTERVAL = 0.25
+
+_DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+_FILE_FLAGS = os.O_NONBLOCK | getattr(os, 'O_NOFOLLOW', 0)
+
+
+def _open_dir(base_fd, parts):
+    """
+    Open a directory below a base directory, one component at a time,
+    without following symbolic links.
+
+    Returns:
+        int: A new file descriptor of the directory, to close.
+    """
+    fd = os.dup(base_fd)
+    try:
+        for name in parts:
+            sub = os.open(name, _DIR_FLAGS, dir_fd=fd)
+            os.close(fd)
+            fd = sub
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _scan(base_fd, parts, file_op, stop):
+    """
+    Apply `file_op` to the entries of a directory that are not directories.
+
+    Returns:
+        tuple: (subdirs, files, size, errors).
+    """
+    subdirs = []
+    files = size = errors = 0
+    try:
+        fd = _open_dir(base_fd, parts)
+    except OSError:
+        return subdirs, files, size, 1
+    try:
+        with os.scandir(fd) as it:
+            for entry in it:
+                if stop.is_set():
+                    break
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(parts + (entry.name,))
+                        continue
+                    done = file_op(fd, entry)
+                except OSError:
+                    errors += 1
+                    continue
+                if done is not None:
+                    files += 1
+                    size += done
+    except OSError:
+        errors += 1
+    finally:
+        os.close(fd)
+    return subdirs, files, size, errors
+
+
+class TreeOperation:
+    """
+    A post-order operation over a directory tree, run on a pool of threads.
+
+    Attributes:
+        root (str): The directory the operation applies to, itself included.
+        files (int): Regular files processed so far.
+        dirs (int): Directories processed so far.
+        bytes (int): Total size of the files processed so far.
+        errors (int): Entries that could not be processed.
+        cancelled (bool): Whether the operation was cancelled.
+    """
+
+    def __init__(self, base, parts, file_op, dir_op, workers=8, finish=None):
+        """
+        Initialize the TreeOperation. Iterate over `run()` to perform it.
+
+        Parameters:
+            base (str): A trusted directory, opened as is.
+            parts (tuple): The components of the path of the directory to
+                operate on, relative to `base`, none of which is followed if
+                it is a symbolic link.
+            file_op (callable): Called with the file descriptor of a
+                directory and the `os.DirEntry` of each of its entries that
+                is not a directory, from the pool's threads. Returns the
+                size to count, or None to not count the entry.
+            dir_op (callable): Called with the file descriptor of the
+                parent of each directory and the directory's name, once its
+                subtree is done.
+            workers (int): Number of threads.
+            finish (callable): Called with the operation once it has ended,
+                however it ended.
+        """
+        self.base = str(base)
+        self.parts = tuple(parts)
+        self.root = os.path.join(self.base, *self.parts)
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.cancelled = False
+        self._file_op = file_op
+        self._dir_op = dir_op
+        self._workers = workers
+        self._finish = finish
+        self._stop = threading.Event()
+
+    def _add(self, result):
+        subdirs, files, size, errors = result
+        self.files += files
+        self.bytes += size
+        self.errors += errors
+        return subdirs
+
+    def _finish_dir(self, base_fd, parts):
+        try:
+            fd = _open_dir(base_fd, parts[:-1])
+            try:
+                self._dir_op(fd, parts[-1] if parts else os.curdir)
+            finally:
+                os.close(fd)
+            self.dirs += 1
+        except OSError:
+            self.errors += 1
+
+    def run(self, interval=YIELD_INTERVAL):
+        """
+        Perform the operation.
+
+        Yields:
+            TreeOperation: The operation itself, every `interval` seconds
+            while it runs, with its counters current.
+
+        Raises:
+            OSError: If the base directory cannot be opened.
+        """
+        try:
+            base_fd = os.open(self.base, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        except OSError:
+            if self._finish is not None:
+                self._finish(self)
+            raise
+        pool = ThreadPoolExecutor(self._workers, thread_name_prefix='thinftp-tree')
+        pending = {pool.submit(_scan, base_fd, self.parts, self._file_op, self._stop): self.parts}
+        parents = {}
+        remaining = {}
+        next_yield = time.monotonic() + interval
+        try:
+            while pending:
+                done, _ = wait(pending, max(next_yield - time.monotonic(), 0), FIRST_COMPLETED)
+                for fut in done:
+                    parts = pending.pop(fut)
+                    subdirs = self._add(fut.result())
+                    if self._stop.is_set():
+                        continue
+                    remaining[parts] = len(subdirs)
+                    for sub in subdirs:
+                        parents[sub] = parts
+                        pending[pool.submit(_scan, base_fd, sub, self._file_op, self._stop)] = sub
+                    # Finish the directories whose subtrees are now done
+                    while parts is not None and remaining.get(parts) == 0:
+                        del remaining[parts]
+                        self._finish_dir(base_fd, parts)
+                        parts = parents.pop(parts, None)
+                        if parts is not None:
+                            remaining[parts] -= 1
+                if time.monotonic() >= next_yield:
+                    yield self
+                    next_yield = time.monotonic() + interval
+        finally:
+            self._stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+            for fut in pending:
+                if not fut.cancelled():
+                    self._add(fut.result())
+            os.close(base_fd)
+            if self._finish is not None:
+                self._finish(self)
+
+    def cancel(self):
+        """
+        Stop the operation at the next entry. `run` then returns shortly.
+        """
+        self.cancelled = True
+        self._stop.set()
+
+    def status(self):
+        """
+        Describe the progress of the operation.
+
+        Returns:
+            str: A line of text.
+        """
+        errors = f", {self.errors} errors" if self.errors else ""
+        return f"{self.files} files ({self.bytes} bytes) and {self.dirs} directories{errors}"
+
+
+def _unlink(dir_fd, entry):
+    st = entry.stat(follow_symlinks=False)
+    os.unlink(entry.name, dir_fd=dir_fd)
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+def _rmdir(dir_fd, name):
+    os.rmdir(name, dir_fd=dir_fd)
+
+
+def _fchmod_at(dir_fd, name, mode, directory=False):
+    """
+    Change the mode of an entry of a directory through a file descriptor,
+    which fails on symbolic links.
+
+    Returns:
+        os.stat_result: The status of the entry, before the change.
+    """
+    if directory:
+        fd = os.open(name, _DIR_FLAGS, dir_fd=dir_fd)
+    else:
+        try:
+            fd = os.open(name, os.O_RDONLY | _FILE_FLAGS, dir_fd=dir_fd)
+        except PermissionError:
+            fd = os.open(name, os.O_WRONLY | _FILE_FLAGS, dir_fd=dir_fd)
+    try:
+        st = os.fstat(fd)
+        if not (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+            raise OSError(f"Not a regular file: {name}")
+        os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+    return st
+
+
+def remove_tree(base, parts, workers=8, finish=None):
+    """
+    Prepare the removal of a directory tree, the directory included.
+
+    Parameters:
+        base (str): A trusted directory, opened as is.
+        parts (tuple): The components of the path of the directory to
+            remove, relative to `base`.
+        workers (int): Number of threads.
+        finish (callable): Called with the operation once it has ended.
+
+    Returns:
+        TreeOperation: The operation, counting removed regular files and
+        their size. Links and other special files are removed uncounted.
+    """
+    return TreeOperation(base, parts, _unlink, _rmdir, workers, finish)
+
+
+def chmod_tree(base, parts, mode, workers=8, finish=None):
+    """
+    Prepare the change of the mode of every file and directory of a tree.
+
+    Parameters:
+        base (str): A trusted directory, opened as is.
+        parts (tuple): The components of the path of the directory to
+            change, relative to `base`.
+        mode (int): The new permission bits.
+        workers (int): Number of threads.
+        finish (callable): Called with the operation once it has ended.
+
+    Returns:
+        TreeOperation: The operation, counting changed files and their size.
+    """
+    def chmod_file(dir_fd, entry):
+        if not entry.is_file(follow_symlinks=False):
+            return None
+        return _fchmod_at(dir_fd, entry.name, mode).st_size
+
+    def chmod_dir(dir_fd, name):
+        _fchmod_at(dir_fd, name, mode, directory=True)
+
+    return TreeOperation(base, parts, chmod_file, chmod_dir, workers, finish)
+
+
+def chmod_path(base, parts, mode):
+    """
+    Change the mode of a file or directory, without following symbolic
+    links, in its path or as itself.
+
+    Parameters:
+        base (str): A trusted directory, opened as is.
+        parts (tuple): The components of the path of the entry, relative to
+            `base`.
+        mode (int): The new permission bits.
+
+    Raises:
+        OSError: If the entry cannot be changed, or is a symbolic link.
+    """
+    base_fd = os.open(base, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        fd = _open_dir(base_fd, parts[:-1])
+    finally:
+        os.close(base_fd)
+    try:
+        name = parts[-1] if parts else os.curdir
+        st = os.stat(name, dir_fd=fd, follow_symlinks=False)
+        _fchmod_at(fd, name, mode, directory=stat.S_ISDIR(st.st_mode))
+    finally:
+        os.close(fd)
@@ -0,0 +1,274 @@
+"""
+Virtual hosts for thinFTP (RFC 7151 `HOST`).
+
+A single server process can serve many tenants, each with its own root
+directory, users and limits, instead of running one process per tenant.
+Clients select a tenant with `HOST <name>` before logging in; sessions
+that send no `HOST` get the default host, if one is configured, or else
+the server's own users.
+
+The hosts are read from a JSON file (reloaded with the users, upon
+`SIGHUP`)::
+
+    {
+        "default": "ftp.example.com",
+        "hosts": {
+            "ftp.example.com": {
+                "aliases": ["example.com"],
+                "directory": "example",
+                "users": {
+                    "alice": {"password": "pbkdf2_sha256$...", "home": "alice"}
+                },
+                "max_sessions": 50,
+                "quota": "10G"
+            },
+            "ftp.other.org": {
+                "directory": "/srv/other",
+                "users": "other-users.json",
+                "writable": false
+            }
+        }
+    }
+
+Relative host directories are resolved against the served directory, and
+user homes against the host directory, which they cannot leave. `users` is
+either the "users" object of a users file (see `thinftp.auth`) or the path
+of a users file, relative to the hosts file. The optional limits are the
+number of sessions logged in at once (`max_sessions`), read-only access
+for all users of the host (`writable`) and a quota for the users that have
+none of their own (`quota`). Users of virtual hosts are never admins, as
+the administrative commands act on the whole server.
+
+Each host counts its sessions, logins, commands and transferred bytes, as
+reported by `SITE HOSTS`. The counters survive reloads.
+
+Classes:
+    HostMetrics: The counters of a virtual host.
+    VirtualHost: A tenant of the server.
+    VirtualHosts: The virtual hosts of the server, loaded from a file.
+"""
+
+import json
+import threading
+from pathlib import Path
+from .auth import UserStore
+from .quota import parse_size
+
+
+class HostMetrics:
+    """
+    The counters of a virtual host.
+
+    Attributes:
+        counters (dict): The counters: sessions logged in (`active`),
+            `logins`, `failed_logins`, logins `refused` for the session
+            limit, `commands`, `bytes_sent` and `bytes_received`.
+    """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(('active', 'logins', 'failed_logins', 'refused', 'commands',
+                                       'bytes_sent', 'bytes_received'), 0)
+        self._lock = threading.Lock()
+
+    def count(self, counter, n=1):
+        """
+        Add to one of the counters.
+
+        Parameters:
+            counter (str): The counter.
+            n (int): The amount to add.
+        """
+        with self._lock:
+            self.counters[counter] += n
+
+    def acquire(self, limit):
+        """
+        Count a login, unless the host is full.
+
+        Parameters:
+            limit (int): Maximum number of sessions logged in at once, or
+                None.
+
+        Returns:
+            bool: False if the login was refused for the limit.
+        """
+        with self._lock:
+            if limit is not None and self.counters['active'] >= limit:
+                self.counters['refused'] += 1
+                return False
+            self.counters['active'] += 1
+            self.counters['logins'] += 1
+            return True
+
+    def release(self):
+        """
+        Count the end of a session counted by `acquire`.
+        """
+        with self._lock:
+            self.counters['active'] -= 1
+
+
+class VirtualHost:
+    """
+    A tenant of the server.
+
+    Attributes:
+        name (str): The host name, in lower case.
+        aliases (tuple): Other names of the host.
+        directory (Path): The root directory of the host.
+        users (UserStore): The users of the host.
+        max_sessions (int): Maximum number of sessions logged in at once,
+            or None.
+        metrics (HostMetrics): The counters of the host.
+    """
+
+    def __init__(self, name, directory, users, aliases=(), max_sessions=None, metrics=None):
+        """
+        Initialize the VirtualHost.
+
+        Parameters:
+            name (str): The host name.
+            directory (str): The root directory of the host.
+            users (UserStore): The users of the host.
+            aliases (iterable): Other names of the host.
+            max_sessions (int): Maximum number of sessions logged in at
+                once, or None.
+            metrics (HostMetrics): Counters to carry on, e.g. from before a
+                reload. New ones by default.
+        """
+        self.name = name.lower()
+        self.aliases = tuple(alias.lower() for alias in aliases)
+        self.directory = Path(directory).resolve()
+        self.users = users
+        self.max_sessions = max_sessions
+        self.metrics = metrics or HostMetrics()
+
+    def __repr__(self):
+        return f"VirtualHost({self.name!r}, directory={str(self.directory)!r})"
+
+    def status(self):
+        """
+        Describe the host and its counters.
+
+        Returns:
+            str: A line of text.
+        """
+        c = dict(self.metrics.counters)
+        limit = f"/{self.max_sessions}" if self.max_sessions is not None else ""
+        return (f"{self.name}: {c['active']}{limit} sessions, {c['logins']} logins"
+                f" ({c['failed_logins']} failed, {c['refused']} refused), {c['commands']} commands,"
+                f" {c['bytes_sent']} bytes sent, {c['bytes_received']} received")
+
+
+class VirtualHosts:
+    """
+    The virtual hosts of the server, loaded from a file.
+
+    Registered on the server's hooks, it counts the commands and transfers
+    of the sessions of each host.
+
+    Attributes:
+        path (Path): Location of the hosts file.
+        base_dir (Path): Directory against which relative host directories
+            are resolved.
+        default (VirtualHost): Host of the sessions that send no HOST, or
+            None.
+    """
+
+    def __init__(self, path, base_dir):
+        """
+        Initialize the VirtualHosts and load the hosts file.
+
+        Parameters:
+            path (str): Location of the hosts file.
+            base_dir (str): Directory used to resolve relative host
+                directories.
+
+        Raises:
+            OSError: If the hosts file, or a users file, cannot be read.
+            ValueError: If the hosts file, or a users file, is malformed.
+        """
+        self.path = Path(path)
+        self.base_dir = Path(base_dir).resolve()
+        self.default = None
+        self._hosts = {}
+        self._names = {}
+        self.reload()
+
+    def reload(self):
+        """
+        (Re)load the hosts file, replacing the current hosts atomically.
+
+        Hosts keep their counters across reloads. Sessions logged in keep
+        the host (and user) they logged in with.
+
+        Raises:
+            OSError: If the hosts file, or a users file, cannot be read.
+            ValueError: If the hosts file, or a users file, is malformed.
+        """
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        hosts = {}
+        names = {}
+        for name, entry in data.get('hosts', {}).items():
+            host = self._load_host(name, entry)
+            hosts[host.name] = host
+            for alias in (host.name,) + host.aliases:
+                if alias in names:
+                    raise ValueError(f"Host name {alias!r} is used twice")
+                names[alias] = host
+        default = data.get('default')
+        if default is not None and default.lower() not in names:
+            raise ValueError(f"Unknown default host: {default!r}")
+        self._hosts = hosts
+        self._names = names
+        self.default = names[default.lower()] if default is not None else None
+
+    def _load_host(self, name, entry):
+        if 'directory' not in entry:
+            raise ValueError(f"Host {name!r} has no directory")
+        directory = self.base_dir / entry['directory']
+        users = entry.get('users', {})
+        if isinstance(users, str):
+            users = UserStore(self.path.parent / users, directory)
+        else:
+            users = UserStore(None, directory, entries=users)
+        quota = parse_size(entry.get('quota'))
+        writable = entry.get('writable', True)
+        old = self._hosts.get(name.lower())
+        host = VirtualHost(name, directory, users, entry.get('aliases', ()),
+                           entry.get('max_sessions'), old.metrics if old is not None else None)
+        for user in users:
+            if not user.home.is_relative_to(host.directory):
+                raise ValueError(f"Home of user {user.name!r} is outside of host {name!r}")
+            user.writable = user.writable and writable
+            user.admin = False
+            if user.quota is None:
+                user.quota = quota
+        return host
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def __iter__(self):
+        return iter(list(self._hosts.values()))
+
+    def get(self, name):
+        """
+        Look up a host by name or alias.
+
+        Parameters:
+            name (str): The name sent with HOST, in any case.
+
+        Returns:
+            VirtualHost: The host, or None if there is no such host.
+        """
+        return self._names.get(name.lower().rstrip('.'))
+
+    def on_command_end(self, session, verb, args, reply, elapsed):
+        if session.vhost is not None and session.logged_in:
+            session.vhost.metrics.count('commands')
+
+    def on_transfer_chunk(self, session, direction, size):
+        if session.vhost is not None:
+            session.vhost.metrics.count('bytes_sent' if direction == 'send' else 'bytes_received', size)
@@ -0,0 +1,140 @@
+"""
+Parallel directory walker for thinFTP.
+
+This module implements the recursive listing used by `LIST -R`. Directories
+are scanned with `os.scandir` on a pool of threads, so that a crawl over a
+large tree is bound by the filesystem's parallelism rather than by a single
+thread issuing one `stat` at a time. Each directory's listing is yielded as
+soon as it has been scanned, allowing the caller to stream it to the client
+while deeper directories are still being read.
+
+Symbolic links are listed as links, neither followed nor statted through,
+which keeps the walk inside the root directory and guards against cycles.
+
+It also provides `tree_usage`, which totals the size of the regular files
+of a tree for disk quotas.
+
+Functions:
+    scan_dir: List a single directory in `ls -l` format.
+    walk_listing: Recursively list a tree in parallel.
+    tree_usage: Total the size and number of files in a tree.
+"""
+
+import os
+import posixpath
+import stat
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .backend import format_entry
+
+
+def scan_dir(path):
+    """
+    List a single directory in `ls -l` format.
+
+    Parameters:
+        path (str): The directory to scan.
+
+    Returns:
+        tuple: (lines, subdirs), where lines are the formatted entries sorted
+        by name and subdirs are the names of subdirectories to descend into.
+
+    Raises:
+        OSError: If the directory cannot be read.
+    """
+    lines = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            try:
+                # Links are shown as such: their target may be outside the root
+                stats = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            lines.append(format_entry(entry.name, stats))
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+    return lines, subdirs
+
+
+def walk_listing(root, max_depth=32, max_entries=100_000, workers=8):
+    """
+    Recursively list a directory tree using a pool of threads.
+
+    Directories that cannot be read are skipped. The walk stops once
+    `max_entries` entries have been produced; the caller can tell the
+    listing was truncated by counting the lines it received.
+
+    Parameters:
+        root (str): The directory to list.
+        max_depth (int): How many levels below `root` to descend.
+        max_entries (int): Maximum number of entries to produce.
+        workers (int): Number of scanning threads.
+
+    Yields:
+        tuple: (rel_dir, lines) for each directory as soon as it is scanned,
+        where rel_dir is the POSIX path relative to `root` ('.' for the root).
+    """
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thinftp-walk')
+    pending = {pool.submit(scan_dir, root): ('.', 0)}
+    count = 0
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                rel, depth = pending.pop(fut)
+                try:
+                    lines, subdirs = fut.result()
+                except OSError:
+                    continue
+                lines = lines[:max_entries - count]
+                count += len(lines)
+                yield rel, lines
+                if count >= max_entries:
+                    return
+                if depth < max_depth:
+                    for name in subdirs:
+                        sub = posixpath.join(rel, name) if rel != '.' else name
+                        fut = pool.submit(scan_dir, os.path.join(root, sub))
+                        pending[fut] = (sub, depth + 1)
+    finally:
+        for fut in pending:
+            fut.cancel()
+        pool.shutdown(wait=False)
+
+
+def tree_usage(root):
+    """
+    Total the size and number of regular files in a tree.
+
+    Symbolic links are neither followed nor counted, and unreadable
+    directories are skipped. `root` may also be a single file.
+
+    Parameters:
+        root (str): The tree to measure.
+
+    Returns:
+        tuple: (size, files), the total size in bytes and the file count.
+    """
+    try:
+        st = os.stat(root, follow_symlinks=False)
+    except OSError:
+        return 0, 0
+    if not stat.S_ISDIR(st.st_mode):
+        return (st.st_size, 1) if stat.S_ISREG(st.st_mode) else (0, 0)
+    size = files = 0
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            size += entry.stat(follow_symlinks=False).st_size
+                            files += 1
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return size, files
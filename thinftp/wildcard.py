@@ -0,0 +1,95 @@
+"""
+Wildcard matching for thinFTP listings.
+
+`LIST *.csv` and `NLST report-??.txt` filter the entries of a directory by
+a shell-style wildcard on their names. This module matches them the cheap
+way: the pattern is compiled to a regular expression once (and cached, as
+clients tend to repeat the same few patterns), and the directory is read
+with a single `os.scandir` pass, names being matched as they come. Matches
+are produced lazily, so a cap on their number bounds the work and memory
+however large the directory is.
+
+Wildcards are only expanded in the last component of a path
+(`logs/2024-*.gz`); as with most FTP servers, `*/*.gz` is not expanded.
+Patterns follow `fnmatch`: `*`, `?`, `[seq]` and `[!seq]`, matched
+case-sensitively against whole names.
+
+Functions:
+    has_magic: Tell whether a string contains wildcards.
+    compile_pattern: Compile a wildcard to a name matching function.
+    scan: Iterate over the entries of a directory matching a wildcard.
+"""
+
+import fnmatch
+import os
+import re
+from functools import lru_cache
+
+#: Characters that make a path component a wildcard.
+MAGIC_CHARS = frozenset('*?[')
+
+
+def has_magic(s):
+    """
+    Tell whether a string contains wildcard characters.
+
+    Parameters:
+        s (str): The string to check.
+
+    Returns:
+        bool: True if `s` contains `*`, `?` or `[`.
+    """
+    return not MAGIC_CHARS.isdisjoint(s)
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    """
+    Compile a wildcard to a function matching whole names.
+
+    Parameters:
+        pattern (str): The wildcard, such as `*.csv`.
+
+    Returns:
+        callable: Takes a name and returns a true value if it matches.
+    """
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def _inside(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def scan(directory, pattern, root):
+    """
+    Iterate over the entries of a directory whose name matches a wildcard.
+
+    Entries are the directory's own, so they are confined to `root` if the
+    directory is; only symbolic links can lead elsewhere, and those that
+    point outside `root`, or nowhere, are left out.
+
+    Parameters:
+        directory (str): The directory to read.
+        pattern (str): The wildcard, or None to match every entry.
+        root (str): The real path of the root directory.
+
+    Yields:
+        os.DirEntry: The matching entries, in directory order.
+
+    Raises:
+        FileNotFoundError: If the directory does not exist.
+        NotADirectoryError: If the path is not a directory.
+    """
+    match = compile_pattern(pattern) if pattern is not None else None
+    with os.scandir(directory) as it:
+        for entry in it:
+            if match is not None and not match(entry.name):
+                continue
+            if entry.is_symlink():
+                try:
+                    entry.stat()
+                except OSError:
+                    continue
+                if not _inside(os.path.realpath(entry.path), root):
+                    continue
+            yield entry